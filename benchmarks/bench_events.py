@@ -0,0 +1,69 @@
+"""
+Ingestion cost and memory per event, pydantic `Event` against the slotted `CompactEvent`.
+
+    python benchmarks/bench_events.py
+"""
+import secrets
+import time
+import tracemalloc
+
+from ekiden.keys import PrivateKey
+from ekiden.nips import CompactEvent, ETag, Event, PTag
+
+EVENTS = 2_000
+
+
+def signed_events():
+    private_key = PrivateKey()
+    return [
+        Event(
+            pubkey=private_key.public_key_hex(),
+            kind=1,
+            content="gm nostr " * 10,
+            tags=[ETag(id=secrets.token_hex(32)), PTag(pubkey=secrets.token_hex(32))],
+        ).signed(private_key.hex())
+        for _ in range(EVENTS)
+    ]
+
+
+def copies(events):
+    # verification takes ownership of the dict it is given
+    return [dict(event, tags=[list(tag) for tag in event["tags"]]) for event in events]
+
+
+def timed(verify, events) -> float:
+    events = copies(events)
+    start = time.perf_counter()
+    for event in events:
+        verify(event)
+    return (time.perf_counter() - start) / len(events)
+
+
+def memory(verify, events) -> float:
+    events = copies(events)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [verify(event) for event in events]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # the tags and strings of the source dicts are shared by both representations
+    del kept
+    return (after - before) / len(events)
+
+
+def main():
+    events = signed_events()
+    results = {}
+    for name, verify in (("pydantic", Event.verify), ("compact", CompactEvent.verify)):
+        results[name] = (timed(verify, events), memory(verify, events))
+
+    for name, (seconds, size) in results.items():
+        print(f"{name:>9}: {seconds * 1e6:8.2f} us/event verified, {size:8.0f} bytes/event held")
+    print(
+        f"{results['pydantic'][0] / results['compact'][0]:.1f}x faster ingestion, "
+        f"{results['pydantic'][1] - results['compact'][1]:.0f} bytes saved per event"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Event ingestion throughput, one transaction per event (the previous behaviour) against the group commit pipeline, on
+each storage backend.
+
+    python benchmarks/bench_ingestion.py
+"""
+import asyncio
+import os
+import secrets
+import tempfile
+import time
+
+from ekiden.config import StorageBackend, settings
+from ekiden.ingestion import WriteBehind
+from ekiden.nips import CompactEvent, ETag, Event, PTag
+from ekiden.storage import SqliteStorage, Storage, TortoiseStorage
+
+EVENTS = 2_000
+PUBLISHERS = 50
+
+
+def random_events():
+    return [
+        CompactEvent.load(
+            Event(
+                pubkey=secrets.token_hex(32),
+                kind=1,
+                content="hello, world",
+                tags=[ETag(id=secrets.token_hex(32)), PTag(pubkey=secrets.token_hex(32))],
+                sig=secrets.token_hex(64),
+            ).dict()
+        )
+        for _ in range(EVENTS)
+    ]
+
+
+async def publish(events, store):
+    # spread the events over concurrent publishers, each waiting for its previous event to be stored
+    async def publisher(chunk):
+        for event in chunk:
+            await store(event)
+
+    await asyncio.gather(*[publisher(events[n::PUBLISHERS]) for n in range(PUBLISHERS)])
+
+
+async def run(backend: StorageBackend, name: str, group_commit: bool):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.sqlite3")
+        storage: Storage = SqliteStorage(path=path) if backend == StorageBackend.sqlite else TortoiseStorage(path=path)
+        await storage.open()
+
+        if group_commit:
+            writer = WriteBehind(storage=storage)
+            store = writer.write
+        else:
+
+            async def store(event):
+                await storage.store_events([event])
+
+        events = random_events()
+        start = time.perf_counter()
+        await publish(events, store)
+        elapsed = time.perf_counter() - start
+
+        if group_commit:
+            await writer.close()
+        await storage.close()
+
+    print(f"{backend.value:>9} {name:>13}: {EVENTS / elapsed:9.0f} events/s")
+
+
+if __name__ == "__main__":
+    print(f"{EVENTS} events from {PUBLISHERS} publishers, synchronous={settings.durability.value}")
+    for backend in (StorageBackend.tortoise, StorageBackend.sqlite):
+        asyncio.run(run(backend, "per event", group_commit=False))
+        asyncio.run(run(backend, "group commit", group_commit=True))
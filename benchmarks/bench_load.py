@@ -0,0 +1,261 @@
+"""
+End-to-end load test: publishers and subscribers talking to a relay over websockets.
+
+    python benchmarks/bench_load.py [--publishers 10] [--subscribers 50] [--events 100] [--json load.json]
+
+By default the relay is started with uvicorn in a subprocess, on a temporary database, and its memory is reported.
+`--in-process` serves `create_app()` from this process instead (memory then includes the clients) and `--url` targets
+a relay that is already running. Events are signed up front, subscribers only ask for live events (`limit: 0`) with a
+mix of feed, thread, mention, profile and global filters.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import websockets
+from report import percentile, rss, write
+
+from ekiden.keys import PrivateKey
+from ekiden.nips import CompactEvent, Event, Filters, create_tag
+from ekiden.subscriptions import validate_filters
+
+
+class Population:
+    """The signed events of every publisher and the filters of every subscriber"""
+
+    def __init__(self, publishers: int, subscribers: int, events: int, seed: int):
+        rng = random.Random(seed)
+        keys = [PrivateKey() for _ in range(publishers)]
+        authors = [key.public_key_hex() for key in keys]
+        audience = authors + [secrets.token_hex(32) for _ in range(50)]
+        threads = [secrets.token_hex(32) for _ in range(20)]
+
+        now = int(time.time())
+        self.events: List[List[dict]] = []
+        for key in keys:
+            signed = []
+            for n in range(events):
+                if n % 10 == 9:
+                    # profile updates, each newer than the last so none of them are stale
+                    event = Event(pubkey=key.public_key_hex(), kind=0, content='{"name":"bench"}', created_at=now + n)
+                else:
+                    tags = []
+                    if rng.random() < 0.5:
+                        tags.append(["e", rng.choice(threads), ""])
+                    if rng.random() < 0.7:
+                        tags.append(["p", rng.choice(audience), ""])
+                    event = Event(
+                        pubkey=key.public_key_hex(),
+                        kind=1,
+                        content=f"gm nostr {n} " * 5,
+                        tags=[create_tag(tag) for tag in tags],
+                        created_at=now,
+                    )
+                signed.append(event.signed(key.hex()))
+            self.events.append(signed)
+
+        self.filters: List[dict] = []
+        for _ in range(subscribers):
+            roll = rng.random()
+            if roll < 0.5:
+                filters = {"authors": rng.sample(authors, min(5, len(authors))), "kinds": [1]}
+            elif roll < 0.7:
+                filters = {"#e": rng.sample(threads, 2)}
+            elif roll < 0.9:
+                filters = {"#p": [rng.choice(authors)]}
+            elif roll < 0.99:
+                filters = {"kinds": [0]}
+            else:
+                filters = {}
+            self.filters.append(dict(filters, limit=0))
+
+    def expected(self, accepted: List[dict]) -> int:
+        """How many deliveries the accepted events should make"""
+        events = [CompactEvent.load(dict(event)) for event in accepted]
+        return sum(
+            validate_filters(event, filters)
+            for filters in (Filters.parse_obj(filters) for filters in self.filters)
+            for event in events
+        )
+
+
+class Run:
+    def __init__(self, url: str, population: Population, rate: float):
+        self.url = url
+        self.population = population
+        self.rate = rate
+
+        self.sent_at: Dict[str, float] = {}
+        self.accepted: List[dict] = []
+        self.rejected = 0
+        self.ok_latencies: List[float] = []
+        self.delivery_latencies: List[float] = []
+        self.last_delivery = 0.0
+
+    async def subscriber(self, number: int, filters: dict, ready: asyncio.Event, subscribed: List[int]):
+        async with websockets.connect(self.url, max_size=None) as ws:
+            await ws.send(json.dumps(["REQ", f"bench-{number}", filters]))
+            while json.loads(await ws.recv())[0] != "EOSE":
+                pass
+            subscribed.append(number)
+            if len(subscribed) == len(self.population.filters):
+                ready.set()
+
+            async for frame in ws:
+                received = time.perf_counter()
+                message = json.loads(frame)
+                if message[0] == "EVENT":
+                    self.delivery_latencies.append(received - self.sent_at[message[2]["id"]])
+                    self.last_delivery = received
+
+    async def publisher(self, events: List[dict]):
+        async with websockets.connect(self.url, max_size=None) as ws:
+            for event in events:
+                started = time.perf_counter()
+                self.sent_at[event["id"]] = started
+                await ws.send(json.dumps(["EVENT", event]))
+                _, _, ok, _ = json.loads(await ws.recv())[:4]
+                self.ok_latencies.append(time.perf_counter() - started)
+                if ok == "true":
+                    self.accepted.append(event)
+                else:
+                    self.rejected += 1
+                if self.rate:
+                    await asyncio.sleep(max(0.0, 1 / self.rate - (time.perf_counter() - started)))
+
+    async def __call__(self, drain: float) -> dict:
+        ready, subscribed = asyncio.Event(), []
+        subscribers = [
+            asyncio.create_task(self.subscriber(number, filters, ready, subscribed))
+            for number, filters in enumerate(self.population.filters)
+        ]
+        if subscribers:
+            await ready.wait()
+
+        start = time.perf_counter()
+        await asyncio.gather(*[self.publisher(events) for events in self.population.events])
+        published = time.perf_counter()
+
+        expected = self.population.expected(self.accepted)
+        deadline = time.perf_counter() + drain
+        while len(self.delivery_latencies) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        for task in subscribers:
+            task.cancel()
+        await asyncio.gather(*subscribers, return_exceptions=True)
+
+        delivered = len(self.delivery_latencies)
+        return {
+            "events_accepted": len(self.accepted),
+            "events_rejected": self.rejected,
+            "events_per_s": len(self.accepted) / (published - start),
+            "deliveries": delivered,
+            "deliveries_missing": expected - delivered,
+            "deliveries_per_s": delivered / (self.last_delivery - start) if delivered else 0.0,
+            "ok_latency_p50_ms": percentile(self.ok_latencies, 50) * 1e3,
+            "ok_latency_p99_ms": percentile(self.ok_latencies, 99) * 1e3,
+            "ok_latency_max_ms": max(self.ok_latencies, default=0.0) * 1e3,
+            "delivery_latency_p50_ms": percentile(self.delivery_latencies, 50) * 1e3,
+            "delivery_latency_p99_ms": percentile(self.delivery_latencies, 99) * 1e3,
+            "delivery_latency_max_ms": max(self.delivery_latencies, default=0.0) * 1e3,
+        }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for(url: str, timeout: float = 10):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            async with websockets.connect(url):
+                return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def main(args) -> dict:
+    population = Population(args.publishers, args.subscribers, args.events, args.seed)
+
+    server: Optional[subprocess.Popen] = None
+    uvicorn_server = serving = None
+    with tempfile.TemporaryDirectory() as directory:
+        url = args.url
+        if url is None:
+            port = free_port()
+            url = f"ws://127.0.0.1:{port}/"
+            env = dict(os.environ, EKIDEN_DB_PATH=os.path.join(directory, "bench.sqlite3"), EKIDEN_BUS="none")
+            # every client connects from localhost and a few authors publish everything, nothing would get through
+            env.update(EKIDEN_CONNECTION_RATE="0", EKIDEN_ADDRESS_RATE="0", EKIDEN_PUBKEY_RATE="0")
+            if args.in_process:
+                import uvicorn
+
+                os.environ.update(env)
+                from ekiden.main import create_app
+
+                app = create_app()
+                # every stored event is logged at INFO
+                logging.getLogger("ekiden").setLevel(logging.WARNING)
+                uvicorn_server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+                serving = asyncio.create_task(uvicorn_server.serve())
+            else:
+                server = subprocess.Popen(
+                    [sys.executable, "-m", "uvicorn", "--factory", "ekiden.main:create_app", "--port", str(port)],
+                    env=env,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+        await wait_for(url)
+
+        try:
+            results = await Run(url, population, args.rate)(args.drain)
+            if server is not None:
+                results.update(rss(server.pid))
+            elif uvicorn_server is not None:
+                results.update(rss())
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+            if uvicorn_server is not None:
+                uvicorn_server.should_exit = True
+                await serving
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--publishers", type=int, default=10)
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--events", type=int, default=100, help="events sent by each publisher")
+    parser.add_argument(
+        "--rate", type=float, default=0, help="events/s per publisher, 0 sends as fast as OKs come back"
+    )
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for outstanding deliveries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--url", help="a running relay to target instead of starting one")
+    parser.add_argument("--in-process", action="store_true", help="serve the relay from this process")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args))
+    params = {
+        name: getattr(args, name) for name in ("publishers", "subscribers", "events", "rate", "seed", "in_process")
+    }
+    params["target"] = "url" if args.url else "local"
+    write(args.json, "load", params, results)
@@ -0,0 +1,141 @@
+"""
+Micro-benchmarks of the per-event hot paths: verification, id hashing, filter matching and JSON encoding.
+
+    python benchmarks/bench_micro.py [--json micro.json]
+"""
+import argparse
+import secrets
+import statistics
+import time
+from typing import Callable, List
+
+from report import write
+
+from ekiden.keys import PrivateKey
+from ekiden.nips import (
+    CompactEvent,
+    ETag,
+    Event,
+    Filters,
+    PTag,
+    create_tag,
+    dump_json,
+    event_message,
+)
+from ekiden.subscriptions import CompiledFilters, validate_filters
+
+EVENTS = 1_000
+REPEATS = 5
+
+
+def signed_events() -> List[dict]:
+    private_key = PrivateKey()
+    return [
+        Event(
+            pubkey=private_key.public_key_hex(),
+            kind=1,
+            content="gm nostr " * 10,
+            tags=[ETag(id=secrets.token_hex(32)), PTag(pubkey=secrets.token_hex(32))],
+        ).signed(private_key.hex())
+        for _ in range(EVENTS)
+    ]
+
+
+def copies(events: List[dict]) -> List[dict]:
+    # verification takes ownership of the dict it is given
+    return [dict(event, tags=[list(tag) for tag in event["tags"]]) for event in events]
+
+
+def per_op(run: Callable[[], int], setup: Callable[[], None] = None) -> float:
+    """Median nanoseconds per operation over `REPEATS` runs, `run` returns how many operations it did"""
+    samples = []
+    for _ in range(REPEATS):
+        if setup is not None:
+            setup()
+        start = time.perf_counter_ns()
+        operations = run()
+        samples.append((time.perf_counter_ns() - start) / operations)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    events = signed_events()
+    compact = [CompactEvent.load(dict(event)) for event in events]
+    results = {}
+
+    state = {}
+
+    def fresh_copies():
+        state["events"] = copies(events)
+
+    def verify(cls):
+        def run():
+            for event in state["events"]:
+                cls.verify(event)
+            return len(events)
+
+        return run
+
+    results["pydantic_verify_ns"] = per_op(verify(Event), fresh_copies)
+    results["compact_verify_ns"] = per_op(verify(CompactEvent), fresh_copies)
+
+    def fresh_models():
+        state["models"] = [Event(**dict(event, tags=[create_tag(tag) for tag in event["tags"]])) for event in events]
+
+    def hash_ids():
+        for model in state["models"]:
+            model.id
+        return len(events)
+
+    results["event_id_ns"] = per_op(hash_ids, fresh_models)
+    # the digest is cached on the instance, the second access is a lookup
+    results["event_id_cached_ns"] = per_op(hash_ids)
+
+    target = compact[0]
+    filter_mix = {
+        "authors_kinds": Filters(authors=[secrets.token_hex(32) for _ in range(4)] + [target.pubkey], kinds=[1]),
+        "author_prefixes": Filters(authors=[secrets.token_hex(4) for _ in range(4)] + [target.pubkey[:8]]),
+        "e_tag": Filters.parse_obj({"#e": list(target.e_tags)}),
+        "p_tag_miss": Filters.parse_obj({"#p": [secrets.token_hex(32)]}),
+        "since_until": Filters(since=0, until=2**32),
+    }
+    for name, filters in filter_mix.items():
+
+        def match(filters=filters):
+            for event in compact:
+                validate_filters(event, filters)
+            return len(compact)
+
+        results[f"validate_filters_{name}_ns"] = per_op(match)
+
+        def match_compiled(compiled=CompiledFilters.compile(filters)):
+            for event in compact:
+                compiled.matches(event)
+            return len(compact)
+
+        results[f"compiled_filters_{name}_ns"] = per_op(match_compiled)
+
+    def dump_events():
+        for event in events:
+            dump_json(event)
+        return len(events)
+
+    def frames():
+        for event in compact:
+            event_message("sub", event)
+        return len(compact)
+
+    results["dump_json_event_ns"] = per_op(dump_events)
+    results["event_message_ns"] = per_op(frames)
+
+    for metric in list(results):
+        results[metric.removesuffix("_ns") + "_per_s"] = 1e9 / results[metric]
+    write(args.json, "micro", {"events": EVENTS, "repeats": REPEATS}, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Replay CPU per event, hydrating models and re-encoding them (the previous behaviour) against splicing the stored JSON
+into the frame, on each storage backend, and against answering from the hot events held in memory.
+
+    python benchmarks/bench_replay.py
+"""
+import asyncio
+import os
+import secrets
+import tempfile
+import time
+
+from ekiden import database
+from ekiden.hot import HotEvents
+from ekiden.nips import (
+    CompactEvent,
+    ETag,
+    Event,
+    Filters,
+    PTag,
+    event_message,
+    payload_message,
+)
+from ekiden.storage import SqliteStorage, Storage, TortoiseStorage
+
+EVENTS = 2_000
+ROUNDS = 5
+
+
+async def hydrated(storage: Storage):
+    for record in await database.Event.all().order_by("-created_at", "-id").limit(EVENTS):
+        event_message("sub", record.nipple())
+
+
+async def raw(storage: Storage):
+    async for _, payload in storage.stream_events(Filters(), limit=EVENTS, page_size=EVENTS):
+        payload_message("sub", payload)
+
+
+async def main():
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.sqlite3")
+        storage = SqliteStorage(path=path)
+        await storage.open()
+        now = int(time.time())
+        await storage.store_events(
+            [
+                CompactEvent.load(
+                    Event(
+                        pubkey=secrets.token_hex(32),
+                        kind=1,
+                        content="gm nostr " * 20,
+                        tags=[ETag(id=secrets.token_hex(32)), PTag(pubkey=secrets.token_hex(32))],
+                        sig=secrets.token_hex(64),
+                        created_at=now - i,
+                    ).dict()
+                )
+                for i in range(EVENTS)
+            ]
+        )
+        await storage.close()
+
+        for name, storage, replay in (
+            ("hydrated", TortoiseStorage(path=path), hydrated),
+            ("raw tortoise", TortoiseStorage(path=path), raw),
+            ("raw sqlite", SqliteStorage(path=path), raw),
+        ):
+            await storage.open()
+            start = time.process_time()
+            for _ in range(ROUNDS):
+                await replay(storage)
+            results[name] = (time.process_time() - start) / (ROUNDS * EVENTS)
+            await storage.close()
+
+        storage = SqliteStorage(path=path)
+        await storage.open()
+        hot = HotEvents(size=EVENTS, age=0)
+        await hot.warm(storage)
+        await storage.close()
+        start = time.process_time()
+        for _ in range(ROUNDS):
+            events, _ = hot.match(Filters(), EVENTS)
+            for event in events:
+                payload_message("sub", event.payload())
+        results["hot events"] = (time.process_time() - start) / (ROUNDS * EVENTS)
+
+    for name, seconds in results.items():
+        print(f"{name:>12}: {seconds * 1e6:8.2f} us cpu/event")
+    print(f"{results['hydrated'] / results['raw sqlite']:.1f}x less replay CPU")
+    print(f"{results['raw sqlite'] / results['hot events']:.1f}x less again from memory")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
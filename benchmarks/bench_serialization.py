@@ -0,0 +1,70 @@
+"""
+Per-subscriber cost of building the `EVENT` frame for a broadcast, re-hashing and re-encoding the event for every
+subscriber (the previous behaviour) against encoding it once and splicing in the subscription id.
+
+    python benchmarks/bench_serialization.py
+"""
+import secrets
+import time
+from hashlib import sha256
+
+from ekiden.keys import PrivateKey
+from ekiden.nips import ETag, Event, PTag, dump_json, event_message
+
+SUBSCRIBERS = 5_000
+
+
+def uncached_frame(subscription_id: str, event: Event) -> str:
+    event_id = sha256(
+        Event.serialize(
+            pubkey=event.pubkey,
+            created_at=event.created_at,
+            kind=event.kind,
+            tags=[tag.json_array() for tag in event.tags],
+            content=event.content,
+        ).encode("utf-8")
+    ).hexdigest()
+    return dump_json(
+        [
+            "EVENT",
+            subscription_id,
+            {
+                "id": event_id,
+                "pubkey": event.pubkey,
+                "created_at": event.created_at,
+                "kind": event.kind,
+                "tags": [tag.json_array() for tag in event.tags],
+                "content": event.content,
+                "sig": event.sig,
+            },
+        ]
+    )
+
+
+def main():
+    private_key = PrivateKey()
+    event = Event(
+        pubkey=private_key.public_key_hex(),
+        kind=1,
+        content="gm nostr " * 30,
+        tags=[ETag(id=secrets.token_hex(32)) for _ in range(3)]
+        + [PTag(pubkey=secrets.token_hex(32)) for _ in range(3)],
+    )
+    event = Event.verify(event.signed(private_key.hex()))
+    subscription_ids = [secrets.token_hex(8) for _ in range(SUBSCRIBERS)]
+    assert uncached_frame(subscription_ids[0], event) == event_message(subscription_ids[0], event)
+
+    results = {}
+    for name, build in (("per subscriber", uncached_frame), ("spliced", event_message)):
+        start = time.perf_counter()
+        for subscription_id in subscription_ids:
+            build(subscription_id, event)
+        results[name] = (time.perf_counter() - start) / SUBSCRIBERS
+
+    for name, seconds in results.items():
+        print(f"{name:>15}: {seconds * 1e6:8.2f} us/subscriber")
+    print(f"{results['per subscriber'] / results['spliced']:.1f}x faster per {SUBSCRIBERS} subscriber broadcast")
+
+
+if __name__ == "__main__":
+    main()
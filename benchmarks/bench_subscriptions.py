@@ -0,0 +1,91 @@
+"""
+Compares broadcasting through the indexed `SubscriptionPool`, which evaluates each distinct filter once, against the
+previous linear scan over every subscription.
+
+    python benchmarks/bench_subscriptions.py
+"""
+import asyncio
+import random
+import secrets
+import time
+
+from ekiden.nips import CompactEvent, ETag, Event, Filters, PTag
+from ekiden.subscriptions import Subscription, SubscriptionPool, validate_filters
+
+SIZES = (1_000, 10_000, 100_000)
+EVENTS = 50
+
+
+class NullConnection:
+    async def send(self, data: str):
+        pass
+
+
+def random_hex() -> str:
+    return secrets.token_hex(32)
+
+
+def random_filters(authors, event_ids) -> Filters:
+    """A rough mix of what clients subscribe with: feeds by author, replies, mentions, kinds and the odd global feed"""
+    roll = random.random()
+    if roll < 0.5:
+        return Filters(authors=random.sample(authors, 5), kinds=[1])
+    if roll < 0.7:
+        return Filters.parse_obj({"#e": random.sample(event_ids, 2)})
+    if roll < 0.9:
+        return Filters.parse_obj({"#p": random.sample(authors, 1)})
+    if roll < 0.99:
+        return Filters(kinds=[random.choice((0, 3, 7))])
+    return Filters()
+
+
+def random_event(authors, event_ids) -> CompactEvent:
+    event = Event(
+        pubkey=random.choice(authors),
+        kind=random.choice((0, 1, 1, 1, 3, 7)),
+        content="hello, world",
+        tags=[ETag(id=random.choice(event_ids)), PTag(pubkey=random.choice(authors))],
+    )
+    return CompactEvent.load(event.dict())
+
+
+async def linear_broadcast(pool: SubscriptionPool, event: CompactEvent):
+    # every filter of every subscription checked with `validate_filters`, as before the pool was indexed
+    for subscription in pool.subscriptions():
+        if any(validate_filters(event, filters) for filters in subscription.filters):
+            await subscription.connection.send("")
+
+
+async def indexed_broadcast(pool: SubscriptionPool, event: CompactEvent):
+    for subscription in pool.matching(event):
+        await subscription.connection.send("")
+
+
+async def run(size: int):
+    authors = [random_hex() for _ in range(max(size // 10, 100))]
+    event_ids = [random_hex() for _ in range(max(size // 10, 100))]
+    pool = SubscriptionPool()
+    connection = NullConnection()
+    for n in range(size):
+        pool.add_subscription(
+            Subscription(filters=[random_filters(authors, event_ids)], connection=connection, subscription_id=str(n))
+        )
+
+    events = [random_event(authors, event_ids) for _ in range(EVENTS)]
+    results = {}
+    for name, broadcast in (("linear", linear_broadcast), ("indexed", indexed_broadcast)):
+        start = time.perf_counter()
+        for event in events:
+            await broadcast(pool, event)
+        results[name] = (time.perf_counter() - start) / EVENTS
+
+    print(
+        f"{size:>7} subscriptions ({pool.distinct_filters():>6} distinct filters): linear {results['linear'] * 1e3:9.3f} ms/event, "
+        f"indexed {results['indexed'] * 1e3:9.3f} ms/event ({results['linear'] / results['indexed']:.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    for size in SIZES:
+        asyncio.run(run(size))
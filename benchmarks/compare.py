@@ -0,0 +1,53 @@
+"""
+Compares two result files written with `--json`, exiting with 1 when a metric regressed past the threshold.
+
+    python benchmarks/compare.py before.json after.json [--threshold 0.1]
+"""
+import argparse
+import json
+import sys
+
+
+def regression(metric: str, before: float, after: float) -> float:
+    """Relative change for the worse, negative when the metric improved"""
+    if before == 0:
+        return 0.0
+    change = (after - before) / before
+    return -change if metric.endswith("_per_s") else change
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    if before["benchmark"] != after["benchmark"]:
+        sys.exit(f"can't compare {before['benchmark']} results with {after['benchmark']} results")
+    if before["params"] != after["params"]:
+        print(f"warning: parameters differ, {before['params']} against {after['params']}")
+
+    print(f"{before['benchmark']}: {before['revision']} -> {after['revision']}")
+    regressed = []
+    width = max(map(len, after["results"]))
+    for metric, value in after["results"].items():
+        if metric not in before["results"]:
+            print(f"{metric:>{width}}: {value:>14,.2f}  (new)")
+            continue
+        worse = regression(metric, before["results"][metric], value)
+        flag = ""
+        if worse > args.threshold:
+            flag = "  REGRESSION"
+            regressed.append(metric)
+        change = (value - before["results"][metric]) / before["results"][metric] if before["results"][metric] else 0.0
+        print(f"{metric:>{width}}: {before['results'][metric]:>14,.2f} -> {value:>14,.2f}  {change:+7.1%}{flag}")
+
+    if regressed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
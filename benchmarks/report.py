@@ -0,0 +1,68 @@
+"""
+Machine-readable results shared by the benchmark scripts, see `compare.py` for diffing two runs.
+
+Results are flat `{metric: number}` dicts. Metrics ending in `_per_s` are better when higher, every other metric
+(latencies, sizes) is better when lower.
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+from typing import Dict, Optional, Sequence
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile, 0 for no values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def rss(pid: int = None) -> Dict[str, int]:
+    """Current and peak resident memory of a process in bytes, read from /proc (Linux only)"""
+    try:
+        with open(f"/proc/{pid or os.getpid()}/status") as status:
+            fields = dict(line.split(":", 1) for line in status)
+    except OSError:
+        return {}
+    # reported in kB
+    return {
+        "rss_bytes": int(fields["VmRSS"].split()[0]) * 1024,
+        "rss_peak_bytes": int(fields["VmHWM"].split()[0]) * 1024,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write(path: Optional[str], benchmark: str, params: dict, results: Dict[str, float]):
+    """Print the results and, given a path, write them out as JSON along with what produced them"""
+    width = max(map(len, results))
+    for metric, value in results.items():
+        print(f"{metric:>{width}}: {value:,.2f}" if isinstance(value, float) else f"{metric:>{width}}: {value:,}")
+
+    if path is None:
+        return
+    with open(path, "w") as out:
+        json.dump(
+            {
+                "benchmark": benchmark,
+                "timestamp": int(time.time()),
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "params": params,
+                "results": results,
+            },
+            out,
+            indent=2,
+        )
+        out.write("\n")
@@ -0,0 +1,145 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from starlette.websockets import WebSocket
+
+from ekiden.config import settings
+
+
+class TokenBucket:
+    """Allows `rate` units per second on average and bursts of up to `burst` units"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, cost: float = 1, now: float = None) -> bool:
+        """Check for enough tokens without taking them"""
+        self._refill(time.monotonic() if now is None else now)
+        return self.tokens >= cost
+
+    def take(self, cost: float = 1, now: float = None) -> bool:
+        """Take the tokens if there are enough
+
+        Args:
+            cost (float): Tokens to take
+            now (float): Current `time.monotonic()`
+
+        Returns:
+            bool: False if the bucket ran dry, nothing is taken then
+        """
+        if not self.ready(cost, now):
+            return False
+        self.tokens -= cost
+        return True
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """Token buckets by key (an address, a pubkey), holding at most `size` of them.
+
+    Buckets are kept in least recently used order. A bucket that has refilled is forgotten, which loses nothing as a new
+    one starts out full, and the least recently used bucket makes room when the limiter is full. A rate of 0 disables
+    the limiter.
+    """
+
+    def __init__(self, rate: float, burst: float, size: int = None):
+        self.rate = rate
+        self.burst = burst
+        self.size = size or settings.rate_limit_keys
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def ready(self, key: str, cost: float = 1) -> bool:
+        """Check whether the key has enough tokens left, without taking them"""
+        if not self.rate:
+            return True
+        bucket = self._buckets.get(key)
+        return bucket is None or bucket.ready(cost)
+
+    def take(self, key: str, cost: float = 1) -> bool:
+        """Take tokens from the key's bucket
+
+        Args:
+            key (str): What is limited
+            cost (float): Tokens to take
+
+        Returns:
+            bool: False if the key is over its limit
+        """
+        if not self.rate:
+            return True
+
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+            self._evict(now, keep=key)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(cost, now)
+
+    def _evict(self, now: float, keep: str):
+        while True:
+            key, bucket = next(iter(self._buckets.items()))
+            if key == keep or (len(self._buckets) <= self.size and not bucket.full(now)):
+                break
+            del self._buckets[key]
+
+
+class Admission:
+    """Decides whether a client's message is worth any work, before decoding it further, verifying or querying.
+
+    Every message costs tokens from its connection and its address, a REQ costs one per filter. Events also cost one
+    from their author, only taken once the signature proved who that is so nobody can spend someone else's tokens.
+    """
+
+    def __init__(self):
+        self.addresses = RateLimiter(settings.address_rate, settings.address_burst)
+        self.pubkeys = RateLimiter(settings.pubkey_rate, settings.pubkey_burst)
+
+    def connection_bucket(self) -> Optional[TokenBucket]:
+        """A bucket for a new connection, None when connections aren't limited"""
+        if not settings.connection_rate:
+            return None
+        return TokenBucket(settings.connection_rate, settings.connection_burst)
+
+    @staticmethod
+    def address(websocket: WebSocket) -> Optional[str]:
+        """The client's address, read from X-Forwarded-For when the relay runs behind `trusted_proxies` proxies"""
+        if settings.trusted_proxies:
+            forwarded = [hop.strip() for hop in websocket.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+            if forwarded:
+                # each proxy appends the address it got the request from, anything before the first is client supplied
+                return forwarded[-min(settings.trusted_proxies, len(forwarded))]
+        return websocket.client.host if websocket.client else None
+
+    def admit(self, bucket: Optional[TokenBucket], address: Optional[str], cost: float = 1) -> Optional[str]:
+        """Charge a message to its connection and address
+
+        Args:
+            bucket (Optional[TokenBucket]): The connection's bucket
+            address (Optional[str]): The client's address
+            cost (float): Tokens the message costs
+
+        Returns:
+            Optional[str]: What ran out of tokens, None if the message is admitted
+        """
+        if bucket is not None and not bucket.take(cost):
+            return "connection"
+        if address is not None and not self.addresses.take(address, cost):
+            return "address"
+        return None
@@ -0,0 +1,246 @@
+import asyncio
+import hashlib
+import os
+import socket
+import stat
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from ekiden import codec, logger, metrics
+from ekiden.config import BusTransport, settings
+from ekiden.nips import CompactEvent
+
+Deliver = Callable[[CompactEvent], Awaitable[None]]
+Lost = Callable[[], None]
+
+
+class Bus:
+    """Fans written events out to the other relay processes.
+
+    Every published event must reach every other process exactly once. The publishing process broadcasts to its own
+    subscribers itself, so a transport that echoes messages back (e.g. a Redis style pub/sub channel) has to drop its
+    own messages on receipt.
+    """
+
+    async def start(self, deliver: Deliver, lost: Lost = None):
+        """Start receiving events from the other processes
+
+        Args:
+            deliver (Deliver): Called with each event published by another process
+            lost (Lost): Called when events written by another process may not all have been delivered
+        """
+
+    async def publish(self, event: CompactEvent):
+        """Send the event to the other processes
+
+        Args:
+            event (CompactEvent): The verified event, once it was written
+        """
+
+    async def resync(self):
+        """Tell the other processes events were written without being published, e.g. by `ekiden import`"""
+
+    async def close(self):
+        pass
+
+
+def default_path() -> str:
+    """A directory of the user running the relay, shared by the processes serving the same database"""
+    database = hashlib.sha256(os.path.abspath(settings.db_path).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"ekiden-bus-{os.getuid()}-{database}")
+
+
+def private_directory(path: str):
+    """Create the directory only its owner can enter, or check an existing one is such
+
+    Raises:
+        PermissionError: When the directory belongs to someone else or others may enter it
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{path} must be a directory only the user running the relay can access")
+
+
+# messages between workers besides the numbered events
+HELLO, WELCOME, RESYNC = b"hello", b"welcome", b"resync"
+
+
+class UnixSocketBus(Bus):
+    """Each worker binds a unix datagram socket in a shared directory and sends every event to all the other sockets
+    found there. Sockets of workers that went away are removed as soon as a send to them is refused.
+
+    Only the owner can enter the directory, so what arrives was sent by another worker and is delivered without being
+    verified again. Each event is numbered by its sender: one a peer could not take in time is dropped rather than
+    holding the publishing worker up, and the peer learns about it from the gap in the numbers.
+
+    A starting worker says hello to the sockets already there and waits for them to add it to their peers, so every
+    event written after `start` returns reaches it.
+    """
+
+    # how often the directory is listed to pick up new workers
+    refresh_interval = 1.0
+
+    def __init__(self, path: str = None):
+        self.path = path or settings.bus_path or default_path()
+        self.address = os.path.join(self.path, f"{os.getpid()}.sock")
+
+        self._socket: Optional[socket.socket] = None
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._peers: Set[str] = set()
+        self._peers_listed_at = 0.0
+        self._sequence = 0
+        # peers that didn't answer the hello yet
+        self._greeting: Set[str] = set()
+        self._greeted = asyncio.Event()
+
+    async def start(self, deliver: Deliver, lost: Lost = None):
+        private_directory(self.path)
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self._socket.bind(self.address)
+        self._socket.setblocking(False)
+
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _BusProtocol(self, deliver, lost), sock=self._socket
+        )
+
+        self._peers_listed_at = 0.0
+        self._list_peers()
+        self._greeting = set(self._peers)
+        self._send(HELLO, "hello")
+        self._greeting &= self._peers
+        if self._greeting:
+            try:
+                await asyncio.wait_for(self._greeted.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                logger.warning(f"bus peers {sorted(self._greeting)} did not answer, they may miss events for a while")
+
+    def joined(self, peer: str):
+        """A worker said hello, it gets every event from now on"""
+        self._peers.add(peer)
+        self._send_to(WELCOME, peer, "welcome")
+
+    def welcomed(self, peer: str):
+        self._greeting.discard(peer)
+        if not self._greeting:
+            self._greeted.set()
+
+    def _list_peers(self):
+        now = time.monotonic()
+        if now - self._peers_listed_at < self.refresh_interval:
+            return
+        self._peers_listed_at = now
+        self._peers = {
+            os.path.join(self.path, name)
+            for name in os.listdir(self.path)
+            if name.endswith(".sock") and os.path.join(self.path, name) != self.address
+        }
+
+    async def publish(self, event: CompactEvent):
+        if self._socket is None:
+            return
+
+        self._list_peers()
+        self._sequence += 1
+        self._send(f"{self._sequence} {event.payload()}".encode("utf-8"), f"event {event.id}")
+
+    async def resync(self):
+        if self._socket is None:
+            return
+        self._list_peers()
+        self._send(RESYNC, "resync")
+
+    def _send(self, data: bytes, what: str):
+        for peer in list(self._peers):
+            self._send_to(data, peer, what)
+
+    def _send_to(self, data: bytes, peer: str, what: str):
+        try:
+            self._socket.sendto(data, peer)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # the worker is gone
+            self._peers.discard(peer)
+            try:
+                os.unlink(peer)
+            except OSError:
+                pass
+        except BlockingIOError:
+            metrics.bus_dropped.inc("peer_full")
+            logger.warning(f"bus peer {peer} is not keeping up, dropped {what}")
+        except OSError as e:
+            metrics.bus_dropped.inc("send_failed")
+            logger.warning(f"could not send {what} to bus peer {peer}: {e}")
+
+    async def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        self._socket = None
+        try:
+            os.unlink(self.address)
+            os.rmdir(self.path)
+        except OSError:
+            pass
+
+
+class _BusProtocol(asyncio.DatagramProtocol):
+    def __init__(self, bus: UnixSocketBus, deliver: Deliver, lost: Optional[Lost]):
+        self.bus = bus
+        self.deliver = deliver
+        self.lost = lost
+        # the number of the last event received from each peer
+        self.sequences: Dict[str, int] = {}
+
+    def datagram_received(self, data: bytes, addr):
+        # only workers can bind sockets in the directory
+        if not isinstance(addr, str) or os.path.dirname(addr) != self.bus.path:
+            metrics.bus_dropped.inc("unknown_sender")
+            logger.warning(f"dropping bus message from {addr!r}, not a worker socket")
+            return
+        if data == HELLO:
+            self.bus.joined(addr)
+            return
+        if data == WELCOME:
+            self.bus.welcomed(addr)
+            return
+        if data == RESYNC:
+            if self.lost is not None:
+                self.lost()
+            return
+
+        try:
+            sequence, payload = data.decode("utf-8").split(" ", 1)
+            sequence = int(sequence)
+            event = CompactEvent.load(codec.loads(payload), payload=payload)
+        except Exception as e:
+            metrics.bus_dropped.inc("malformed")
+            logger.warning(f"dropping malformed bus message: {e}")
+            return
+
+        # a lower number is a restarted worker that reuses the socket
+        last = self.sequences.get(addr)
+        self.sequences[addr] = sequence
+        if last is not None and sequence > last + 1:
+            metrics.bus_dropped.inc("lost", sequence - last - 1)
+            logger.warning(f"{sequence - last - 1} events from bus peer {addr} were lost")
+            if self.lost is not None:
+                self.lost()
+        asyncio.create_task(self.deliver(event))
+
+
+def create_bus(transport: BusTransport = None) -> Bus:
+    match transport or settings.bus:
+        case BusTransport.unix:
+            return UnixSocketBus()
+        case _:
+            return Bus()
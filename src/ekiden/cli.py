@@ -0,0 +1,214 @@
+"""
+Bulk import and export of events as newline-delimited JSON, one event per line.
+
+    ekiden import events.jsonl
+    ekiden export --filter '{"kinds": [0, 3]}' --output profiles.jsonl
+
+Import streams the file in chunks verified across a process pool and stores them in large transactions, with the
+same duplicate, replaceable and deletion handling as events published to the relay. Running relays serving the same
+database are told over the bus once the import is done, and reload their caches (hot events, latest versions,
+tombstones). Until then their answers may miss imported events.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+from typing import BinaryIO, Deque, Iterator, List, Optional, Tuple
+
+from ekiden import codec, logger
+from ekiden.bus import create_bus
+from ekiden.nips import CompactEvent, Filters
+from ekiden.retention import Retention
+from ekiden.storage import Storage, create_storage
+
+# lines handed to a worker at once, large enough that pickling the results costs little next to verifying them
+CHUNK_SIZE = 1_000
+
+
+def verify_lines(lines: List[bytes]) -> Tuple[List[CompactEvent], int]:
+    """Decode and verify a chunk of lines, runs inside the process pool.
+
+    Args:
+        lines (List[bytes]): The lines, each holding one event
+
+    Returns:
+        Tuple[List[CompactEvent], int]: The valid events in the order of the lines, and how many lines were not
+    """
+    events, invalid = [], 0
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            event = CompactEvent.verify(codec.loads(line))
+        except Exception:
+            invalid += 1
+            continue
+        # encoded here rather than by the importing process
+        event.payload()
+        events.append(event)
+    return events, invalid
+
+
+def chunks(stream: BinaryIO, size: int) -> Iterator[List[bytes]]:
+    while chunk := list(islice(stream, size)):
+        yield chunk
+
+
+class Importer:
+    """Stores the events of an NDJSON stream.
+
+    At most two chunks per worker are verified or waiting at a time, and at most `batch_size` verified events are held
+    before they are written, so memory doesn't grow with the input. Results are stored in the order of the input, so
+    a deletion only applies to the events before it and an older version of a replaceable event never wins.
+    """
+
+    def __init__(self, storage: Storage, workers: int = None, batch_size: int = 10_000, retention: Retention = None):
+        self.storage = storage
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.retention = retention or Retention()
+
+        self.lines = 0
+        self.invalid = 0
+        self.expired = 0
+        self.stored = 0
+        self.skipped = 0
+        self._batch: List[CompactEvent] = []
+        self._started = time.perf_counter()
+
+    async def run(self, stream: BinaryIO):
+        loop = asyncio.get_running_loop()
+        pending: Deque[asyncio.Future] = deque()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for chunk in chunks(stream, CHUNK_SIZE):
+                self.lines += len(chunk)
+                pending.append(loop.run_in_executor(pool, verify_lines, chunk))
+                if len(pending) >= self.workers * 2:
+                    await self._collect(await pending.popleft())
+            while pending:
+                await self._collect(await pending.popleft())
+        await self._flush()
+
+    async def _collect(self, result: Tuple[List[CompactEvent], int]):
+        events, invalid = result
+        self.invalid += invalid
+        now = time.time()
+        for event in events:
+            if self.retention.expired(event, now):
+                self.expired += 1
+                continue
+            self._batch.append(event)
+            if len(self._batch) >= self.batch_size:
+                await self._flush()
+
+    async def _flush(self):
+        if not self._batch:
+            return
+        written = await self.storage.store_events(self._batch)
+        self.stored += len(written)
+        self.skipped += len(self._batch) - len(written)
+        self._batch = []
+        logger.info(self.summary())
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self._started
+        return (
+            f"{self.lines} lines read in {elapsed:.1f}s ({self.lines / elapsed:.0f}/s): {self.stored} stored, "
+            f"{self.skipped} already stored, deleted or stale, {self.expired} expired, {self.invalid} invalid"
+        )
+
+
+async def export_events(storage: Storage, filters: Filters, output: BinaryIO, page_size: int = 1_000) -> int:
+    """Write the stored events matching the filters to the stream, newest first
+
+    Args:
+        storage (Storage): Where the events are stored
+        filters (Filters): Which events to export, all of them by default
+        output (BinaryIO): Where the lines are written
+        page_size (int): Events fetched per query
+
+    Returns:
+        int: The number of events written
+    """
+    limit = sys.maxsize if filters.limit is None else filters.limit
+    exported = 0
+    async for _, raw in storage.stream_events(filters, limit=limit, page_size=page_size):
+        output.write(raw.encode("utf-8"))
+        output.write(b"\n")
+        exported += 1
+    return exported
+
+
+async def resync_relays():
+    """Have the running relays reload what they cache from the database"""
+    bus = create_bus()
+
+    async def ignore(event: CompactEvent):
+        pass
+
+    await bus.start(ignore)
+    try:
+        await bus.resync()
+    finally:
+        await bus.close()
+
+
+@contextmanager
+def open_stream(path: str, mode: str) -> Iterator[BinaryIO]:
+    """The file at the path, or stdin / stdout for -, which are left open"""
+    if path == "-":
+        yield sys.stdin.buffer if "r" in mode else sys.stdout.buffer
+        return
+    with open(path, mode) as stream:
+        yield stream
+
+
+async def run(args: argparse.Namespace, storage: Optional[Storage] = None):
+    storage = storage or create_storage()
+    await storage.open()
+    try:
+        if args.command == "import":
+            importer = Importer(storage, workers=args.workers, batch_size=args.batch_size)
+            with open_stream(args.input, "rb") as stream:
+                await importer.run(stream)
+            logger.info(f"Import done, {importer.summary()}")
+            await resync_relays()
+        else:
+            filters = Filters.parse_obj(codec.loads(args.filter))
+            with open_stream(args.output, "wb") as output:
+                exported = await export_events(storage, filters, output, page_size=args.page_size)
+            logger.info(f"Exported {exported} events")
+    finally:
+        await storage.close()
+
+
+def parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="ekiden", description="Import and export the relay's events as NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importing = commands.add_parser("import", help="store the events of an NDJSON file, verifying each")
+    importing.add_argument("input", help="the file to read, - for stdin")
+    importing.add_argument("--workers", type=int, help="verification processes, one per CPU by default")
+    importing.add_argument("--batch-size", type=int, default=10_000, help="events written per transaction")
+
+    exporting = commands.add_parser("export", help="write the stored events matching a filter, newest first")
+    exporting.add_argument("--filter", default="{}", help='a NIP-01 filter as JSON, e.g. {"kinds": [1], "since": 0}')
+    exporting.add_argument("--output", default="-", help="the file to write, stdout by default")
+    exporting.add_argument("--page-size", type=int, default=1_000, help="events fetched per query")
+    return parser
+
+
+def main(argv: List[str] = None):
+    args = parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
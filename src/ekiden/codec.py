@@ -0,0 +1,126 @@
+import json
+from typing import Any, Callable, NamedTuple, Tuple, Type, Union
+
+from ekiden import logger
+from ekiden.config import JsonCodec, settings
+
+
+def stdlib_dumps(obj: Any) -> str:
+    """The reference encoding: compact separators, non-ASCII characters written as is"""
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+class Backend(NamedTuple):
+    name: JsonCodec
+    loads: Callable[[Union[str, bytes]], Any]
+    dumps: Callable[[Any], str]
+    # what `loads` raises on malformed input
+    errors: Tuple[Type[Exception], ...]
+
+
+def _orjson() -> Backend:
+    import orjson
+
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    return Backend(JsonCodec.orjson, orjson.loads, dumps, (orjson.JSONDecodeError,))
+
+
+def _msgspec() -> Backend:
+    import msgspec
+
+    encoder, decoder = msgspec.json.Encoder(), msgspec.json.Decoder()
+
+    def dumps(obj: Any) -> str:
+        return encoder.encode(obj).decode("utf-8")
+
+    return Backend(JsonCodec.msgspec, decoder.decode, dumps, (msgspec.DecodeError,))
+
+
+def _stdlib() -> Backend:
+    return Backend(JsonCodec.stdlib, json.loads, stdlib_dumps, (ValueError,))
+
+
+BACKENDS = {JsonCodec.orjson: _orjson, JsonCodec.msgspec: _msgspec, JsonCodec.stdlib: _stdlib}
+
+# what event ids are computed over, the strings cover every escape the reference encoding makes
+PROBES = (
+    [0, "a" * 64, 1_700_000_000, 1, [["e", "b" * 64, "wss://relay.example"], ["p", "c" * 64]], "hello, world"],
+    ["".join(map(chr, range(0x00, 0x80)))],
+    ["\x7f\x80\x9f\xa0\xad", "\u2028\u2029", "\ufeff\ufffe\uffff", "é日本語🎉\U0001f469\u200d\U0001f467\U0010ffff"],
+    [0, -1, 2**31, 2**53 + 1, 2**63 - 1, -(2**63), 2**64 - 1, True, False, None, [], [[]], ""],
+)
+
+
+def conforms(backend: Backend) -> bool:
+    """Check that the backend encodes the probes byte for byte like the reference encoding"""
+    try:
+        return all(backend.dumps(probe) == stdlib_dumps(probe) for probe in PROBES)
+    except Exception:
+        return False
+
+
+def load(codec: JsonCodec) -> Backend:
+    """The backend to use for the configured codec.
+
+    A library that isn't installed, or that doesn't encode like the standard library, is passed over so event ids
+    never depend on which one was picked.
+
+    Args:
+        codec (JsonCodec): The configured codec
+
+    Returns:
+        Backend: The first usable backend, the standard library's when none is
+    """
+    candidates = [JsonCodec.orjson, JsonCodec.msgspec] if codec == JsonCodec.auto else [codec]
+    for name in candidates:
+        if name == JsonCodec.stdlib:
+            break
+        try:
+            backend = BACKENDS[name]()
+        except ImportError:
+            if codec != JsonCodec.auto:
+                logger.warning(f"{name.value} is not installed, using the standard library json module")
+            continue
+        if conforms(backend):
+            return backend
+        logger.warning(f"{name.value} does not encode like the standard library json module, not using it")
+    return _stdlib()
+
+
+backend = load(settings.json_codec)
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """Decode a JSON document
+
+    Args:
+        data (Union[str, bytes]): The document, bytes must be UTF-8
+
+    Raises:
+        ValueError: If the document is malformed
+
+    Returns:
+        Any: The decoded value
+    """
+    try:
+        return backend.loads(data)
+    except backend.errors as e:
+        raise ValueError(str(e)) from e
+
+
+def dumps(obj: Any) -> str:
+    """Encode as compact JSON, byte for byte what the standard library produces
+
+    Args:
+        obj (Any): The value to encode
+
+    Returns:
+        str: The document
+    """
+    try:
+        return backend.dumps(obj)
+    except (TypeError, ValueError, OverflowError):
+        # past what the fast libraries support, e.g. integers over 64 bits or lone surrogates
+        return stdlib_dumps(obj)
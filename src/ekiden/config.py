@@ -0,0 +1,111 @@
+from enum import Enum
+from typing import Dict, Optional
+
+from pydantic import BaseSettings
+
+
+class QueuePolicy(str, Enum):
+    # what to do when a connection's send queue is full
+    drop_oldest = "drop_oldest"  # throw away the oldest queued frame to make room
+    disconnect = "disconnect"  # send a NOTICE and close the connection
+    block = "block"  # wait for the writer to make room, slowing down the broadcast
+
+
+class VerifyExecutor(str, Enum):
+    # where signature verification runs
+    thread = "thread"
+    process = "process"
+
+
+class Durability(str, Enum):
+    # maps to sqlite's `PRAGMA synchronous`
+    off = "OFF"
+    normal = "NORMAL"
+    full = "FULL"
+
+
+class StorageBackend(str, Enum):
+    sqlite = "sqlite"  # tuned native sqlite
+    tortoise = "tortoise"  # everything over the ORM's connection
+
+
+class JsonCodec(str, Enum):
+    # library used to encode and decode JSON, the fast ones are only used if they encode events like the stdlib does
+    auto = "auto"  # orjson, then msgspec, then the stdlib, whichever is installed first
+    orjson = "orjson"
+    msgspec = "msgspec"
+    stdlib = "stdlib"
+
+
+class BusTransport(str, Enum):
+    # how verified events reach the other worker processes
+    none = "none"  # single process, nothing to fan out
+    unix = "unix"  # unix domain datagram sockets, one per worker
+
+
+class Settings(BaseSettings):
+    """Relay settings, every field can be overridden with an `EKIDEN_` prefixed environment variable"""
+
+    json_codec: JsonCodec = JsonCodec.auto
+
+    send_queue_size: int = 256  # max number of frames buffered per connection
+    send_queue_policy: QueuePolicy = QueuePolicy.drop_oldest
+
+    verify_executor: VerifyExecutor = VerifyExecutor.thread
+    verify_workers: int = 4
+    verify_batch_window: float = 0.002  # seconds to wait for more events before verifying a batch
+    verify_batch_size: int = 64  # verify right away once this many events are waiting
+    pubkey_cache_size: int = 4096  # parsed public keys kept around, by pubkey hex
+
+    ingest_flush_interval: float = 0.005  # seconds verified events are collected before they are written
+    ingest_batch_size: int = 256  # write right away once this many events are waiting
+    durability: Durability = Durability.normal
+
+    storage: StorageBackend = StorageBackend.sqlite
+    db_path: str = "ekiden.sqlite3"
+    sqlite_readers: int = 4  # read-only connections serving replays next to the single writer
+    sqlite_mmap_size: int = 256 * 1024 * 1024  # bytes, `PRAGMA mmap_size`
+    sqlite_cache_size: int = -64 * 1024  # `PRAGMA cache_size`, negative values are KiB
+    sqlite_statement_cache: int = 256  # prepared statements kept per connection
+
+    recent_id_cache_size: int = 100_000  # ids of recently seen events, duplicates of these are answered right away
+    replaceable_cache_size: int = 20_000  # latest versions of replaceable events (profiles, contact lists) kept around
+
+    replay_max_events: int = 2000  # hard cap on the events replayed for a REQ, across all its filters
+    replay_page_size: int = 100  # events fetched from the database at a time while replaying
+    replay_max_concurrent: int = 64  # replays reading a page at once across all connections, others wait their turn
+    hot_events: int = 10_000  # most recent events kept in memory to answer REQs from, 0 turns the buffer off
+    hot_events_age: int = 3600  # seconds of events kept in memory, 0 keeps as many as fit
+    count_budget: float = 0.5  # seconds a COUNT the maintained counts can't answer may spend counting rows
+    # max age in seconds by kind, as JSON (e.g. {"1": 2592000, "7": 604800}). replaceable kinds are kept for good
+    retention: Dict[int, int] = {}
+    retention_default: int = 0  # max age in seconds of the other kinds, 0 keeps them for good
+    partition_seconds: int = 86_400  # span of created_at each partition of expiring events covers
+    compaction_interval: float = 60  # seconds between background runs removing expired events and freeing pages
+    compaction_batch: int = 1_000  # expired events deleted per transaction
+    vacuum_pages: int = 1_000  # free database pages given back to the file system per run
+
+    max_message_size: int = 128 * 1024  # characters of a text frame or bytes of a binary one
+    max_subscriptions: int = 20  # open subscriptions per connection
+    # token buckets, a rate of 0 turns the limit off. a REQ costs one token per filter
+    connection_rate: float = 20  # messages per second from one connection
+    connection_burst: float = 100
+    address_rate: float = 50  # messages per second from one client address, across its connections
+    address_burst: float = 200
+    pubkey_rate: float = 5  # events per second from one author
+    pubkey_burst: float = 30
+    rate_limit_keys: int = 100_000  # addresses and pubkeys tracked at most, idle ones are forgotten first
+    trusted_proxies: int = 0  # proxies in front of the relay, client addresses are then read from X-Forwarded-For
+
+    profiler: bool = False  # start with /debug/profile enabled, SIGUSR2 toggles it in a running worker
+    profiler_token: str = ""  # bearer token /debug/profile requires, without one only local clients may use it
+    profiler_interval: float = 0.005  # seconds between stack samples while profiling
+
+    bus: BusTransport = BusTransport.unix
+    bus_path: Optional[str] = None  # directory of the worker sockets, private to the user and database by default
+
+    class Config:
+        env_prefix = "EKIDEN_"
+
+
+settings = Settings()
@@ -0,0 +1,159 @@
+import asyncio
+import weakref
+from collections import deque
+from typing import Deque, MutableSet, Optional, Tuple
+
+from starlette.websockets import WebSocket
+
+from ekiden import logger
+from ekiden.config import QueuePolicy, settings
+from ekiden.nips import Notice, dump_json
+
+
+class ConnectionClosedError(RuntimeError):
+    """Raised when sending to a connection that has already been closed"""
+
+
+class OutboundMetrics:
+    def __init__(self) -> None:
+        self.connections: MutableSet["Connection"] = weakref.WeakSet()
+        self.dropped_frames = 0
+        self.slow_disconnects = 0
+
+    def snapshot(self) -> dict:
+        depths = [connection.queue_depth for connection in self.connections]
+        return {
+            "connections": len(depths),
+            "send_queue_depth": sum(depths),
+            "send_queue_depth_max": max(depths, default=0),
+            "dropped_frames": self.dropped_frames,
+            "slow_disconnects": self.slow_disconnects,
+        }
+
+
+metrics = OutboundMetrics()
+
+
+class Connection:
+    """A websocket with a bounded send queue drained by its own writer task.
+
+    Broadcasting only enqueues frames, so a congested socket holds up nobody but its own client. Frames are tagged
+    with how they were queued: the full queue policy only ever drops broadcast frames, never responses or replayed
+    events.
+    """
+
+    def __init__(self, websocket: WebSocket, queue_size: int = None, policy: QueuePolicy = None):
+        self.websocket = websocket
+        self.policy = policy or settings.send_queue_policy
+        self.queue_size = queue_size or settings.send_queue_size
+        self.closed = False
+        # frames waiting for the writer, oldest first, and whether each one came from `send`
+        self._frames: Deque[Tuple[str, bool]] = deque()
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        metrics.connections.add(self)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._frames)
+
+    def start(self):
+        """Start the writer task, the websocket must already be accepted"""
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write())
+
+    async def close(self):
+        """Stop the writer, any frames still queued are discarded"""
+        self._set_closed()
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except (asyncio.CancelledError, Exception):
+                pass
+        metrics.connections.discard(self)
+
+    async def put(self, data: str):
+        """Queue a frame that must be delivered (OK responses, stored events), waiting for room if needed
+
+        Args:
+            data (str): The frame to send
+        """
+        await self._wait_for_room()
+        self._append(data, broadcast=False)
+
+    async def send(self, data: str):
+        """Queue a broadcast frame, applying the configured policy when the queue is full
+
+        Args:
+            data (str): The frame to send
+        """
+        if self.closed:
+            raise ConnectionClosedError("connection is closed")
+
+        if len(self._frames) < self.queue_size:
+            self._append(data, broadcast=True)
+            return
+
+        match self.policy:
+            case QueuePolicy.drop_oldest:
+                metrics.dropped_frames += 1
+                # a queue holding nothing but frames that must be delivered has no room for this one
+                for index, (_, broadcast) in enumerate(self._frames):
+                    if broadcast:
+                        del self._frames[index]
+                        self._append(data, broadcast=True)
+                        break
+            case QueuePolicy.disconnect:
+                metrics.dropped_frames += 1
+                metrics.slow_disconnects += 1
+                self._disconnect("send queue is full, closing the connection")
+                raise ConnectionClosedError("connection is too slow")
+            case QueuePolicy.block:
+                await self._wait_for_room()
+                self._append(data, broadcast=True)
+
+    async def _wait_for_room(self):
+        while not self.closed and len(self._frames) >= self.queue_size:
+            self._writable.clear()
+            await self._writable.wait()
+        if self.closed:
+            raise ConnectionClosedError("connection is closed")
+
+    def _append(self, data: str, broadcast: bool):
+        self._frames.append((data, broadcast))
+        self._readable.set()
+
+    async def _write(self):
+        try:
+            while True:
+                while not self._frames:
+                    self._readable.clear()
+                    await self._readable.wait()
+                data, _ = self._frames.popleft()
+                self._writable.set()
+                await self.websocket.send_text(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._set_closed()
+
+    def _set_closed(self):
+        self.closed = True
+        # frames waiting for room are refused rather than left waiting for good
+        self._writable.set()
+
+    def _disconnect(self, message: str):
+        self._set_closed()
+        if self._writer is not None:
+            self._writer.cancel()
+        asyncio.create_task(self._notice_and_close(message))
+
+    async def _notice_and_close(self, message: str):
+        logger.info(message)
+        try:
+            await self.websocket.send_text(dump_json(Notice(message=message).json_array()))
+            await self.websocket.close()
+        except Exception:
+            pass
@@ -9,6 +9,11 @@ class UnknownTagError(Exception):
 
 
 def create_tag(tag_dict) -> nips.Tag:
+    if isinstance(tag_dict, list):
+        # stored as the tag array sent by the client
+        return nips.create_tag(tag_dict)
+
+    # stored as the tag model's fields
     try:
         return nips.ETag.parse_obj(tag_dict)
     except:
@@ -35,19 +40,29 @@ def create_tag(tag_dict) -> nips.Tag:
 #         return f"{self.pubkey}, {self.name}, {self.about}, {self.picture}"
 
 
+# the tables are created by `storage.SCHEMA`, these models give ORM access to them
+
+
 class Event(Model):
     table_id = fields.IntField(pk=True)
 
-    id: str = fields.TextField()
+    id: str = fields.CharField(max_length=64, unique=True)
     kind = fields.IntField()
     content: str = fields.TextField()
     created_at = fields.IntField()
     tags = fields.JSONField()
-    pubkey: str = fields.TextField()
+    pubkey: str = fields.CharField(max_length=64)
     sig: str = fields.TextField()
+    raw: str = fields.TextField()  # the verified event as JSON, sent as is when replaying
 
     class Meta:
         table = "event"
+        indexes = (
+            ("pubkey", "kind", "created_at", "id"),
+            ("pubkey", "created_at", "id"),
+            ("kind", "created_at", "id"),
+            ("created_at", "id"),
+        )
 
     def __str__(self) -> str:
         return f"{self.id} {self.kind} {self.content} {self.tags} {self.pubkey} {self.sig}"
@@ -60,9 +75,23 @@ class Event(Model):
         """
         return nips.Event(
             pubkey=self.pubkey,
-            create_at=self.created_at,
+            created_at=self.created_at,
             kind=self.kind,
             sig=self.sig,
             tags=[create_tag(tag_dict) for tag_dict in self.tags],
             content=self.content,
         )
+
+
+class EventTag(Model):
+    """The e and p tag values of an event, normalized so tag filters can use an index"""
+
+    table_id = fields.IntField(pk=True)
+
+    event = fields.ForeignKeyField("models.Event", related_name="tag_values", on_delete=fields.CASCADE)
+    name: str = fields.CharField(max_length=1)
+    value: str = fields.CharField(max_length=64)
+
+    class Meta:
+        table = "event_tag"
+        indexes = (("name", "value"),)
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, Set, Tuple
+
+from ekiden.config import settings
+
+
+class RecentIds:
+    """Bounded LRU of recently seen event ids, used to answer duplicates before doing any work on them"""
+
+    def __init__(self, size: int = None):
+        self.size = size or settings.recent_id_cache_size
+        self._ids: OrderedDict[str, None] = OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def seen(self, event_id: str) -> bool:
+        """Check whether the id was seen recently, counting towards the hit rate
+
+        Args:
+            event_id (str): The event id
+
+        Returns:
+            bool: True if it was seen
+        """
+        self.lookups += 1
+        if event_id in self._ids:
+            self._ids.move_to_end(event_id)
+            self.hits += 1
+            return True
+        return False
+
+    def add(self, event_id: str) -> bool:
+        """Remember the id
+
+        Args:
+            event_id (str): The event id
+
+        Returns:
+            bool: False if the id was already known
+        """
+        if event_id in self._ids:
+            self._ids.move_to_end(event_id)
+            return False
+
+        self._ids[event_id] = None
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+        return True
+
+    def discard(self, event_id: str):
+        self._ids.pop(event_id, None)
+
+    def snapshot(self) -> dict:
+        return {
+            "recent_ids": len(self._ids),
+            "recent_id_lookups": self.lookups,
+            "recent_id_hits": self.hits,
+            "recent_id_hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+        }
+
+
+class Tombstones:
+    """Events deleted by their author, by id and the pubkey of the deletion.
+
+    A deletion only covers the referenced events written by the same pubkey, whether they arrived before or after it,
+    so re-posts can be rejected without touching the database. Mirrors the persistent `tombstone` table.
+    """
+
+    def __init__(self, tombstones: Iterable[Tuple[str, str]] = ()):
+        self._pubkeys: Dict[str, Set[str]] = {}
+        self.update(tombstones)
+
+    def __len__(self) -> int:
+        return len(self._pubkeys)
+
+    def __contains__(self, event_id: str) -> bool:
+        return event_id in self._pubkeys
+
+    def deleted(self, event_id: str, pubkey: str) -> bool:
+        """Check whether the event was deleted
+
+        Args:
+            event_id (str): The event id
+            pubkey (str): The author of the event
+
+        Returns:
+            bool: True if the author deleted it
+        """
+        pubkeys = self._pubkeys.get(event_id)
+        return pubkeys is not None and pubkey in pubkeys
+
+    def add(self, pubkey: str, event_ids: Iterable[str]):
+        """Record a deletion
+
+        Args:
+            pubkey (str): The author of the deletion
+            event_ids (Iterable[str]): The ids it references
+        """
+        for event_id in event_ids:
+            self._pubkeys.setdefault(event_id, set()).add(pubkey)
+
+    def update(self, tombstones: Iterable[Tuple[str, str]]):
+        """Record stored deletions
+
+        Args:
+            tombstones (Iterable[Tuple[str, str]]): The deleted event ids and the pubkeys that deleted them
+        """
+        for event_id, pubkey in tombstones:
+            self._pubkeys.setdefault(event_id, set()).add(pubkey)
+
+    def snapshot(self) -> dict:
+        return {"tombstones": len(self._pubkeys)}
@@ -1,17 +1,38 @@
-import json
+import asyncio
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, List, Tuple
 
+from pydantic import ValidationError
 from starlette.websockets import WebSocket, WebSocketDisconnect
-from tortoise.transactions import atomic
 
-from ekiden import database, logger
-from ekiden.nips import Filters
+from ekiden import codec, logger, metrics
+from ekiden.admission import Admission
+from ekiden.config import settings
+from ekiden.connections import Connection, ConnectionClosedError
+from ekiden.connections import metrics as outbound_metrics
+from ekiden.nips import (
+    MAX_SUBSCRIPTION_ID_LENGTH,
+    Filters,
+    Notice,
+    dump_json,
+    is_prefix,
+    is_replaceable,
+    is_subscription_id,
+    payload_message,
+)
 from ekiden.relay import AsyncRelay
+from ekiden.storage import create_storage
 from ekiden.subscriptions import Subscription, SubscriptionPool
 
 
 class Hoshi:
     sub_pool = SubscriptionPool()
-    relay = AsyncRelay(sub_pool=sub_pool)
+    storage = create_storage()
+    admission = Admission()
+    relay = AsyncRelay(sub_pool=sub_pool, storage=storage, admission=admission)
+    replay_slots = asyncio.Semaphore(settings.replay_max_concurrent)
+    replays = 0  # reading a page while holding a slot
 
     async def __call__(self, scope, receive, send):
         """
@@ -22,51 +43,309 @@ class Hoshi:
 
     async def endpoint(self, websocket: WebSocket):
         await websocket.accept()
+        connection = Connection(websocket)
+        connection.start()
+        # admission runs before anything costly: verification, storage or replay
+        bucket = self.admission.connection_bucket()
+        address = self.admission.address(websocket)
         try:
             while True:
-                match await websocket.receive_json():
+                frame = await websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(frame.get("code", 1000))
+                # clients may send text or binary frames, both are decoded straight from what was received
+                raw = frame["text"] if frame.get("text") is not None else frame["bytes"]
+                if len(raw) > settings.max_message_size:
+                    metrics.rejections.inc("too_large")
+                    await connection.put(self.notice(f"invalid: messages are limited to {settings.max_message_size}"))
+                    continue
+
+                started = time.perf_counter()
+                try:
+                    data = codec.loads(raw)
+                except ValueError:
+                    metrics.rejections.inc("invalid_json")
+                    self.admission.admit(bucket, address)
+                    await connection.put(self.notice("invalid: message is not JSON"))
+                    continue
+                finally:
+                    metrics.decode_seconds.observe(time.perf_counter() - started)
+
+                match data:
                     case ["EVENT", message]:
-                        await self.handle_event(websocket=websocket, message=message)
-                    case ["REQ", subscription_id, filters_dict]:
-                        await self.handle_request(
-                            websocket=websocket, subscription_id=subscription_id, filters_dict=filters_dict
-                        )
+                        metrics.messages.inc("EVENT")
+                        limited = self.admission.admit(bucket, address)
+                        pubkey = message.get("pubkey") if isinstance(message, dict) else None
+                        if limited is None and not isinstance(pubkey, str):
+                            metrics.rejections.inc("invalid_event")
+                            event_id = AsyncRelay.claimed_id(message)
+                            await connection.put(
+                                dump_json(["OK", event_id, "false", "invalid: pubkey must be a string"])
+                            )
+                            continue
+                        # the author is only charged once verified, but a pubkey out of tokens is refused right away
+                        if limited is None and not self.admission.pubkeys.ready(pubkey):
+                            limited = "pubkey"
+                        if limited is not None:
+                            metrics.rejections.inc(f"rate_limited_{limited}")
+                            await connection.put(
+                                dump_json(["OK", AsyncRelay.claimed_id(message), "false", self.limit_message(limited)])
+                            )
+                        else:
+                            await self.handle_event(connection=connection, message=message)
+                    case ["REQ", subscription_id, *filters_dicts]:
+                        metrics.messages.inc("REQ")
+                        cost = max(1, len(filters_dicts))
+                        if limited := self.admission.admit(bucket, address, cost=cost):
+                            metrics.rejections.inc(f"rate_limited_{limited}")
+                            await connection.put(self.notice(self.limit_message(limited)))
+                        elif not is_subscription_id(subscription_id):
+                            await self.invalid_subscription_id(connection)
+                        elif (
+                            self.sub_pool.get_subscription(connection, subscription_id) is None
+                            and self.sub_pool.count(connection) >= settings.max_subscriptions
+                        ):
+                            metrics.rejections.inc("too_many_subscriptions")
+                            limit = settings.max_subscriptions
+                            await connection.put(self.notice(f"blocked: at most {limit} subscriptions per connection"))
+                        else:
+                            await self.handle_request(
+                                connection=connection, subscription_id=subscription_id, filters_dicts=filters_dicts
+                            )
+                    case ["COUNT", subscription_id, *filters_dicts]:
+                        metrics.messages.inc("COUNT")
+                        if limited := self.admission.admit(bucket, address, cost=max(1, len(filters_dicts))):
+                            metrics.rejections.inc(f"rate_limited_{limited}")
+                            await connection.put(self.notice(self.limit_message(limited)))
+                        elif not is_subscription_id(subscription_id):
+                            await self.invalid_subscription_id(connection)
+                        else:
+                            await self.handle_count(
+                                connection=connection, subscription_id=subscription_id, filters_dicts=filters_dicts
+                            )
                     case ["CLOSE", subscription_id]:
-                        await self.handle_close(websocket)
+                        metrics.messages.inc("CLOSE")
+                        if not is_subscription_id(subscription_id):
+                            await self.invalid_subscription_id(connection)
+                        else:
+                            await self.handle_close(connection, subscription_id=subscription_id)
+                    case _:
+                        metrics.messages.inc("unknown")
+                        self.admission.admit(bucket, address)
+
+        except (WebSocketDisconnect, ConnectionClosedError):
+            # the client went away, or was disconnected for not keeping up
+            pass
+        finally:
+            await self.handle_disconnect(connection)
+
+    @staticmethod
+    def notice(message: str) -> str:
+        return dump_json(Notice(message=message).json_array())
+
+    @staticmethod
+    def limit_message(limited: str) -> str:
+        return f"rate-limited: too many messages from this {limited}, slow down"
 
-        except WebSocketDisconnect:
-            await self.handle_disconnect(websocket)
+    @staticmethod
+    def invalid_filters(error: ValidationError) -> str:
+        # the first problem is enough for the client to fix its request
+        problem = error.errors()[0]
+        location = ".".join(str(part) for part in problem["loc"] if part != "__root__")
+        return f"invalid: {location}: {problem['msg']}" if location else f"invalid: {problem['msg']}"
 
-    async def handle_event(self, websocket: WebSocket, message: dict):
+    async def invalid_subscription_id(self, connection: Connection):
+        # there is no id to answer with a CLOSED
+        metrics.rejections.inc("invalid_subscription_id")
+        limit = MAX_SUBSCRIPTION_ID_LENGTH
+        await connection.put(self.notice(f"invalid: subscription ids are strings of 1 to {limit} characters"))
+
+    async def handle_event(self, connection: Connection, message: dict):
         """
         used to publish events
         """
-        logger.info(json.dumps(message))
+        logger.info(dump_json(message))
         response = await self.relay.event(message)
-        await websocket.send_text(response)
+        await connection.put(response)
 
-    async def handle_request(self, websocket: WebSocket, subscription_id: str, filters_dict: dict):
+    async def handle_request(self, connection: Connection, subscription_id: str, filters_dicts: List[dict]):
         """
         used to request events and subscribe to new updates
         """
-        sub = Subscription(
-            filters=Filters.parse_obj(filters_dict),
-            websocket=websocket,
-            subscription_id=subscription_id,
-        )
-        await self.sub_pool.add_subscription(subscription=sub)
-        # set sane cap
-        limit = sub.filters.limit if sub.filters.limit else 2000
-        for event in await database.Event.all().limit(limit):
-            await sub.send(event.nipple())
+        # nothing is registered or replaced for a REQ the relay can't make sense of
+        try:
+            filters = [Filters.parse_obj(filters_dict) for filters_dict in filters_dicts]
+        except ValidationError as error:
+            metrics.rejections.inc("invalid_filters")
+            await connection.put(dump_json(["CLOSED", subscription_id, self.invalid_filters(error)]))
+            return
+
+        sub = Subscription(filters=filters, connection=connection, subscription_id=subscription_id)
+        self.sub_pool.add_subscription(subscription=sub)
+        # replay in the background so the connection can keep publishing, closing or opening subscriptions
+        sub.replay = asyncio.create_task(self.replay(sub))
+
+    async def handle_count(self, connection: Connection, subscription_id: str, filters_dicts: List[dict]):
+        """
+        used to count the stored events matching any of the filters (NIP-45). the usual shapes are read from the counts
+        the storage maintains, others are counted with the indexes until `count_budget` runs out
+        """
+        if not filters_dicts:
+            metrics.rejections.inc("invalid_count")
+            await connection.put(dump_json(["CLOSED", subscription_id, "invalid: COUNT needs at least one filter"]))
+            return
+
+        try:
+            filters = [Filters.parse_obj(filters_dict) for filters_dict in filters_dicts]
+        except ValidationError as error:
+            metrics.rejections.inc("invalid_filters")
+            await connection.put(dump_json(["CLOSED", subscription_id, self.invalid_filters(error)]))
+            return
+
+        started = time.perf_counter()
+        try:
+            count = await self.storage.aggregate_count(filters[0]) if len(filters) == 1 else None
+            if count is not None:
+                metrics.counts.inc("aggregate")
+            else:
+                async with self.replay_slots:
+                    count = await self.storage.indexed_count(filters, settings.count_budget)
+                metrics.counts.inc("indexed")
+        except TimeoutError:
+            metrics.rejections.inc("count_timeout")
+            await connection.put(
+                dump_json(["CLOSED", subscription_id, "error: counting took too long, narrow the filters down"])
+            )
+            return
+        finally:
+            metrics.count_seconds.observe(time.perf_counter() - started)
+
+        await connection.put(dump_json(["COUNT", subscription_id, {"count": count}]))
+
+    async def replay(self, sub: Subscription):
+        """
+        stream the stored events matching the subscription, then mark the end with EOSE
+        """
+        started = time.perf_counter()
+        try:
+            await self.send_stored(sub)
+            await sub.connection.put(dump_json(["EOSE", sub.subscription_id]))
+            metrics.replay_seconds.observe(time.perf_counter() - started)
+        except RuntimeError:
+            # the connection went away
+            pass
+
+    async def send_stored(self, sub: Subscription):
+        """
+        send the stored events matching any of the subscription's filters. `replay_max_events` is shared by all the
+        filters of the REQ, however many there are
+        """
+        tombstones = self.relay.tombstones
+        # an event matching several filters is only sent once
+        sent = set() if len(sub.filters) > 1 else None
+        budget = settings.replay_max_events
+        for filters in sub.filters:
+            if budget <= 0:
+                return
+            limit = budget if filters.limit is None else min(filters.limit, budget)
+
+            async with aclosing(self.stored_events(filters, limit=limit)) as events:
+                async for page in self.pages(events):
+                    # whatever was read counts, sent or not
+                    budget -= len(page)
+                    for event_id, raw in page:
+                        # deleted while the page was in flight, or by a worker that hasn't written it yet
+                        if event_id in tombstones and tombstones.deleted(event_id, codec.loads(raw)["pubkey"]):
+                            continue
+                        if sent is not None:
+                            if event_id in sent:
+                                continue
+                            sent.add(event_id)
+                        # the query applies the filters, the stored JSON goes out as is
+                        await sub.connection.put(payload_message(sub.subscription_id, raw))
+
+    async def pages(self, events: AsyncIterator[Tuple[str, str]]) -> AsyncIterator[List[Tuple[str, str]]]:
+        """
+        read the events a page at a time, holding a replay slot only while a page is read. a slow client waits for its
+        frames to be queued without keeping other replays from the database
+        """
+        page_size = settings.replay_page_size
+        while True:
+            page = []
+            async with self.replay_slots:
+                Hoshi.replays += 1
+                try:
+                    while len(page) < page_size and (event := await anext(events, None)) is not None:
+                        page.append(event)
+                finally:
+                    Hoshi.replays -= 1
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        """
+        current values of the relay's gauges and counters
+        """
+        return {
+            **outbound_metrics.snapshot(),
+            "subscriptions": len(cls.sub_pool),
+            "distinct_filters": cls.sub_pool.distinct_filters(),
+            "replays": cls.replays,
+            **cls.relay.recent_ids.snapshot(),
+            **cls.relay.latest.snapshot(),
+            **cls.relay.tombstones.snapshot(),
+            **cls.relay.hot.snapshot(),
+            "rate_limited_addresses": len(cls.admission.addresses),
+            "rate_limited_pubkeys": len(cls.admission.pubkeys),
+        }
+
+    async def stored_events(self, filters: Filters, limit: int) -> AsyncIterator[Tuple[str, str]]:
+        """
+        the stored events matching the filters, newest first. lookups of replaceable events by author (profiles,
+        contact lists) are answered by the relay's index of latest versions, recent activity by its hot events
+        """
+        if (
+            filters.authors
+            and filters.kinds
+            and not any(is_prefix(author) for author in filters.authors)
+            and all(is_replaceable(kind) for kind in filters.kinds)
+            and not (filters.ids or filters.event_ids or filters.pubkeys)
+        ):
+            versions = [
+                version
+                for version in await self.relay.latest_versions(filters.authors, filters.kinds)
+                if (filters.since is None or version.created_at > filters.since)
+                and (filters.until is None or version.created_at < filters.until)
+            ]
+            versions.sort(key=lambda version: (version.created_at, version.id), reverse=True)
+            for version in versions[:limit]:
+                yield version.id, version.payload
+            return
+
+        # recent activity is served from memory, the database only has to fill in what is older than the buffer
+        events, complete = self.relay.hot.match(filters, limit)
+        for event in events:
+            yield event.id, event.payload()
+        if complete:
+            return
+        if events:
+            floor = self.relay.hot.floor
+            until = floor + 1 if filters.until is None else min(filters.until, floor + 1)
+            filters, limit = filters.copy(update={"until": until}), limit - len(events)
+
+        page_size = settings.replay_page_size
+        async for event_id, raw in self.storage.stream_events(filters, limit=limit, page_size=page_size):
+            yield event_id, raw
 
-    async def handle_close(self, websocket: WebSocket):
+    async def handle_close(self, connection: Connection, subscription_id: str):
         """
         used to stop previous subscriptions
         """
-        await self.handle_disconnect(websocket)
+        self.sub_pool.remove_subscription(connection=connection, subscription_id=subscription_id)
 
-    async def handle_disconnect(self, websocket: WebSocket):
-        subscription = await self.sub_pool.get_subscription(websocket=websocket)
-        if subscription:
-            await self.sub_pool.remove_subscription(subscription)
+    async def handle_disconnect(self, connection: Connection):
+        self.sub_pool.remove_connection(connection)
+        await connection.close()
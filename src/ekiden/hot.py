@@ -0,0 +1,227 @@
+import sys
+import time
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from ekiden import codec
+from ekiden.config import settings
+from ekiden.nips import CompactEvent, Filters, Kind, is_prefix, is_replaceable
+from ekiden.replaceable import Version
+from ekiden.retention import Retention
+from ekiden.storage import Storage
+from ekiden.subscriptions import CompiledFilters
+
+# what an entry costs besides its payload and content: the event's other strings, slots, tag tuples and sets, the order
+# and index entries. measured with tracemalloc for a note with two tags
+ENTRY_OVERHEAD = 2_000
+
+
+class HotEvents:
+    """The most recent stored events, by `created_at`, so REQs for fresh activity are answered without a query.
+
+    Every stored event created after `floor` is kept, older ones are left to the database: when the buffer is over
+    `size` events, or an event is older than `age` seconds, the oldest is dropped and the floor moves up to it. Events
+    arriving with a `created_at` at or below the floor aren't kept at all. The buffer is warmed from the database when
+    the relay starts, deleted and replaced events leave it as the database drops them.
+
+    It sees what this worker stores and what the bus delivers from the others, with several workers and no bus it
+    has to be turned off. When the bus loses events, or events are imported behind the relay's back, the buffer is
+    reset and warmed again.
+    """
+
+    def __init__(self, size: int = None, age: int = None, retention: Retention = None):
+        self.size = settings.hot_events if size is None else size
+        self.age = settings.hot_events_age if age is None else age
+        # expired events are skipped until compaction has them removed
+        self.retention = retention or Retention()
+        # None while every stored event is held
+        self.floor: Optional[int] = None
+        # nothing is held or answered until the buffer was warmed
+        self.warmed = False
+        # events stored while warming, added once the stored ones are loaded
+        self._pending: Optional[List[CompactEvent]] = None
+        self._events: Dict[str, CompactEvent] = {}
+        # (created_at, id), oldest first
+        self._order: List[Tuple[int, str]] = []
+        self._authors: Dict[str, Set[str]] = {}
+        self._kinds: Dict[int, Set[str]] = {}
+        self.bytes = 0
+        self.lookups = 0
+        self.hits = 0
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def __contains__(self, event_id: str) -> bool:
+        return event_id in self._events
+
+    async def warm(self, storage: Storage):
+        """Load the newest stored events
+
+        Args:
+            storage (Storage): Where the events are stored
+        """
+        if not self.size:
+            return
+        self.reset()
+        self._pending = []
+        since = int(time.time()) - self.age if self.age else None
+        loaded = 0
+        async for _, raw in storage.stream_events(Filters(since=since), limit=self.size, page_size=1_000):
+            self._insert(CompactEvent.load(codec.loads(raw), payload=raw))
+            loaded += 1
+        # everything above `since` was loaded unless the limit cut the stream short
+        self.floor = self._order[0][0] if loaded >= self.size else since
+        self.warmed = True
+        pending, self._pending = self._pending, None
+        for event in pending:
+            self.add(event)
+
+    def reset(self):
+        """Forget every event and stop answering until the buffer is warmed again"""
+        self.floor = None
+        self.warmed = False
+        self._pending = None
+        self._events.clear()
+        self._order.clear()
+        self._authors.clear()
+        self._kinds.clear()
+        self.bytes = 0
+
+    def add(self, event: CompactEvent):
+        """Keep an event that was stored, applying what it replaces or deletes
+
+        Args:
+            event (CompactEvent): The event
+        """
+        if not self.warmed:
+            if self._pending is not None:
+                self._pending.append(event)
+            return
+        self._expire()
+
+        if is_replaceable(event.kind):
+            version = Version.of(event)
+            for event_id in list(self._authors.get(event.pubkey, ())):
+                current = self._events[event_id]
+                if current.kind != event.kind:
+                    continue
+                if not version.newer_than(Version.of(current)):
+                    return
+                self._remove(event_id)
+        elif event.kind == Kind.delete:
+            self.discard(event.pubkey, event.e_tags)
+
+        if (self.floor is None or event.created_at > self.floor) and event.id not in self._events:
+            self._insert(event)
+            while len(self._events) > self.size:
+                self._drop_oldest()
+
+    def discard(self, pubkey: str, event_ids: Iterable[str]):
+        """Forget events the author deleted
+
+        Args:
+            pubkey (str): The author of the deletion
+            event_ids (Iterable[str]): The ids it references
+        """
+        for event_id in event_ids:
+            event = self._events.get(event_id)
+            if event is not None and event.pubkey == pubkey:
+                self._remove(event_id)
+
+    def match(self, filters: Filters, limit: int) -> Tuple[List[CompactEvent], bool]:
+        """The held events matching the filters, counting towards the hit rate
+
+        Args:
+            filters (Filters): The filters of a REQ
+            limit (int): Most events to return
+
+        Returns:
+            Tuple[List[CompactEvent], bool]: The events newest first, and whether they are the complete answer. When
+                they aren't, the rest are the stored events created at or before `floor`.
+        """
+        if not self.warmed:
+            return [], False
+        self._expire()
+        self.lookups += 1
+
+        events = []
+        if limit > 0:
+            compiled = CompiledFilters.compile(filters)
+            now = time.time()
+            for event in self._candidates(filters):
+                # some of the events created in the floor's second may be gone, the database has them all
+                if self.floor is not None and event.created_at <= self.floor:
+                    break
+                if compiled.matches(event) and not self.retention.expired(event, now):
+                    events.append(event)
+                    if len(events) >= limit:
+                        break
+
+        # anything not held was created at or before the floor, so it can't be newer than what was found
+        complete = (
+            self.floor is None or len(events) >= limit or (filters.since is not None and filters.since >= self.floor)
+        )
+        if complete:
+            self.hits += 1
+        return events, complete
+
+    def _candidates(self, filters: Filters) -> Iterable[CompactEvent]:
+        # the narrowest index the filters allow, newest first
+        if filters.ids and not any(is_prefix(event_id) for event_id in filters.ids):
+            ids = {event_id for event_id in filters.ids if event_id in self._events}
+        elif filters.authors and not any(is_prefix(author) for author in filters.authors):
+            ids = set().union(*(self._authors.get(author, ()) for author in filters.authors))
+        elif filters.kinds:
+            ids = set().union(*(self._kinds.get(kind, ()) for kind in filters.kinds))
+        else:
+            return (self._events[event_id] for _, event_id in reversed(self._order))
+
+        events = [self._events[event_id] for event_id in ids]
+        events.sort(key=lambda event: (event.created_at, event.id), reverse=True)
+        return events
+
+    def _insert(self, event: CompactEvent):
+        self._events[event.id] = event
+        insort(self._order, (event.created_at, event.id))
+        self._authors.setdefault(event.pubkey, set()).add(event.id)
+        self._kinds.setdefault(event.kind, set()).add(event.id)
+        self.bytes += self._size(event)
+
+    def _remove(self, event_id: str):
+        event = self._events.pop(event_id)
+        del self._order[bisect_left(self._order, (event.created_at, event_id))]
+        for index, key in ((self._authors, event.pubkey), (self._kinds, event.kind)):
+            ids = index[key]
+            ids.discard(event_id)
+            if not ids:
+                del index[key]
+        self.bytes -= self._size(event)
+
+    def _drop_oldest(self):
+        created_at, event_id = self._order[0]
+        self._remove(event_id)
+        # others created in the same second may still be held, but not all of them need be
+        self.floor = created_at if self.floor is None else max(self.floor, created_at)
+
+    def _expire(self):
+        if not self.age:
+            return
+        oldest = int(time.time()) - self.age
+        while self._order and self._order[0][0] <= oldest:
+            self._drop_oldest()
+        if self.floor is None or self.floor < oldest:
+            self.floor = oldest
+
+    @staticmethod
+    def _size(event: CompactEvent) -> int:
+        return sys.getsizeof(event.payload()) + sys.getsizeof(event.content) + ENTRY_OVERHEAD
+
+    def snapshot(self) -> dict:
+        return {
+            "hot_events": len(self._events),
+            "hot_event_bytes": self.bytes,
+            "hot_lookups": self.lookups,
+            "hot_hits": self.hits,
+            "hot_hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+        }
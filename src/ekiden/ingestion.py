@@ -0,0 +1,96 @@
+import asyncio
+import time
+from typing import List, Optional, Tuple
+
+from ekiden import logger, metrics
+from ekiden.config import settings
+from ekiden.nips import CompactEvent
+from ekiden.storage import Storage
+
+
+class WriteBehind:
+    """Group commits verified events.
+
+    Events are collected for `flush_interval` seconds or until `batch_size` are waiting, whichever comes first, and
+    written in a single transaction. Writers are released once the transaction holding their event commits.
+    """
+
+    def __init__(self, storage: Storage, flush_interval: float = None, batch_size: int = None):
+        self.storage = storage
+        self.flush_interval = settings.ingest_flush_interval if flush_interval is None else flush_interval
+        self.batch_size = batch_size or settings.ingest_batch_size
+
+        self._queue: Optional[asyncio.Queue[Optional[Tuple[CompactEvent, asyncio.Future]]]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def write(self, event: CompactEvent) -> bool:
+        """Queue the event and wait until it has been committed
+
+        Args:
+            event (CompactEvent): The verified event
+
+        Returns:
+            bool: False if nothing was written, the event was already stored or a newer version replaced it
+        """
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((event, future))
+        return await future
+
+    async def close(self):
+        """Flush whatever is still queued and stop"""
+        if self._task is None:
+            return
+
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            item = await self._queue.get()
+            if item is None:
+                break
+
+            batch: List[Tuple[CompactEvent, asyncio.Future]] = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if self._queue.empty():
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self._queue.get_nowait()
+
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[CompactEvent, asyncio.Future]]):
+        started = time.perf_counter()
+        try:
+            written = await self.storage.store_events([event for event, _ in batch])
+        except Exception as e:
+            logger.error(f"failed to store {len(batch)} events: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            metrics.db_write_seconds.observe(time.perf_counter() - started)
+
+        for event, future in batch:
+            if not future.done():
+                future.set_result(event.id in written)
@@ -1,7 +1,10 @@
 import secrets
+from functools import lru_cache
 
 import secp256k1
 
+from ekiden.config import settings
+
 
 class VerificationError(Exception):
     """Raised when there is a error verifying the key"""
@@ -22,6 +25,14 @@ class PublicKey:
         return self._public_key.schnorr_verify(msg, bytes.fromhex(signature), None, raw=True)
 
 
+@lru_cache(maxsize=settings.pubkey_cache_size)
+def load_public_key(key_hex: str) -> PublicKey:
+    """
+    Returns the parsed public key, cached so frequent authors don't pay to reconstruct it
+    """
+    return PublicKey(key_hex=key_hex)
+
+
 class PrivateKey:
     def __init__(self):
         # Use the secrets module instead of the os.urandom which the secp256k1 library uses
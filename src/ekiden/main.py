@@ -1,22 +1,80 @@
+import asyncio
+import hmac
+import ipaddress
 import logging
+import signal
 
 from starlette.applications import Starlette
-from starlette.routing import WebSocketRoute
-from tortoise import Tortoise
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route, WebSocketRoute
 from tortoise.functions import Count
-from tortoise.transactions import atomic
 
 from ekiden import database as db
+from ekiden import logger, metrics
+from ekiden.config import settings
 from ekiden.hoshi import Hoshi
+from ekiden.profiler import SamplingProfiler
+
+profiler = SamplingProfiler()
 
 
 async def startup():
-    await Tortoise.init(db_url="sqlite://ekiden.sqlite3", modules={"models": ["ekiden.database"]})
-    await Tortoise.generate_schemas()
+    await Hoshi.storage.open()
+    await Hoshi.relay.start()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, toggle_profiler)
+    except (NotImplementedError, AttributeError):
+        # no signals on this platform, the profiler keeps its setting
+        pass
+
+
+def toggle_profiler():
+    profiler.enabled = not profiler.enabled
+    logger.info(f"Profiler {'enabled' if profiler.enabled else 'disabled'}")
 
 
 async def shutdown():
-    await Tortoise.close_connections()
+    await Hoshi.relay.close()
+    await Hoshi.storage.close()
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    return PlainTextResponse(metrics.render(Hoshi.snapshot()), media_type=metrics.CONTENT_TYPE)
+
+
+def profiling_allowed(request: Request) -> bool:
+    """
+    whether the request carries `profiler_token`, or comes from the loopback interface when no token is set. behind a
+    proxy every client would look local, so only the token lets them in
+    """
+    if settings.profiler_token:
+        expected = f"Bearer {settings.profiler_token}"
+        return hmac.compare_digest(request.headers.get("authorization", "").encode(), expected.encode())
+    if settings.trusted_proxies or request.client is None:
+        return False
+    try:
+        return ipaddress.ip_address(request.client.host).is_loopback
+    except ValueError:
+        return False
+
+
+async def profile_endpoint(request: Request) -> Response:
+    """
+    sample the event loop for `seconds` (at most a minute) and answer with the `top` hottest stacks, collapsed
+    """
+    if not profiler.enabled:
+        return PlainTextResponse("profiling is disabled\n", status_code=404)
+    if not profiling_allowed(request):
+        return PlainTextResponse("profiling needs the profiler token or a local client\n", status_code=403)
+    if profiler.running:
+        return PlainTextResponse("a profile is already running\n", status_code=409)
+    try:
+        seconds = min(float(request.query_params.get("seconds", 10)), 60)
+        top = int(request.query_params["top"]) if "top" in request.query_params else None
+    except ValueError:
+        return PlainTextResponse("seconds and top must be numbers\n", status_code=400)
+    return PlainTextResponse(await profiler.profile(seconds, top=top))
 
 
 def create_app():
@@ -25,10 +83,14 @@ def create_app():
         format='{"name": "%(name)s", "level": "%(levelname)s", "message": %(message)s}',
     )
 
+    routes = [
+        WebSocketRoute(path="/", endpoint=Hoshi()),
+        Route(path="/metrics", endpoint=metrics_endpoint),
+        Route(path="/debug/profile", endpoint=profile_endpoint),
+    ]
+
     return Starlette(
-        routes=[
-            WebSocketRoute(path="/", endpoint=Hoshi()),
-        ],
+        routes=routes,
         on_startup=[startup],
         on_shutdown=[shutdown],
     )
@@ -0,0 +1,139 @@
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Dict, List, Sequence
+
+# what Prometheus expects from a text exposition
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from a cached lookup up to a stalled write
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Distribution of durations, exposed as cumulative buckets"""
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self._counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self._counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Counter:
+    """Monotonic count, split by the value of a single label"""
+
+    def __init__(self, name: str, help: str, label: str):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values: Dict[str, int] = defaultdict(int)
+
+    def inc(self, value: str, amount: int = 1):
+        self._values[value] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for value, count in sorted(self._values.items()):
+            lines.append(f'{self.name}{{{self.label}="{value}"}} {count}')
+        return lines
+
+
+decode_seconds = Histogram("ekiden_decode_seconds", "Time spent parsing incoming websocket messages")
+verify_seconds = Histogram(
+    "ekiden_verify_seconds", "Time an event spends waiting for and going through signature verification"
+)
+db_write_seconds = Histogram("ekiden_db_write_seconds", "Duration of the transactions writing a batch of events")
+broadcast_seconds = Histogram("ekiden_broadcast_seconds", "Time spent fanning an event out to the subscriptions")
+replay_seconds = Histogram("ekiden_replay_seconds", "Time from a REQ to its EOSE")
+count_seconds = Histogram("ekiden_count_seconds", "Time taken to answer a COUNT")
+compaction_seconds = Histogram("ekiden_compaction_seconds", "Duration of the background runs removing expired events")
+
+messages = Counter("ekiden_messages_total", "Messages received from clients", "type")
+rejections = Counter("ekiden_rejections_total", "Events and messages refused", "reason")
+counts = Counter("ekiden_counts_total", "COUNT requests by how they were answered", "source")
+expired = Counter("ekiden_expired_total", "Expired events deleted one by one, and partitions dropped whole", "unit")
+bus_dropped = Counter("ekiden_bus_dropped_total", "Events that did not make it over the bus between workers", "reason")
+
+HISTOGRAMS = (
+    decode_seconds,
+    verify_seconds,
+    db_write_seconds,
+    broadcast_seconds,
+    replay_seconds,
+    count_seconds,
+    compaction_seconds,
+)
+COUNTERS = (messages, rejections, counts, expired, bus_dropped)
+
+# snapshot values that only ever grow, everything else is exposed as a gauge
+SNAPSHOT_COUNTERS = {
+    "dropped_frames",
+    "slow_disconnects",
+    "recent_id_lookups",
+    "recent_id_hits",
+    "replaceable_lookups",
+    "replaceable_hits",
+    "hot_lookups",
+    "hot_hits",
+}
+
+SNAPSHOT_HELP = {
+    "connections": "Open websocket connections",
+    "subscriptions": "Active subscriptions",
+    "distinct_filters": "Distinct filters across the subscriptions, each is evaluated once per event",
+    "send_queue_depth": "Frames waiting in all send queues",
+    "send_queue_depth_max": "Frames waiting in the fullest send queue",
+    "dropped_frames": "Frames dropped from full send queues",
+    "slow_disconnects": "Connections closed for not keeping up",
+    "replays": "REQ replays reading a page of events",
+    "hot_events": "Recent events held in memory to answer REQs",
+    "hot_event_bytes": "Estimated memory held by the recent events",
+    "hot_lookups": "REQ filters looked up in the recent events",
+    "hot_hits": "REQ filters answered by the recent events alone",
+    "rate_limited_addresses": "Client addresses with a token bucket",
+    "rate_limited_pubkeys": "Authors with a token bucket",
+}
+
+
+def render(snapshot: Dict[str, float]) -> str:
+    """The process' metrics in the Prometheus text format.
+
+    Each worker process keeps its own metrics, scrapes see the worker that answered.
+
+    Args:
+        snapshot (Dict[str, float]): Current values of the relay's gauges and counters, by name
+
+    Returns:
+        str: The exposition
+    """
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    for counter in COUNTERS:
+        lines.extend(counter.render())
+
+    for key, value in snapshot.items():
+        kind, name = ("counter", f"ekiden_{key}_total") if key in SNAPSHOT_COUNTERS else ("gauge", f"ekiden_{key}")
+        if key in SNAPSHOT_HELP:
+            lines.append(f"# HELP {name} {SNAPSHOT_HELP[key]}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -1,18 +1,19 @@
 from __future__ import annotations
 
-import json
 import time
 from enum import IntEnum
 from hashlib import sha256
-from typing import List, Optional, Tuple
+from typing import Dict, FrozenSet, List, Optional, Sequence, Tuple
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr, validator
 
-from ekiden.keys import PrivateKey, PublicKey, VerificationError
+from ekiden import codec
+from ekiden.keys import PrivateKey, VerificationError, load_public_key
 
 
 def dump_json(obj) -> str:
-    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+    # the id of an event is hashed over this encoding, see `codec.dumps`
+    return codec.dumps(obj)
 
 
 class Kind(IntEnum):
@@ -23,6 +24,22 @@ class Kind(IntEnum):
     delete = 5
 
 
+def is_replaceable(kind: int) -> bool:
+    """Whether only the latest event of this kind is kept per pubkey (NIP-1 kinds 0 and 3, NIP-16 10000-19999)"""
+    return kind in (Kind.set_metadata, Kind.contact_list) or 10000 <= kind < 20000
+
+
+def expiration(tags: Sequence[Sequence[str]]) -> Optional[int]:
+    """The NIP-40 `expiration` timestamp of an event, None if it has none or it isn't a number"""
+    for tag in tags:
+        if len(tag) > 1 and tag[0] == "expiration":
+            try:
+                return int(tag[1])
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
 class Tag(BaseModel):
     def json_array(self):
         raise NotImplemented("json_array is not implemented!")
@@ -53,10 +70,11 @@ class PTag(Tag):
 
 
 def create_tag(tag_info) -> Tag:
+    recommended_relay_url = tag_info[2] if len(tag_info) > 2 else ""
     if tag_info[0] == "e":
-        return ETag(id=tag_info[1], recommended_relay_url=tag_info[2])
+        return ETag(id=tag_info[1], recommended_relay_url=recommended_relay_url)
     elif tag_info[0] == "p":
-        return PTag(pubkey=tag_info[1], recommended_relay_url=tag_info[2])
+        return PTag(pubkey=tag_info[1], recommended_relay_url=recommended_relay_url)
 
     raise UnknownTagError(f"Could not parse tag {tag_info}")
 
@@ -72,6 +90,17 @@ class Event(BaseModel):
 
     sig: Optional[str] = None
 
+    # computed on first use and reused, cleared whenever a field they depend on changes
+    _id: Optional[str] = PrivateAttr(default=None)
+    _payload: Optional[str] = PrivateAttr(default=None)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self.__fields__:
+            self._payload = None
+            if name != "sig":
+                self._id = None
+
     @property
     def id(self) -> str:
         """
@@ -87,16 +116,43 @@ class Event(BaseModel):
         <content, as a string>
         ]`
 
+        The digest is cached on the instance.
+        """
+        if self._id is None:
+            self._id = sha256(
+                Event.serialize(
+                    pubkey=self.pubkey,
+                    created_at=self.created_at,
+                    kind=self.kind,
+                    tags=[tag.json_array() for tag in self.tags],
+                    content=self.content,
+                ).encode("utf-8")
+            ).hexdigest()
+        return self._id
+
+    @property
+    def tag_values(self) -> Dict[str, FrozenSet[str]]:
+        return {
+            "e": frozenset(tag.id for tag in self.tags if isinstance(tag, ETag)),
+            "p": frozenset(tag.pubkey for tag in self.tags if isinstance(tag, PTag)),
+        }
+
+    @property
+    def e_tags(self) -> FrozenSet[str]:
+        return self.tag_values["e"]
+
+    @property
+    def p_tags(self) -> FrozenSet[str]:
+        return self.tag_values["p"]
+
+    def payload(self) -> str:
         """
-        return sha256(
-            Event.serialize(
-                pubkey=self.pubkey,
-                created_at=self.created_at,
-                kind=self.kind,
-                tags=[tag.json_array() for tag in self.tags],
-                content=self.content,
-            ).encode("utf-8")
-        ).hexdigest()
+        The event encoded as a JSON object, as sent to clients. Cached on the instance so broadcasting to many
+        subscribers encodes it once.
+        """
+        if self._payload is None:
+            self._payload = dump_json(self.dict())
+        return self._payload
 
     def sign(self, private_key: str):
         """Signs the messge (Event.id) and sets the sig field
@@ -129,7 +185,7 @@ class Event(BaseModel):
         """
         event["tags"] = [create_tag(tag_info) for tag_info in event["tags"]]
         _event = Event(**event)
-        ret = PublicKey(event["pubkey"]).verify(msg=bytes.fromhex(_event.id), signature=event["sig"])
+        ret = load_public_key(event["pubkey"]).verify(msg=bytes.fromhex(_event.id), signature=event["sig"])
         if not ret:
             raise VerificationError("contents of the message could not be verified with the signature provided")
         return _event
@@ -150,6 +206,166 @@ class Event(BaseModel):
         }
 
 
+_NO_VALUES: FrozenSet[str] = frozenset()
+
+
+class CompactEvent:
+    """
+    Slotted event used from ingestion through broadcast and storage, the pydantic `Event` is kept for the public API.
+
+    Tags stay the arrays they came in as, so any tag letter is accepted. Their values are collected per single letter
+    tag name into frozensets once, when the event is built, so filter checks are plain set lookups.
+    """
+
+    __slots__ = ("id", "pubkey", "created_at", "kind", "tags", "content", "sig", "tag_values", "_payload")
+
+    def __init__(
+        self,
+        id: str,
+        pubkey: str,
+        created_at: int,
+        kind: int,
+        tags: Tuple[Tuple[str, ...], ...],
+        content: str,
+        sig: str,
+        payload: str = None,
+    ):
+        self.id = id
+        self.pubkey = pubkey
+        self.created_at = created_at
+        self.kind = kind
+        self.tags = tags
+        self.content = content
+        self.sig = sig
+        self._payload = payload
+
+        tag_values: Dict[str, set] = {}
+        for tag in tags:
+            if len(tag) > 1 and len(tag[0]) == 1:
+                tag_values.setdefault(tag[0], set()).add(tag[1])
+        self.tag_values: Dict[str, FrozenSet[str]] = {name: frozenset(values) for name, values in tag_values.items()}
+
+    @property
+    def e_tags(self) -> FrozenSet[str]:
+        return self.tag_values.get("e", _NO_VALUES)
+
+    @property
+    def p_tags(self) -> FrozenSet[str]:
+        return self.tag_values.get("p", _NO_VALUES)
+
+    @classmethod
+    def load(cls, event: dict, payload: str = None) -> CompactEvent:
+        """
+        Build the event from data that has already been verified, e.g. by another worker or read back from storage.
+        `payload` is the event's JSON encoding, if it is known it is reused instead of encoding the event again.
+        """
+        return cls(
+            id=event["id"],
+            pubkey=event["pubkey"],
+            created_at=event["created_at"],
+            kind=event["kind"],
+            tags=tuple(tuple(tag) for tag in event["tags"]),
+            content=event["content"],
+            sig=event["sig"],
+            payload=payload,
+        )
+
+    @classmethod
+    def verify(cls, event: dict) -> CompactEvent:
+        """
+        Check the shape of the event, its id and its signature.
+
+        Returns the event if successful else raises a VerificationError
+        """
+        try:
+            pubkey, created_at, kind = event["pubkey"], event["created_at"], event["kind"]
+            tags, content, sig = event["tags"], event["content"], event["sig"]
+        except (KeyError, TypeError):
+            raise VerificationError("event is missing fields")
+
+        if not (
+            isinstance(pubkey, str)
+            and type(created_at) is int
+            and type(kind) is int
+            and isinstance(content, str)
+            and isinstance(sig, str)
+            and isinstance(tags, list)
+            and all(isinstance(tag, list) and all(isinstance(item, str) for item in tag) for tag in tags)
+        ):
+            raise VerificationError("event fields have the wrong types")
+
+        event_id = sha256(Event.serialize(pubkey, created_at, kind, tags, content).encode("utf-8")).hexdigest()
+        if event.get("id", event_id) != event_id:
+            raise VerificationError("id does not match the contents of the event")
+
+        try:
+            ret = load_public_key(pubkey).verify(msg=bytes.fromhex(event_id), signature=sig)
+        except Exception:
+            ret = False
+        if not ret:
+            raise VerificationError("contents of the message could not be verified with the signature provided")
+
+        return cls(
+            id=event_id,
+            pubkey=pubkey,
+            created_at=created_at,
+            kind=kind,
+            tags=tuple(tuple(tag) for tag in tags),
+            content=content,
+            sig=sig,
+        )
+
+    def dict(self) -> dict:
+        return {
+            "id": self.id,
+            "pubkey": self.pubkey,
+            "created_at": self.created_at,
+            "kind": self.kind,
+            "tags": [list(tag) for tag in self.tags],
+            "content": self.content,
+            "sig": self.sig,
+        }
+
+    def payload(self) -> str:
+        """
+        The event encoded as a JSON object, as sent to clients and stored. Cached like `Event.payload`.
+        """
+        if self._payload is None:
+            self._payload = dump_json(self.dict())
+        return self._payload
+
+
+def event_message(subscription_id: str, event: Event) -> str:
+    """Build the `["EVENT", <subscription_id>, <event JSON>]` frame by splicing the subscription id into the
+    pre-encoded event payload. Produces the same text as `dump_json(["EVENT", subscription_id, event.dict()])`.
+    """
+    return payload_message(subscription_id, event.payload())
+
+
+def payload_message(subscription_id: str, payload: str) -> str:
+    """Same as `event_message`, for an event that is only at hand as JSON (e.g. read from the database)"""
+    return f'["EVENT",{dump_json(subscription_id)},{payload}]'
+
+
+# event ids and pubkeys are 32 bytes hex encoded, anything shorter in `ids` or `authors` is a prefix
+HEX_LENGTH = 64
+
+
+HEX_DIGITS = frozenset("0123456789abcdef")
+
+
+def is_prefix(value: str) -> bool:
+    return len(value) < HEX_LENGTH
+
+
+# NIP-01 subscription ids are non empty strings of at most 64 characters
+MAX_SUBSCRIPTION_ID_LENGTH = 64
+
+
+def is_subscription_id(value) -> bool:
+    return isinstance(value, str) and 0 < len(value) <= MAX_SUBSCRIPTION_ID_LENGTH
+
+
 class Filters(BaseModel):
     # NIP-1
     # each field is considered a `filter`. multiple filters are or conditions (e.g only one has to pass for the event to be valid)
@@ -169,6 +385,13 @@ class Filters(BaseModel):
     until: Optional[int]  # <a timestamp, events must be older than this to pass>
     limit: Optional[int]  # <maximum number of events to be returned in the initial query>
 
+    @validator("ids", "authors", each_item=True)
+    def lowercase_hex(cls, value: str) -> str:
+        # nothing else can match, and prefixes are looked up as index ranges ending at the next hex digit
+        if len(value) > HEX_LENGTH or not HEX_DIGITS.issuperset(value):
+            raise ValueError(f"must be lowercase hex of at most {HEX_LENGTH} characters")
+        return value
+
 
 class Subscribe(BaseModel):
     # NIP-1
@@ -194,6 +417,9 @@ class Notice(BaseModel):
     #  used to send human-readable error messages or other things to clients.
     message: str
 
+    def json_array(self) -> str:
+        return ["NOTICE", self.message]
+
 
 if __name__ == "__main__":
     pk = PrivateKey()
@@ -205,5 +431,5 @@ if __name__ == "__main__":
     )
     payload = event.signed_json(pk.hex())
 
-    data = json.loads(payload)
+    data = codec.loads(payload)
     print(Event.verify(data))
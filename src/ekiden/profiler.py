@@ -0,0 +1,63 @@
+import asyncio
+import sys
+import threading
+from collections import Counter
+from typing import Optional
+
+from ekiden.config import settings
+
+
+class SamplingProfiler:
+    """Samples the stack of the event loop thread from a background thread.
+
+    Nothing runs until a profile is asked for, then the loop's current frame is read every `interval` seconds and the
+    stacks are counted in the collapsed format flame graph tools take (`outer;inner;leaf count`). `enabled` is
+    whether `/debug/profile` may ask for one.
+    """
+
+    def __init__(self, interval: float = None):
+        self.interval = interval or settings.profiler_interval
+        self.enabled = settings.profiler
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def _sample(self, thread_id: int, stacks: Counter, stop: threading.Event):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_filename}:{code.co_name}")
+                frame = frame.f_back
+            if names:
+                stacks[";".join(reversed(names))] += 1
+
+    async def profile(self, seconds: float, top: Optional[int] = None) -> str:
+        """Sample the event loop for a while.
+
+        Only one profile runs at a time, further calls wait their turn.
+
+        Args:
+            seconds (float): How long to sample for
+            top (Optional[int]): Only keep this many of the hottest stacks
+
+        Returns:
+            str: The collapsed stacks, hottest first
+        """
+        async with self._lock:
+            stacks: Counter = Counter()
+            stop = threading.Event()
+            sampler = threading.Thread(
+                target=self._sample, args=(threading.get_ident(), stacks, stop), name="ekiden-profiler", daemon=True
+            )
+            sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                stop.set()
+                await asyncio.to_thread(sampler.join)
+
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common(top))
@@ -1,73 +1,241 @@
-from hashlib import sha256
-from uuid import uuid4
+import asyncio
+import time
+from typing import List, Optional, Sequence
 
-from tortoise.exceptions import DoesNotExist
-from tortoise.transactions import atomic
-
-from ekiden import database, logger
-from ekiden.nips import ETag, Event, Kind, dump_json
+from ekiden import logger, metrics
+from ekiden.admission import Admission
+from ekiden.bus import Bus, create_bus
+from ekiden.config import settings
+from ekiden.dedup import RecentIds, Tombstones
+from ekiden.hot import HotEvents
+from ekiden.ingestion import WriteBehind
+from ekiden.nips import CompactEvent, Kind, dump_json, is_replaceable
+from ekiden.replaceable import LatestVersions, Version
+from ekiden.retention import Retention
+from ekiden.storage import Storage
 from ekiden.subscriptions import SubscriptionPool
+from ekiden.verification import Verifier
 
 
 class AsyncRelay:
-    def __init__(self, sub_pool: SubscriptionPool) -> None:
+    def __init__(
+        self,
+        sub_pool: SubscriptionPool,
+        storage: Storage,
+        verifier: Verifier = None,
+        writer: WriteBehind = None,
+        recent_ids: RecentIds = None,
+        bus: Bus = None,
+        latest: LatestVersions = None,
+        tombstones: Tombstones = None,
+        admission: Admission = None,
+        hot: HotEvents = None,
+        retention: Retention = None,
+    ) -> None:
         self.conn_pool = sub_pool
+        self.storage = storage
+        self.verifier = verifier or Verifier()
+        self.writer = writer or WriteBehind(storage=storage)
+        self.recent_ids = recent_ids if recent_ids is not None else RecentIds()
+        self.bus = bus or create_bus()
+        self.latest = latest if latest is not None else LatestVersions()
+        self.tombstones = tombstones if tombstones is not None else Tombstones()
+        self.admission = admission
+        self.retention = retention or Retention()
+        self.hot = hot if hot is not None else HotEvents(retention=self.retention)
+        self._compaction: Optional[asyncio.Task] = None
+        self._resync: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.tombstones.update(await self.storage.tombstones())
+        # listening first, events written while the buffer is warmed are delivered rather than missed
+        await self.bus.start(self.deliver, self.lost)
+        await self.hot.warm(self.storage)
+        if settings.compaction_interval:
+            self._compaction = asyncio.create_task(self.compact_forever())
+
+    async def close(self):
+        if self._compaction is not None:
+            self._compaction.cancel()
+            self._compaction = None
+        if self._resync is not None:
+            self._resync.cancel()
+            self._resync = None
+        await self.bus.close()
+        await self.writer.close()
+        self.verifier.close()
+
+    async def deliver(self, event: CompactEvent):
+        """Track and broadcast an event that was verified and written by another worker, unless this worker already
+        handled it
+
+        Args:
+            event (CompactEvent): The event
+        """
+        if not self.recent_ids.add(event.id):
+            return
+        self.track(event)
+        await self.broadcast(event)
+
+    def lost(self):
+        """Events written by other processes may be missing from the caches, they start over from the database"""
+        logger.warning("events written by other processes may have been missed, reloading the caches")
+        self.latest.clear()
+        self.hot.reset()
+        if self._resync is not None:
+            self._resync.cancel()
+        self._resync = asyncio.create_task(self.resync())
+
+    async def resync(self):
+        self.tombstones.update(await self.storage.tombstones())
+        await self.hot.warm(self.storage)
+
+    async def compact_forever(self):
+        """Compact every `compaction_interval` seconds, a failed run is retried at the next"""
+        while True:
+            await asyncio.sleep(settings.compaction_interval)
+            started = time.perf_counter()
+            try:
+                await self.compact()
+            except Exception:
+                logger.exception("compaction failed")
+            finally:
+                metrics.compaction_seconds.observe(time.perf_counter() - started)
+
+    async def compact(self):
+        """Remove expired events and give free pages back, in short transactions that let writes through between
+        them"""
+        now = int(time.time())
+        for partition in await self.storage.drop_partitions(now):
+            logger.info(f"Dropped expired partition {partition.table}")
+            metrics.expired.inc("partition")
+
+        while deleted := await self.storage.delete_expired(now, settings.compaction_batch):
+            metrics.expired.inc("event", len(deleted))
+            for event_id, pubkey in deleted:
+                self.latest.discard(pubkey, (event_id,))
+                self.hot.discard(pubkey, (event_id,))
+
+        if pages := await self.storage.vacuum(settings.vacuum_pages):
+            logger.info(f"Freed {pages} database pages")
+
+    async def broadcast(self, event: CompactEvent):
+        started = time.perf_counter()
+        await self.conn_pool.broadcast(event)
+        metrics.broadcast_seconds.observe(time.perf_counter() - started)
+
+    def track(self, event: CompactEvent):
+        """Keep the in-memory indexes up to date with an event that was written"""
+        if is_replaceable(event.kind):
+            self.latest.add(event.pubkey, event.kind, Version.of(event))
+        elif event.kind == Kind.delete:
+            self.tombstones.add(event.pubkey, event.e_tags)
+            self.latest.discard(event.pubkey, event.e_tags)
+        self.hot.add(event)
+
+    async def latest_versions(self, authors: Sequence[str], kinds: Sequence[int]) -> List[Version]:
+        """The current version of replaceable events, from memory when known and from storage otherwise
+
+        Args:
+            authors (Sequence[str]): The pubkeys
+            kinds (Sequence[int]): The replaceable kinds
+
+        Returns:
+            List[Version]: The versions that exist
+        """
+        versions, missing_authors, missing_kinds = [], set(), set()
+        for pubkey in authors:
+            for kind in kinds:
+                if (version := self.latest.get(pubkey, kind)) is not None:
+                    versions.append(version)
+                else:
+                    missing_authors.add(pubkey)
+                    missing_kinds.add(kind)
+
+        if missing_authors:
+            known = {version.id for version in versions}
+            for pubkey, kind, created_at, event_id, raw in await self.storage.latest_events(
+                list(missing_authors), list(missing_kinds)
+            ):
+                if event_id not in known:
+                    version = Version(created_at, event_id, raw)
+                    self.latest.add(pubkey, kind, version)
+                    versions.append(version)
+        return versions
+
+    @staticmethod
+    def claimed_id(event_data: dict) -> str:
+        """The id an event says it has, before it is verified"""
+        event_id = event_data.get("id") if isinstance(event_data, dict) else None
+        return event_id if isinstance(event_id, str) else ""
+
+    @staticmethod
+    def duplicate(event_id: str) -> str:
+        return dump_json(["OK", event_id, "true", "duplicate: already have this event"])
+
+    @staticmethod
+    def stale(event_id: str) -> str:
+        return dump_json(["OK", event_id, "false", "invalid: a newer version of this event is already stored"])
 
-    @atomic()
     async def event(self, event_data: dict):
         """Handles the event action.
 
         Args:
             event_data (dict): A dict object containing the event data.
-            db (Database): The database connection.
         """
+        event_id = self.claimed_id(event_data)
+        # the id covers the pubkey, a forged pubkey only gets its own event refused
+        if event_id in self.tombstones and self.tombstones.deleted(event_id, event_data.get("pubkey")):
+            metrics.rejections.inc("deleted")
+            return dump_json(["OK", event_id, "false", "invalid: this event was deleted by its author"])
+        if event_id and self.recent_ids.seen(event_id):
+            metrics.rejections.inc("duplicate")
+            return self.duplicate(event_id)
+
+        started = time.perf_counter()
         try:
-            event = Event.verify(event_data)
+            event = await self.verifier.verify(event_data)
         except:
-            return dump_json(
-                [
-                    "OK",
-                    dump_json(event_data).encode("utf-8") + uuid4().hex.encode("utf-8"),
-                    "false",
-                    "failed to verify key",
-                ]
-            )
+            metrics.rejections.inc("verification_failed")
+            return dump_json(["OK", event_id, "false", "failed to verify key"])
+        finally:
+            metrics.verify_seconds.observe(time.perf_counter() - started)
 
-        await self.conn_pool.broadcast(event)
+        if self.admission is not None and not self.admission.pubkeys.take(event.pubkey):
+            metrics.rejections.inc("rate_limited_pubkey")
+            return dump_json(["OK", event.id, "false", "rate-limited: too many events from this pubkey, slow down"])
+
+        if self.retention.expired(event):
+            metrics.rejections.inc("expired")
+            return dump_json(["OK", event.id, "false", "invalid: this event has expired"])
+
+        if is_replaceable(event.kind) and self.latest.stale(event):
+            metrics.rejections.inc("stale")
+            return self.stale(event.id)
+
+        # identical events verified concurrently only go through once
+        if not self.recent_ids.add(event.id):
+            metrics.rejections.inc("duplicate")
+            return self.duplicate(event.id)
 
-        match event.kind:
-            case Kind.set_metadata:
-                await self.delete_event(event)
-            case Kind.contact_list:
-                await self.delete_event(event)
-            case Kind.delete:
-                for tag in event.tags:
-                    if not isinstance(tag, ETag):
-                        continue
-                    await database.Event.filter(id=tag.id).delete()
-
-        await database.Event.create(
-            id=event.id,
-            kind=event.kind,
-            content=event.content,
-            created_at=event.created_at,
-            tags=[tag.dict() for tag in event.tags],
-            pubkey=event.pubkey,
-            sig=event.sig,
-        )
-
-        return dump_json(
-            [
-                "OK",
-                sha256(event.json().encode("utf-8") + uuid4().hex.encode("utf-8")).hexdigest(),
-                "true",
-                "",
-            ]
-        )
-
-    async def delete_event(self, event):
         try:
-            if db_event := await database.Event.get(pubkey=event.pubkey, kind=event.kind):
-                await db_event.delete()
-        except DoesNotExist:
-            pass
+            written = await self.writer.write(event)
+        except Exception:
+            self.recent_ids.discard(event.id)
+            metrics.rejections.inc("store_failed")
+            return dump_json(["OK", event.id, "false", "failed to store event"])
+
+        if not written:
+            if is_replaceable(event.kind):
+                # the stored version was newer than anything this worker knew of
+                metrics.rejections.inc("stale")
+                return self.stale(event.id)
+            # already stored or deleted, but no longer remembered by this worker
+            metrics.rejections.inc("duplicate")
+            return self.duplicate(event.id)
+
+        # only what was written reaches subscribers, here and on the other workers
+        self.track(event)
+        await self.broadcast(event)
+        await self.bus.publish(event)
+        return dump_json(["OK", event.id, "true", ""])
@@ -0,0 +1,117 @@
+from collections import OrderedDict
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from ekiden.config import settings
+from ekiden.nips import CompactEvent
+
+
+class Version(NamedTuple):
+    """A stored version of a replaceable event"""
+
+    created_at: int
+    id: str
+    payload: str
+
+    @classmethod
+    def of(cls, event: CompactEvent) -> "Version":
+        return cls(event.created_at, event.id, event.payload())
+
+    def newer_than(self, other: "Version") -> bool:
+        # the later event wins, on a tie the lowest id is kept
+        return self.created_at > other.created_at or (self.created_at == other.created_at and self.id < other.id)
+
+
+class LatestVersions:
+    """Bounded LRU of the current version of replaceable events, by (pubkey, kind).
+
+    The database stays authoritative and enforces the same ordering, this only lets the relay reject stale
+    replacements before writing them and answer profile lookups without a query. A missing entry means unknown, not
+    absent.
+    """
+
+    def __init__(self, size: int = None):
+        self.size = size or settings.replaceable_cache_size
+        self._versions: OrderedDict[Tuple[str, int], Version] = OrderedDict()
+        self._keys: Dict[str, Tuple[str, int]] = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def __len__(self) -> int:
+        return len(self._versions)
+
+    def get(self, pubkey: str, kind: int) -> Optional[Version]:
+        """The current version, counting towards the hit rate
+
+        Args:
+            pubkey (str): The author
+            kind (int): The replaceable kind
+
+        Returns:
+            Optional[Version]: The version, None if it isn't known
+        """
+        self.lookups += 1
+        key = (pubkey, kind)
+        version = self._versions.get(key)
+        if version is not None:
+            self._versions.move_to_end(key)
+            self.hits += 1
+        return version
+
+    def stale(self, event: CompactEvent) -> bool:
+        """Check whether a newer version of the event is already known
+
+        Args:
+            event (CompactEvent): A replaceable event
+
+        Returns:
+            bool: True if storing the event would not replace anything
+        """
+        current = self._versions.get((event.pubkey, event.kind))
+        return current is not None and not Version.of(event).newer_than(current)
+
+    def add(self, pubkey: str, kind: int, version: Version) -> bool:
+        """Remember the version unless a newer one is known
+
+        Args:
+            pubkey (str): The author
+            kind (int): The replaceable kind
+            version (Version): The version
+
+        Returns:
+            bool: True if the version is now the current one
+        """
+        key = (pubkey, kind)
+        current = self._versions.get(key)
+        if current is not None:
+            if not version.newer_than(current):
+                return False
+            del self._keys[current.id]
+
+        self._versions[key] = version
+        self._versions.move_to_end(key)
+        self._keys[version.id] = key
+        if len(self._versions) > self.size:
+            _, evicted = self._versions.popitem(last=False)
+            del self._keys[evicted.id]
+        return True
+
+    def discard(self, pubkey: str, event_ids: Iterable[str]):
+        """Forget the versions with these ids written by the pubkey, once they were deleted"""
+        for event_id in event_ids:
+            key = self._keys.get(event_id)
+            if key is not None and key[0] == pubkey:
+                del self._keys[event_id]
+                del self._versions[key]
+
+    def clear(self):
+        """Forget every version, after versions may have been written without this cache hearing of them"""
+        self._versions.clear()
+        self._keys.clear()
+
+    def snapshot(self) -> dict:
+        return {
+            "replaceable_versions": len(self._versions),
+            "replaceable_lookups": self.lookups,
+            "replaceable_hits": self.hits,
+            "replaceable_hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+        }
@@ -0,0 +1,88 @@
+import time
+from typing import Dict, NamedTuple, Optional
+
+from ekiden.config import settings
+from ekiden.nips import CompactEvent, Filters, expiration, is_replaceable
+
+
+class Partition(NamedTuple):
+    """A table of events created in [start, end) that are all kept for `age` seconds, dropped once the newest expired"""
+
+    age: int
+    start: int
+    end: int
+
+    @property
+    def table(self) -> str:
+        return f"event_{self.age}_{self.start}"
+
+    @property
+    def tags(self) -> str:
+        return f"event_tag_{self.age}_{self.start}"
+
+    def expired(self, now: int) -> bool:
+        return self.end - 1 + self.age <= now
+
+    def overlaps(self, filters: Filters) -> bool:
+        """Whether events created in the partition's period can pass the filters' since and until"""
+        return (filters.since is None or self.end - 1 > filters.since) and (
+            filters.until is None or self.start < filters.until
+        )
+
+
+class Retention:
+    """How long events are kept, by kind.
+
+    Replaceable events and kinds without a max age are kept for good in the `event` table. Events of the other kinds
+    are stored in partitions by max age and `created_at`, so they expire by dropping a table. A NIP-40 `expiration` tag
+    shortens an event's life further.
+    """
+
+    def __init__(self, ages: Dict[int, int] = None, default: int = None, partition_seconds: int = None):
+        self.ages = settings.retention if ages is None else ages
+        self.default = settings.retention_default if default is None else default
+        self.partition_seconds = partition_seconds or settings.partition_seconds
+
+    def max_age(self, kind: int) -> Optional[int]:
+        """Seconds events of the kind are kept for, None if they are kept for good"""
+        if is_replaceable(kind):
+            return None
+        return self.ages.get(kind, self.default) or None
+
+    def expires_at(self, event: CompactEvent) -> Optional[int]:
+        """When the event is to be removed, None if never
+
+        Args:
+            event (CompactEvent): The event
+
+        Returns:
+            Optional[int]: The unix timestamp it expires at
+        """
+        max_age = self.max_age(event.kind)
+        expires_at = None if max_age is None else event.created_at + max_age
+        if (tagged := expiration(event.tags)) is not None:
+            expires_at = tagged if expires_at is None else min(expires_at, tagged)
+        return expires_at
+
+    def expired(self, event: CompactEvent, now: float = None) -> bool:
+        expires_at = self.expires_at(event)
+        return expires_at is not None and expires_at <= (time.time() if now is None else now)
+
+    def partition(self, event: CompactEvent, now: float = None) -> Optional[Partition]:
+        """The partition the event is stored in
+
+        Args:
+            event (CompactEvent): The event
+            now (float): Current unix time
+
+        Returns:
+            Optional[Partition]: None if the event goes in the `event` table, as it's kept for good or dated so far
+                ahead it would need a partition of its own
+        """
+        max_age = self.max_age(event.kind)
+        if max_age is None:
+            return None
+        start = event.created_at - event.created_at % self.partition_seconds
+        if start > (time.time() if now is None else now) + self.partition_seconds:
+            return None
+        return Partition(max_age, start, start + self.partition_seconds)
@@ -0,0 +1,1107 @@
+import asyncio
+import heapq
+import sqlite3
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncContextManager,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+import aiosqlite
+from tortoise import Tortoise
+from tortoise.transactions import in_transaction
+
+from ekiden import codec, logger
+from ekiden.config import Durability, StorageBackend, settings
+from ekiden.database import create_tag
+from ekiden.nips import (
+    CompactEvent,
+    Filters,
+    Kind,
+    dump_json,
+    expiration,
+    is_prefix,
+    is_replaceable,
+)
+from ekiden.retention import Partition, Retention
+
+# the kinds of which only the latest event is kept per pubkey, see `nips.is_replaceable`
+REPLACEABLE = '("kind" IN (0, 3) OR "kind" BETWEEN 10000 AND 19999)'
+
+# the indexes of an events' table. each ends in ("created_at", "id"), so a page of events matching one author, one
+# kind or both, newest first, is a single range of an index, see `Storage._stream_table`
+EVENT_INDEXES = (
+    ("pubkey", "kind", "created_at", "id"),
+    ("pubkey", "created_at", "id"),
+    ("kind", "created_at", "id"),
+    ("created_at", "id"),
+)
+
+
+def event_indexes(table: str) -> Tuple[str, ...]:
+    return tuple(
+        f'CREATE INDEX IF NOT EXISTS "idx_{table}_{"_".join(columns)}" ON "{table}" ({", ".join(map(quoted, columns))})'
+        for columns in EVENT_INDEXES
+    )
+
+
+def quoted(column: str) -> str:
+    return f'"{column}"'
+
+
+# the tables behind `database.Event` and `database.EventTag`, shared by every backend
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS "event" (
+        "table_id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        "id" VARCHAR(64) NOT NULL UNIQUE,
+        "kind" INT NOT NULL,
+        "content" TEXT NOT NULL,
+        "created_at" INT NOT NULL,
+        "tags" JSON NOT NULL,
+        "pubkey" VARCHAR(64) NOT NULL,
+        "sig" TEXT NOT NULL,
+        "raw" TEXT NOT NULL
+    )""",
+    *event_indexes("event"),
+    # databases written before replaceable events were upserted may hold older versions, which would break the index
+    f"""DELETE FROM "event" WHERE {REPLACEABLE} AND EXISTS (
+        SELECT 1 FROM "event" AS "newer"
+        WHERE "newer"."pubkey" = "event"."pubkey" AND "newer"."kind" = "event"."kind"
+        AND ("newer"."created_at" > "event"."created_at"
+            OR ("newer"."created_at" = "event"."created_at" AND "newer"."id" < "event"."id"))
+    )""",
+    f'CREATE UNIQUE INDEX IF NOT EXISTS "uid_event_replaceable" ON "event" ("pubkey", "kind") WHERE {REPLACEABLE}',
+    """CREATE TABLE IF NOT EXISTS "event_tag" (
+        "table_id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        "event_id" INT NOT NULL REFERENCES "event" ("table_id") ON DELETE CASCADE,
+        "name" VARCHAR(1) NOT NULL,
+        "value" VARCHAR(64) NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS "idx_event_tag_name_value" ON "event_tag" ("name", "value")',
+    'CREATE INDEX IF NOT EXISTS "idx_event_tag_event_id" ON "event_tag" ("event_id")',
+    # ids deleted by an author, kept so the events are refused if they show up again
+    """CREATE TABLE IF NOT EXISTS "tombstone" (
+        "event_id" VARCHAR(64) NOT NULL,
+        "pubkey" VARCHAR(64) NOT NULL,
+        PRIMARY KEY ("event_id", "pubkey")
+    ) WITHOUT ROWID""",
+    # the partitions of expiring events, see `retention.Partition`
+    """CREATE TABLE IF NOT EXISTS "event_partition" (
+        "age" INT NOT NULL,
+        "start" INT NOT NULL,
+        "end" INT NOT NULL,
+        PRIMARY KEY ("age", "start")
+    ) WITHOUT ROWID""",
+    # when events with a NIP-40 expiration tag are to be deleted, wherever they are stored
+    """CREATE TABLE IF NOT EXISTS "expiration" (
+        "event_id" VARCHAR(64) NOT NULL PRIMARY KEY,
+        "expires_at" INT NOT NULL
+    ) WITHOUT ROWID""",
+    'CREATE INDEX IF NOT EXISTS "idx_expiration_expires_at" ON "expiration" ("expires_at")',
+    # stored events by kind, by author and kind, and by indexed tag value and kind, across every table. kept exact by
+    # `count_triggers` so the usual COUNT requests are answered without counting rows
+    """CREATE TABLE IF NOT EXISTS "kind_count" (
+        "kind" INT NOT NULL PRIMARY KEY,
+        "count" INT NOT NULL
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS "author_count" (
+        "pubkey" VARCHAR(64) NOT NULL,
+        "kind" INT NOT NULL,
+        "count" INT NOT NULL,
+        PRIMARY KEY ("pubkey", "kind")
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS "tag_count" (
+        "name" VARCHAR(1) NOT NULL,
+        "value" VARCHAR(64) NOT NULL,
+        "kind" INT NOT NULL,
+        "count" INT NOT NULL,
+        PRIMARY KEY ("name", "value", "kind")
+    ) WITHOUT ROWID""",
+)
+
+# a partition holds the same rows as `event`, never replaceable ones
+PARTITION_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS "{table}" (
+        "table_id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        "id" VARCHAR(64) NOT NULL UNIQUE,
+        "kind" INT NOT NULL,
+        "content" TEXT NOT NULL,
+        "created_at" INT NOT NULL,
+        "tags" JSON NOT NULL,
+        "pubkey" VARCHAR(64) NOT NULL,
+        "sig" TEXT NOT NULL,
+        "raw" TEXT NOT NULL
+    )""",
+    *event_indexes("{table}"),
+    """CREATE TABLE IF NOT EXISTS "{tags}" (
+        "table_id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        "event_id" INT NOT NULL REFERENCES "{table}" ("table_id") ON DELETE CASCADE,
+        "name" VARCHAR(1) NOT NULL,
+        "value" VARCHAR(64) NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS "idx_{tags}_name_value" ON "{tags}" ("name", "value")',
+    'CREATE INDEX IF NOT EXISTS "idx_{tags}_event_id" ON "{tags}" ("event_id")',
+)
+
+INSERT = (
+    'INSERT INTO "{table}" ("id", "kind", "content", "created_at", "tags", "pubkey", "sig", "raw") '
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+# takes over the row of an older version, the event id is unique on its own as well
+UPSERT = f"""{INSERT.format(table="event")}
+    ON CONFLICT ("id") DO NOTHING
+    ON CONFLICT ("pubkey", "kind") WHERE {REPLACEABLE} DO UPDATE SET
+        "id" = excluded."id", "content" = excluded."content", "created_at" = excluded."created_at",
+        "tags" = excluded."tags", "sig" = excluded."sig", "raw" = excluded."raw"
+    WHERE excluded."created_at" > "event"."created_at"
+        OR (excluded."created_at" = "event"."created_at" AND excluded."id" < "event"."id")"""
+
+# tag names whose values are normalized into `event_tag`
+INDEXED_TAGS = ("e", "p")
+
+
+def indexed_tag_values(tags: str) -> Tuple[str, str]:
+    """The FROM and WHERE clauses selecting the indexed (name, value) pairs of a JSON tags column as "tag"."value"
+    ->> 0 and ->> 1, read from the JSON as the tag rows may be gone already when a row is deleted"""
+    names = ", ".join(f"'{name}'" for name in INDEXED_TAGS)
+    return (
+        f'json_each({tags}) AS "tag"',
+        f'"tag"."value" ->> 0 IN ({names}) AND json_array_length("tag"."value") > 1',
+    )
+
+
+def count_triggers(table: str) -> Tuple[str, ...]:
+    """The triggers keeping the counts up to date with every upsert and delete on the table, in the same transaction.
+
+    Inserts of the kinds that aren't replaceable, nearly all of them, are counted a batch at a time by `Storage._count`
+    instead. Dropping the table doesn't fire the triggers, see `subtract_counts`.
+    """
+
+    def add(row: str) -> str:
+        source, condition = indexed_tag_values(f'{row}."tags"')
+        return f"""
+            INSERT INTO "kind_count" VALUES ({row}."kind", 1) ON CONFLICT DO UPDATE SET "count" = "count" + 1;
+            INSERT INTO "author_count" VALUES ({row}."pubkey", {row}."kind", 1)
+                ON CONFLICT DO UPDATE SET "count" = "count" + 1;
+            INSERT INTO "tag_count"
+                SELECT DISTINCT "tag"."value" ->> 0, "tag"."value" ->> 1, {row}."kind", 1
+                FROM {source} WHERE {condition}
+                ON CONFLICT DO UPDATE SET "count" = "count" + 1;"""
+
+    def remove(row: str) -> str:
+        source, condition = indexed_tag_values(f'{row}."tags"')
+        tag_values = (
+            f'("name", "value") IN (SELECT "tag"."value" ->> 0, "tag"."value" ->> 1 FROM {source} WHERE {condition})'
+        )
+        return f"""
+            UPDATE "kind_count" SET "count" = "count" - 1 WHERE "kind" = {row}."kind";
+            UPDATE "author_count" SET "count" = "count" - 1 WHERE "pubkey" = {row}."pubkey" AND "kind" = {row}."kind";
+            DELETE FROM "author_count" WHERE "pubkey" = {row}."pubkey" AND "kind" = {row}."kind" AND "count" <= 0;
+            UPDATE "tag_count" SET "count" = "count" - 1 WHERE "kind" = {row}."kind" AND {tag_values};
+            DELETE FROM "tag_count" WHERE "kind" = {row}."kind" AND {tag_values} AND "count" <= 0;"""
+
+    return (
+        f"""CREATE TRIGGER IF NOT EXISTS "{table}_count_insert" AFTER INSERT ON "{table}"
+            WHEN {REPLACEABLE.replace('"kind"', 'NEW."kind"')} BEGIN {add("NEW")} END""",
+        f'CREATE TRIGGER IF NOT EXISTS "{table}_count_delete" AFTER DELETE ON "{table}" BEGIN {remove("OLD")} END',
+        # a replaceable event taking over the row of its previous version
+        f"""CREATE TRIGGER IF NOT EXISTS "{table}_count_update" AFTER UPDATE OF "kind", "pubkey", "tags" ON "{table}"
+            BEGIN {remove("OLD")} {add("NEW")} END""",
+    )
+
+
+# add a batch of inserted events to the counts, one statement per count table
+COUNT_UPSERTS = tuple(
+    f'INSERT INTO "{counts}" VALUES ({values}) ON CONFLICT DO UPDATE SET "count" = "count" + excluded."count"'
+    for counts, values in (("kind_count", "?, ?"), ("author_count", "?, ?, ?"), ("tag_count", "?, ?, ?, ?"))
+)
+
+
+def table_counts(table: str) -> Tuple[Tuple[str, Tuple[str, ...], str], ...]:
+    """For each count table, its key columns and a query counting the table's events under those keys, with the
+    columns named after the count table's"""
+    source, condition = indexed_tag_values('"events"."tags"')
+    return (
+        ("kind_count", ("kind",), f'SELECT "kind", count(*) AS "count" FROM "{table}" GROUP BY 1'),
+        (
+            "author_count",
+            ("pubkey", "kind"),
+            f'SELECT "pubkey", "kind", count(*) AS "count" FROM "{table}" GROUP BY 1, 2',
+        ),
+        (
+            "tag_count",
+            ("name", "value", "kind"),
+            'SELECT "tag"."value" ->> 0 AS "name", "tag"."value" ->> 1 AS "value", "kind", '
+            f'count(DISTINCT "events"."table_id") AS "count" FROM "{table}" AS "events", {source} '
+            f"WHERE {condition} GROUP BY 1, 2, 3",
+        ),
+    )
+
+
+def add_counts(table: str) -> Tuple[str, ...]:
+    """Statements adding the events of a table that had no triggers yet to the counts"""
+    return tuple(
+        f'INSERT INTO "{counts}" SELECT * FROM ({query}) WHERE 1 '
+        f'ON CONFLICT DO UPDATE SET "count" = "{counts}"."count" + excluded."count"'
+        for counts, _, query in table_counts(table)
+    )
+
+
+def subtract_counts(table: str) -> List[str]:
+    """Statements taking the events of a table about to be dropped out of the counts"""
+    statements = []
+    for counts, keys, query in table_counts(table):
+        columns = ", ".join(f'"{counts}"."{key}"' for key in keys)
+        dropped = ", ".join(f'"dropped"."{key}"' for key in keys)
+        statements.append(
+            f'UPDATE "{counts}" SET "count" = "{counts}"."count" - "dropped"."count" '
+            f'FROM ({query}) AS "dropped" WHERE ({columns}) = ({dropped})'
+        )
+        keys = ", ".join(f'"{key}"' for key in keys)
+        statements.append(f'DELETE FROM "{counts}" WHERE "count" <= 0 AND ({keys}) IN (SELECT {keys} FROM ({query}))')
+    return statements
+
+
+def placeholders(values: Sequence[Any]) -> str:
+    return ",".join("?" * len(values))
+
+
+def prefix_upper(prefix: str) -> str:
+    """The smallest string greater than every string starting with the prefix, `prefix <= value < upper` is a range
+    the column's index can scan"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def match_clause(column: str, values: Sequence[str]) -> Tuple[Optional[str], List[Any]]:
+    """Match a column against full values and prefixes, see `filter_query`"""
+    if any(value == "" for value in values):
+        # the empty prefix matches everything
+        return None, []
+
+    exact = [value for value in values if not is_prefix(value)]
+    prefixes = [value for value in values if is_prefix(value)]
+    conditions, params = [], []
+    if exact:
+        conditions.append(f'"{column}" IN ({placeholders(exact)})')
+        params.extend(exact)
+    for prefix in prefixes:
+        conditions.append(f'("{column}" >= ? AND "{column}" < ?)')
+        params.extend((prefix, prefix_upper(prefix)))
+    return " OR ".join(conditions), params
+
+
+# maps hex digits to their complement, so ids sort in descending order where only ascending is available
+DESCENDING = str.maketrans("0123456789abcdef", "fedcba9876543210")
+
+
+def filter_query(filters: Filters, tags: str = "event_tag") -> Tuple[str, List[Any]]:
+    """Translate the filters into a WHERE clause the indexes on `event` and `event_tag`, or a partition's tables,
+    can serve.
+
+    Args:
+        filters (Filters): The filters of the REQ
+        tags (str): The tag table of the events' table
+
+    Returns:
+        Tuple[str, List[Any]]: The clause and its parameters
+    """
+    clauses, params = [], []
+    for column, values in (("id", filters.ids), ("pubkey", filters.authors)):
+        if values:
+            clause, values = match_clause(column, values)
+            if clause is not None:
+                clauses.append(f"({clause})")
+                params.extend(values)
+    if filters.kinds:
+        clauses.append(f'"kind" IN ({placeholders(filters.kinds)})')
+        params.extend(filters.kinds)
+    if filters.since is not None:
+        clauses.append('"created_at" > ?')
+        params.append(filters.since)
+    if filters.until is not None:
+        clauses.append('"created_at" < ?')
+        params.append(filters.until)
+    for name, values in (("e", filters.event_ids), ("p", filters.pubkeys)):
+        if values:
+            clauses.append(
+                f'"table_id" IN (SELECT "event_id" FROM "{tags}" WHERE "name" = ? AND "value" IN ({placeholders(values)}))'
+            )
+            params.append(name)
+            params.extend(values)
+
+    return " AND ".join(clauses) or "1", params
+
+
+class Transaction:
+    """What the storage logic needs from a backend's connection"""
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()):
+        raise NotImplementedError
+
+    async def executemany(self, sql: str, rows: Sequence[Sequence[Any]]):
+        raise NotImplementedError
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        raise NotImplementedError
+
+    async def fetchall_before(self, sql: str, params: Sequence[Any], deadline: float) -> List[tuple]:
+        """Run a query that is interrupted once `time.monotonic()` passes the deadline
+
+        Raises:
+            TimeoutError: The query ran past the deadline
+        """
+        raise NotImplementedError
+
+
+async def fetchall_before(connection: aiosqlite.Connection, sql: str, params: Sequence[Any], deadline: float):
+    # SQLite calls the handler every thousand instructions of the statement and aborts it once the handler says so
+    await connection.set_progress_handler(lambda: time.monotonic() > deadline, 1_000)
+    try:
+        return [tuple(row) for row in await connection.execute_fetchall(sql, params)]
+    except sqlite3.OperationalError as e:
+        if time.monotonic() > deadline:
+            raise TimeoutError("the query ran out of time") from e
+        raise
+    finally:
+        await connection.set_progress_handler(None, 0)
+
+
+async def migrate_legacy_events(tx: Transaction):
+    """Bring an `event` table created by `Tortoise.generate_schemas` up to date. Ids are made unique, keeping the
+    first copy of an event that was stored twice, tags kept as the tag models' fields become the arrays they were sent
+    as, and every event gets its `raw` JSON and its rows in `event_tag`."""
+    columns = [name for _, name, *_ in await tx.fetchall('PRAGMA table_info("event")')]
+    if "raw" not in columns:
+        await tx.execute("""ALTER TABLE "event" ADD COLUMN "raw" TEXT NOT NULL DEFAULT ''""")
+    await tx.execute('DELETE FROM "event" WHERE "table_id" NOT IN (SELECT min("table_id") FROM "event" GROUP BY "id")')
+    await tx.execute('CREATE UNIQUE INDEX IF NOT EXISTS "uid_event_id" ON "event" ("id")')
+
+    last = 0
+    while rows := await tx.fetchall(
+        'SELECT "table_id", "id", "pubkey", "created_at", "kind", "tags", "content", "sig" FROM "event" '
+        """WHERE "raw" = '' AND "table_id" > ? ORDER BY "table_id" LIMIT 1000""",
+        [last],
+    ):
+        updates = []
+        for table_id, event_id, pubkey, created_at, kind, tags, content, sig in rows:
+            tags = [tag if isinstance(tag, list) else create_tag(tag).json_array() for tag in codec.loads(tags)]
+            event = CompactEvent(event_id, pubkey, created_at, kind, tuple(map(tuple, tags)), content, sig)
+            updates.append((dump_json(tags), event.payload(), table_id))
+        await tx.executemany('UPDATE "event" SET "tags" = ?, "raw" = ? WHERE "table_id" = ?', updates)
+        last = rows[-1][0]
+
+    source, condition = indexed_tag_values('"event"."tags"')
+    await tx.execute(
+        'INSERT INTO "event_tag" ("event_id", "name", "value") '
+        f'SELECT DISTINCT "event"."table_id", "tag"."value" ->> 0, "tag"."value" ->> 1 FROM "event", {source} '
+        f'WHERE {condition} AND NOT EXISTS (SELECT 1 FROM "event_tag" WHERE "event_id" = "event"."table_id")'
+    )
+
+
+async def migrate_seek_indexes(tx: Transaction):
+    """Replace the indexes that ended in "created_at" by the `EVENT_INDEXES`, in every events' table"""
+    for table in await Storage._tables(tx):
+        for statement in event_indexes(table):
+            await tx.execute(statement)
+        for columns in ("pubkey_kind_created_at", "kind_created_at"):
+            await tx.execute(f'DROP INDEX IF EXISTS "idx_{table}_{columns}"')
+
+
+# the steps bringing a database written by an earlier version up to date, in order. `PRAGMA user_version` holds how
+# many of them the database went through, a new database starts out at the last one
+MIGRATIONS: Tuple[Callable[[Transaction], Awaitable[None]], ...] = (migrate_legacy_events, migrate_seek_indexes)
+
+
+class Storage:
+    """Where events are kept.
+
+    The queries are written once against `Transaction`, backends provide connections: `transaction` for writes and
+    `reader` for queries that may run alongside them.
+
+    Events that are kept for good live in `event`, those that expire in partitions picked by `retention`, so expiring
+    them drops a table. Queries read every table that can hold a match and merge them.
+    """
+
+    retention: Retention
+
+    async def open(self):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    def transaction(self) -> AsyncContextManager[Transaction]:
+        raise NotImplementedError
+
+    def reader(self) -> AsyncContextManager[Transaction]:
+        raise NotImplementedError
+
+    async def vacuum(self, pages: int) -> int:
+        """Give free pages back to the file system, a few at a time so writers aren't held up
+
+        Args:
+            pages (int): Most pages to free
+
+        Returns:
+            int: The pages that were freed
+        """
+        raise NotImplementedError
+
+    async def create_schema(self):
+        async with self.transaction() as tx:
+            (counted,), *_ = await tx.fetchall('SELECT count(*) FROM "sqlite_master" WHERE "name" = ?', ["kind_count"])
+            (existing,), *_ = await tx.fetchall('SELECT count(*) FROM "sqlite_master" WHERE "name" = ?', ["event"])
+            (version,), *_ = await tx.fetchall("PRAGMA user_version")
+            for statement in SCHEMA:
+                await tx.execute(statement)
+            if existing:
+                for migration in MIGRATIONS[version:]:
+                    logger.info(f"Migrating the database: {migration.__name__}")
+                    await migration(tx)
+            await tx.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+            for table in await self._tables(tx):
+                # events stored before the counts existed are counted once
+                for statement in (() if counted else add_counts(table)) + count_triggers(table):
+                    await tx.execute(statement)
+            (auto_vacuum,), *_ = await tx.fetchall("PRAGMA auto_vacuum")
+        if auto_vacuum != 2 and (self.retention.ages or self.retention.default):
+            # only a new database can be set up for it, an existing one has to be rebuilt once
+            logger.warning("the database can't give the space of expired events back, run VACUUM on it once to fix it")
+
+    @staticmethod
+    async def _partitions(tx: Transaction) -> List[Partition]:
+        return [Partition(*row) for row in await tx.fetchall('SELECT "age", "start", "end" FROM "event_partition"')]
+
+    @staticmethod
+    async def _tables(tx: Transaction) -> List[str]:
+        """Every table events are stored in"""
+        return ["event", *(partition.table for partition in await Storage._partitions(tx))]
+
+    async def store_events(self, events: List[CompactEvent]) -> Set[str]:
+        """Store a batch of verified events in a single transaction, applying their side effects in order.
+
+        Replaceable events are upserted on (pubkey, kind) and only replace an older version. Deletions remove the
+        referenced events written by the same pubkey, from every table, and leave tombstones behind so they are not
+        stored again. Consecutive events between deletions are written with one bulk insert per table.
+
+        Args:
+            events (List[CompactEvent]): The verified events, in the order they were received
+
+        Returns:
+            Set[str]: The ids of the events that were written, leaving out those already stored, deleted and stale
+                versions
+        """
+        written = set()
+        async with self.transaction() as tx:
+            pending: List[CompactEvent] = []
+            for event in events:
+                if event.kind == Kind.delete:
+                    written |= await self._insert(tx, pending)
+                    pending = []
+                    if ids := list(event.e_tags):
+                        for table in await self._tables(tx):
+                            await tx.execute(
+                                f'DELETE FROM "{table}" WHERE "pubkey" = ? AND "id" IN ({placeholders(ids)})',
+                                [event.pubkey, *ids],
+                            )
+                        await tx.executemany(
+                            'INSERT OR IGNORE INTO "tombstone" ("event_id", "pubkey") VALUES (?, ?)',
+                            [(event_id, event.pubkey) for event_id in ids],
+                        )
+                pending.append(event)
+
+            written |= await self._insert(tx, pending)
+        return written
+
+    async def _insert(self, tx: Transaction, events: List[CompactEvent]) -> Set[str]:
+        """Write the events to their tables, and remember when those with an expiration tag expire"""
+        if not events:
+            return set()
+
+        now = time.time()
+        tables: Dict[Optional[Partition], List[CompactEvent]] = {}
+        for event in events:
+            tables.setdefault(self.retention.partition(event, now), []).append(event)
+
+        written = set()
+        for partition, batch in tables.items():
+            if partition is None:
+                written |= await self._insert_into(tx, batch)
+                continue
+            await tx.execute(
+                'INSERT OR IGNORE INTO "event_partition" ("age", "start", "end") VALUES (?, ?, ?)', list(partition)
+            )
+            for statement in PARTITION_SCHEMA:
+                await tx.execute(statement.format(table=partition.table, tags=partition.tags))
+            for statement in count_triggers(partition.table):
+                await tx.execute(statement)
+            written |= await self._insert_into(tx, batch, table=partition.table, tags=partition.tags)
+
+        expiring = [
+            (event.id, self.retention.expires_at(event))
+            for event in events
+            if event.id in written and expiration(event.tags) is not None
+        ]
+        if expiring:
+            await tx.executemany(
+                'INSERT OR REPLACE INTO "expiration" ("event_id", "expires_at") VALUES (?, ?)', expiring
+            )
+        return written
+
+    @staticmethod
+    async def _insert_into(
+        tx: Transaction, events: List[CompactEvent], table: str = "event", tags: str = "event_tag"
+    ) -> Set[str]:
+        """Bulk insert the events along with their normalized tag values, events that are already stored or were
+        deleted are skipped.
+
+        Replaceable events go through an upsert that keeps the row of the previous version, so its tag values are
+        replaced too. A stale version changes nothing.
+        """
+        if not events:
+            return set()
+
+        ids = [event.id for event in events]
+        existing = set()
+        # an event dated too far ahead for a partition is kept in `event` until it can have one
+        for stored in {"event", table}:
+            existing.update(
+                row[0]
+                for row in await tx.fetchall(f'SELECT "id" FROM "{stored}" WHERE "id" IN ({placeholders(ids)})', ids)
+            )
+        deleted = set(
+            await tx.fetchall(
+                f'SELECT "event_id", "pubkey" FROM "tombstone" WHERE "event_id" IN ({placeholders(ids)})', ids
+            )
+        )
+        fresh = {}
+        for event in events:
+            if event.id not in existing and (event.id, event.pubkey) not in deleted:
+                fresh.setdefault(event.id, event)
+        if not fresh:
+            return set()
+        events = list(fresh.values())
+
+        rows = {False: [], True: []}
+        for event in events:
+            rows[is_replaceable(event.kind)].append(
+                (
+                    event.id,
+                    event.kind,
+                    event.content,
+                    event.created_at,
+                    dump_json(event.tags),
+                    event.pubkey,
+                    event.sig,
+                    event.payload(),
+                )
+            )
+        if rows[False]:
+            await tx.executemany(f"{INSERT.format(table=table)} ON CONFLICT DO NOTHING", rows[False])
+        if rows[True]:
+            await tx.executemany(UPSERT, rows[True])
+
+        ids = list(fresh)
+        table_ids = dict(
+            await tx.fetchall(f'SELECT "id", "table_id" FROM "{table}" WHERE "id" IN ({placeholders(ids)})', ids)
+        )
+        replaced = [table_ids[event.id] for event in events if is_replaceable(event.kind) and event.id in table_ids]
+        if replaced:
+            await tx.execute(f'DELETE FROM "{tags}" WHERE "event_id" IN ({placeholders(replaced)})', replaced)
+        values = [
+            (table_ids[event.id], name, value)
+            for event in events
+            if event.id in table_ids
+            for name in INDEXED_TAGS
+            for value in event.tag_values.get(name, ())
+        ]
+        if values:
+            await tx.executemany(f'INSERT INTO "{tags}" ("event_id", "name", "value") VALUES (?, ?, ?)', values)
+        # the triggers count replaceable events, which may have taken over the row of a previous version
+        await Storage._count(
+            tx, [event for event in events if event.id in table_ids and not is_replaceable(event.kind)]
+        )
+        return set(table_ids)
+
+    @staticmethod
+    async def _count(tx: Transaction, events: List[CompactEvent]):
+        """Add newly inserted events to the counts, each key is updated once per batch"""
+        kinds, authors, tag_values = Counter(), Counter(), Counter()
+        for event in events:
+            kinds[(event.kind,)] += 1
+            authors[event.pubkey, event.kind] += 1
+            for name in INDEXED_TAGS:
+                for value in event.tag_values.get(name, ()):
+                    tag_values[name, value, event.kind] += 1
+        for statement, counter in zip(COUNT_UPSERTS, (kinds, authors, tag_values)):
+            if counter:
+                await tx.executemany(statement, [(*key, count) for key, count in counter.items()])
+
+    async def latest_events(self, authors: Sequence[str], kinds: Sequence[int]) -> List[Tuple[str, int, int, str, str]]:
+        """The current version of replaceable events.
+
+        Args:
+            authors (Sequence[str]): The pubkeys
+            kinds (Sequence[int]): The replaceable kinds
+
+        Returns:
+            List[Tuple[str, int, int, str, str]]: The pubkey, kind, created_at, id and JSON of each stored version
+        """
+        async with self.reader() as tx:
+            return await tx.fetchall(
+                'SELECT "pubkey", "kind", "created_at", "id", "raw" FROM "event" '
+                f'WHERE "pubkey" IN ({placeholders(authors)}) AND "kind" IN ({placeholders(kinds)})',
+                [*authors, *kinds],
+            )
+
+    async def tombstones(self) -> List[Tuple[str, str]]:
+        """Every recorded deletion
+
+        Returns:
+            List[Tuple[str, str]]: The deleted event id and the pubkey that deleted it
+        """
+        async with self.reader() as tx:
+            return await tx.fetchall('SELECT "event_id", "pubkey" FROM "tombstone"')
+
+    async def stream_events(self, filters: Filters, limit: int, page_size: int) -> AsyncIterator[Tuple[str, str]]:
+        """The events matching the filters, newest events first, fetched a page at a time.
+
+        Pages are keyed on (created_at, id) rather than offsets, so with at most one author and one kind every page
+        is a range of one of the `EVENT_INDEXES`, and at most `page_size` events are held in memory per table no matter
+        the limit. Several authors or kinds are a range per value, sorted together. Only the stored JSON is read. A reader is
+        only held while a page is fetched.
+
+        Partitions are merged in, newest first: one is only queried once the events already found aren't newer than
+        anything it could hold, so a limit reached in the recent partitions never touches the older ones. Expired
+        events that weren't removed yet are left out.
+
+        Args:
+            filters (Filters): The filters of the REQ
+            limit (int): Max number of events to return
+            page_size (int): Number of events fetched per query
+
+        Yields:
+            Tuple[str, str]: The id and the JSON of each matching event
+        """
+        now = int(time.time())
+        async with self.reader() as tx:
+            partitions = [
+                partition
+                for partition in await self._partitions(tx)
+                if partition.overlaps(filters) and not partition.expired(now)
+            ]
+
+        if not partitions:
+            async for _, event_id, raw in self._stream_table(filters, limit, page_size, now):
+                yield event_id, raw
+            return
+
+        partitions.sort(key=lambda partition: partition.end, reverse=True)
+        # the next event of each table being read, newest first
+        heads: List[Tuple[Tuple[int, str], int, Tuple[int, str, str], AsyncIterator]] = []
+
+        async def read(table: str, tags: str):
+            stream = self._stream_table(filters, limit, page_size, now, table=table, tags=tags)
+            await advance(stream)
+
+        async def advance(stream: AsyncIterator):
+            head = await anext(stream, None)
+            if head is not None:
+                created_at, event_id, _ = head
+                heapq.heappush(heads, ((-created_at, event_id.translate(DESCENDING)), id(stream), head, stream))
+
+        await read("event", "event_tag")
+        try:
+            while limit > 0:
+                while partitions and (not heads or partitions[0].end > heads[0][2][0]):
+                    partition = partitions.pop(0)
+                    await read(partition.table, partition.tags)
+                if not heads:
+                    return
+                _, _, (_, event_id, raw), stream = heapq.heappop(heads)
+                yield event_id, raw
+                limit -= 1
+                await advance(stream)
+        finally:
+            for *_, stream in heads:
+                await stream.aclose()
+
+    async def _stream_table(
+        self,
+        filters: Filters,
+        limit: int,
+        page_size: int,
+        now: int,
+        table: str = "event",
+        tags: str = "event_tag",
+    ) -> AsyncIterator[Tuple[int, str, str]]:
+        """The matching events of one table, newest first, see `stream_events`"""
+        where, params = filter_query(filters, tags=tags)
+        where += ' AND NOT EXISTS (SELECT 1 FROM "expiration" WHERE "event_id" = "id" AND "expires_at" <= ?)'
+        params.append(now)
+        last = None
+        while limit > 0:
+            size = min(page_size, limit)
+            sql = f'SELECT "created_at", "id", "raw" FROM "{table}" WHERE {where}'
+            page_params = list(params)
+            if last is not None:
+                # a row value bounds the index range the page is read from
+                sql += ' AND ("created_at", "id") < (?, ?)'
+                page_params.extend(last)
+            sql += ' ORDER BY "created_at" DESC, "id" DESC LIMIT ?'
+            page_params.append(size)
+
+            async with self.reader() as tx:
+                page = await tx.fetchall(sql, page_params)
+            for row in page:
+                yield row
+
+            if len(page) < size:
+                return
+            limit -= len(page)
+            last = page[-1][:2]
+
+    async def aggregate_count(self, filters: Filters) -> Optional[int]:
+        """Count the events matching the filters from the maintained counts, for the shapes they cover: kinds alone,
+        full authors with or without kinds, and a single #e or #p value with or without kinds.
+
+        Expired events still count until compaction removed them.
+
+        Args:
+            filters (Filters): The filters of the COUNT
+
+        Returns:
+            Optional[int]: The count, None if the filters have another shape
+        """
+        if filters.ids or filters.since is not None or filters.until is not None:
+            return None
+        tags = [(name, values) for name, values in (("e", filters.event_ids), ("p", filters.pubkeys)) if values]
+
+        if tags:
+            # an event tagging several of the values would be counted for each
+            if filters.authors or len(tags) > 1 or len(set(tags[0][1])) > 1:
+                return None
+            name, values = tags[0]
+            sql, params = 'SELECT sum("count") FROM "tag_count" WHERE "name" = ? AND "value" = ?', [name, values[0]]
+        elif filters.authors:
+            if any(is_prefix(author) for author in filters.authors):
+                return None
+            authors = list(set(filters.authors))
+            sql = f'SELECT sum("count") FROM "author_count" WHERE "pubkey" IN ({placeholders(authors)})'
+            params = authors
+        else:
+            sql, params = 'SELECT sum("count") FROM "kind_count" WHERE 1', []
+        if filters.kinds:
+            kinds = list(set(filters.kinds))
+            sql += f' AND "kind" IN ({placeholders(kinds)})'
+            params.extend(kinds)
+
+        async with self.reader() as tx:
+            (count,), *_ = await tx.fetchall(sql, params)
+        return count or 0
+
+    async def indexed_count(self, filters: Sequence[Filters], seconds: float) -> int:
+        """Count the events matching any of the filters with the indexes, giving up after a while
+
+        Args:
+            filters (Sequence[Filters]): The filters of the COUNT
+            seconds (float): How long the count may take
+
+        Raises:
+            TimeoutError: Counting took longer than `seconds`
+
+        Returns:
+            int: The count
+        """
+        deadline = time.monotonic() + seconds
+        now = int(time.time())
+        async with self.reader() as tx:
+            partitions = [
+                partition
+                for partition in await self._partitions(tx)
+                if any(partition.overlaps(f) for f in filters) and not partition.expired(now)
+            ]
+
+        count = 0
+        for table, tags in (("event", "event_tag"), *((partition.table, partition.tags) for partition in partitions)):
+            clauses, params = [], []
+            for f in filters:
+                where, values = filter_query(f, tags=tags)
+                clauses.append(f"({where})")
+                params.extend(values)
+            sql = (
+                f'SELECT count(*) FROM "{table}" WHERE ({" OR ".join(clauses)}) '
+                'AND NOT EXISTS (SELECT 1 FROM "expiration" WHERE "event_id" = "id" AND "expires_at" <= ?)'
+            )
+            async with self.reader() as tx:
+                (counted,), *_ = await tx.fetchall_before(sql, [*params, now], deadline)
+            count += counted
+        return count
+
+    async def drop_partitions(self, now: int) -> List[Partition]:
+        """Drop the partitions whose events have all expired, one transaction each
+
+        Args:
+            now (int): Current unix time
+
+        Returns:
+            List[Partition]: The dropped partitions
+        """
+        async with self.reader() as tx:
+            expired = [partition for partition in await self._partitions(tx) if partition.expired(now)]
+        for partition in expired:
+            async with self.transaction() as tx:
+                for statement in subtract_counts(partition.table):
+                    await tx.execute(statement)
+                await tx.execute(f'DROP TABLE IF EXISTS "{partition.tags}"')
+                await tx.execute(f'DROP TABLE IF EXISTS "{partition.table}"')
+                await tx.execute(
+                    'DELETE FROM "event_partition" WHERE "age" = ? AND "start" = ?', [partition.age, partition.start]
+                )
+        return expired
+
+    def _aged(self, now: int) -> Iterator[Tuple[str, List[Any]]]:
+        # conditions on `event` rows past their kind's max age: stored before it applied, or dated too far ahead for a
+        # partition at the time
+        for kind, age in self.retention.ages.items():
+            if age and not is_replaceable(kind):
+                yield '"kind" = ? AND "created_at" <= ?', [kind, now - age]
+        if self.retention.default:
+            kinds = list(self.retention.ages)
+            yield (
+                f'"kind" NOT IN ({placeholders(kinds)}) AND NOT {REPLACEABLE} AND "created_at" <= ?',
+                [*kinds, now - self.retention.default],
+            )
+
+    async def delete_expired(self, now: int, batch: int) -> List[Tuple[str, str]]:
+        """Delete a batch of expired events that aren't in a partition of their own: those with a NIP-40 expiration
+        tag and rows of `event` past their kind's max age
+
+        Args:
+            now (int): Current unix time
+            batch (int): Most events to delete
+
+        Returns:
+            List[Tuple[str, str]]: The id and pubkey of each deleted event, empty once there is nothing left
+        """
+        deleted = []
+        async with self.transaction() as tx:
+            ids = [
+                row[0]
+                for row in await tx.fetchall(
+                    'SELECT "event_id" FROM "expiration" WHERE "expires_at" <= ? LIMIT ?', [now, batch]
+                )
+            ]
+            if ids:
+                for table in await self._tables(tx):
+                    deleted.extend(
+                        await tx.fetchall(
+                            f'SELECT "id", "pubkey" FROM "{table}" WHERE "id" IN ({placeholders(ids)})', ids
+                        )
+                    )
+                    await tx.execute(f'DELETE FROM "{table}" WHERE "id" IN ({placeholders(ids)})', ids)
+                await tx.execute(f'DELETE FROM "expiration" WHERE "event_id" IN ({placeholders(ids)})', ids)
+
+            for where, params in self._aged(now):
+                if len(deleted) >= batch:
+                    break
+                rows = await tx.fetchall(
+                    f'SELECT "table_id", "id", "pubkey" FROM "event" WHERE {where} LIMIT ?',
+                    [*params, batch - len(deleted)],
+                )
+                if rows:
+                    table_ids = [row[0] for row in rows]
+                    await tx.execute(f'DELETE FROM "event" WHERE "table_id" IN ({placeholders(table_ids)})', table_ids)
+                    deleted.extend(row[1:] for row in rows)
+        return deleted
+
+
+class _SqliteTransaction(Transaction):
+    def __init__(self, connection: aiosqlite.Connection):
+        self.connection = connection
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()):
+        await self.connection.execute(sql, params)
+
+    async def executemany(self, sql: str, rows: Sequence[Sequence[Any]]):
+        await self.connection.executemany(sql, rows)
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        return list(await self.connection.execute_fetchall(sql, params))
+
+    async def fetchall_before(self, sql: str, params: Sequence[Any], deadline: float) -> List[tuple]:
+        return await fetchall_before(self.connection, sql, params, deadline)
+
+
+class SqliteStorage(Storage):
+    """SQLite tuned for the relay: WAL journaling, one dedicated writer connection and a pool of read-only reader
+    connections, so replays never queue behind writes. Each connection runs on its own thread and keeps its prepared
+    statements cached.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        readers: int = None,
+        durability: Durability = None,
+        mmap_size: int = None,
+        cache_size: int = None,
+        statement_cache: int = None,
+        retention: Retention = None,
+    ):
+        self.path = path or settings.db_path
+        self.readers = readers or settings.sqlite_readers
+        self.durability = durability or settings.durability
+        self.mmap_size = settings.sqlite_mmap_size if mmap_size is None else mmap_size
+        self.cache_size = settings.sqlite_cache_size if cache_size is None else cache_size
+        self.statement_cache = statement_cache or settings.sqlite_statement_cache
+        self.retention = retention or Retention()
+
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: Optional[asyncio.Queue[aiosqlite.Connection]] = None
+
+    async def _connect(self, read_only: bool) -> aiosqlite.Connection:
+        database = f"file:{self.path}?mode=ro" if read_only else f"file:{self.path}"
+        connection = await aiosqlite.connect(
+            database, uri=True, isolation_level=None, cached_statements=self.statement_cache
+        )
+        for pragma, value in (
+            ("busy_timeout", 5000),
+            ("mmap_size", self.mmap_size),
+            ("cache_size", self.cache_size),
+            ("foreign_keys", "ON"),
+        ):
+            await connection.execute(f"PRAGMA {pragma}={value}")
+        return connection
+
+    async def open(self):
+        self._writer = await self._connect(read_only=False)
+        # only takes on a new database, before its first table is created
+        await self._writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await self._writer.execute("PRAGMA journal_mode=WAL")
+        await self._writer.execute(f"PRAGMA synchronous={self.durability.value}")
+        await self.create_schema()
+
+        self._readers = asyncio.Queue()
+        for _ in range(self.readers):
+            self._readers.put_nowait(await self._connect(read_only=True))
+
+    async def close(self):
+        if self._readers is not None:
+            while not self._readers.empty():
+                await self._readers.get_nowait().close()
+            self._readers = None
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Transaction]:
+        async with self._write_lock:
+            await self._writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield _SqliteTransaction(self._writer)
+            except BaseException:
+                await self._writer.execute("ROLLBACK")
+                raise
+            await self._writer.execute("COMMIT")
+
+    async def vacuum(self, pages: int) -> int:
+        async with self._write_lock:
+            (before,) = await self._writer.execute_fetchall("PRAGMA freelist_count")
+            # a statement only frees one page per step, a script runs it to the end
+            await self._writer.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+            (after,) = await self._writer.execute_fetchall("PRAGMA freelist_count")
+        return before[0] - after[0]
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[Transaction]:
+        connection = await self._readers.get()
+        try:
+            yield _SqliteTransaction(connection)
+        finally:
+            self._readers.put_nowait(connection)
+
+
+class _TortoiseTransaction(Transaction):
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def execute(self, sql: str, params: Sequence[Any] = ()):
+        await self.connection.execute_query(sql, list(params))
+
+    async def executemany(self, sql: str, rows: Sequence[Sequence[Any]]):
+        await self.connection.execute_many(sql, [list(row) for row in rows])
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        _, rows = await self.connection.execute_query(sql, list(params))
+        return [tuple(row) for row in rows]
+
+    async def fetchall_before(self, sql: str, params: Sequence[Any], deadline: float) -> List[tuple]:
+        # the connection is shared, the progress handler must not outlive this query
+        async with self.connection.acquire_connection() as connection:
+            return await fetchall_before(connection, sql, params, deadline)
+
+
+class TortoiseStorage(Storage):
+    """Fallback backend running everything over Tortoise's single connection, which also makes the
+    `database` models usable
+    """
+
+    def __init__(self, path: str = None, durability: Durability = None, retention: Retention = None):
+        self.path = path or settings.db_path
+        self.durability = durability or settings.durability
+        self.retention = retention or Retention()
+
+    async def open(self):
+        await Tortoise.init(
+            # workers share the database file, wait for each other's write locks instead of failing
+            db_url=f"sqlite://{self.path}?synchronous={self.durability.value}&busy_timeout=5000",
+            modules={"models": ["ekiden.database"]},
+        )
+        connection = Tortoise.get_connection("default")
+        _, tables = await connection.execute_query('SELECT count(*) FROM "sqlite_master"')
+        if not tables[0][0]:
+            # the connection switched to WAL already, which fixes the setting until the database is rebuilt
+            await connection.execute_script("PRAGMA auto_vacuum=INCREMENTAL; VACUUM")
+        await self.create_schema()
+
+    async def close(self):
+        await Tortoise.close_connections()
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[Transaction]:
+        async with in_transaction() as connection:
+            yield _TortoiseTransaction(connection)
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[Transaction]:
+        yield _TortoiseTransaction(Tortoise.get_connection("default"))
+
+    async def vacuum(self, pages: int) -> int:
+        connection = Tortoise.get_connection("default")
+        _, before = await connection.execute_query("PRAGMA freelist_count")
+        await connection.execute_script(f"PRAGMA incremental_vacuum({int(pages)})")
+        _, after = await connection.execute_query("PRAGMA freelist_count")
+        return before[0][0] - after[0][0]
+
+
+def create_storage(backend: StorageBackend = None) -> Storage:
+    match backend or settings.storage:
+        case StorageBackend.tortoise:
+            return TortoiseStorage()
+        case _:
+            return SqliteStorage()
@@ -1,10 +1,22 @@
 import asyncio
-from typing import MutableSet, Optional
-
-from starlette.websockets import WebSocket
+from collections import Counter, defaultdict
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 from ekiden import logger
-from ekiden.nips import ETag, Event, Filters, PTag, dump_json
+from ekiden.connections import Connection
+from ekiden.nips import CompactEvent, Filters, event_message, is_prefix
 
 
 def validate_scalar(candidates, subject) -> bool:
@@ -17,16 +29,24 @@ def validate_scalar(candidates, subject) -> bool:
     return True if subject in candidates else False
 
 
+def validate_prefix(candidates, subject) -> bool:
+    """
+    For ids and authors, the attribute from the event must start with one of the values in the filter list
+    """
+    if len(candidates) == 0:
+        return True
+
+    return any(subject.startswith(candidate) for candidate in candidates)
+
+
 def validate_multiple(candidates, subjects) -> bool:
     """
     For tag attributes such as #e, where an event may have multiple values, the event and filter condition values must have at least one item in common.
     """
-    a = set(candidates)
-    b = set(subjects)
-    if len(a) == 0:
+    if len(candidates) == 0:
         return True
 
-    return len(a.intersection(b)) > 0
+    return not frozenset(subjects).isdisjoint(candidates)
 
 
 def validate_since(candidate, subject) -> bool:
@@ -43,22 +63,22 @@ def validate_until(candidate, subject) -> bool:
     return subject < candidate
 
 
-def validate_filters(event: Event, filters: Filters) -> bool:
+def validate_filters(event: CompactEvent, filters: Filters) -> bool:
     """Given a event, validate the filters on it.
 
     Args:
-        event (Event): The event under question
+        event (CompactEvent): The event under question
         filters (Filters): The filter to validate
 
     Returns:
         bool: True if the event passes the filters, else False.
     """
     if (
-        validate_scalar(filters.ids, event.id)
-        and validate_scalar(filters.authors, event.pubkey)
+        validate_prefix(filters.ids, event.id)
+        and validate_prefix(filters.authors, event.pubkey)
         and validate_scalar(filters.kinds, event.kind)
-        and validate_multiple(filters.event_ids, [tag.id for tag in event.tags if isinstance(tag, ETag)])
-        and validate_multiple(filters.pubkeys, [tag.pubkey for tag in event.tags if isinstance(tag, PTag)])
+        and validate_multiple(filters.event_ids, event.e_tags)
+        and validate_multiple(filters.pubkeys, event.p_tags)
         and validate_since(filters.since, event.created_at)
         and validate_until(filters.until, event.created_at)
     ):
@@ -66,71 +86,315 @@ def validate_filters(event: Event, filters: Filters) -> bool:
     return False
 
 
+class CompiledFilters(NamedTuple):
+    """A filter reduced to frozensets and bounds, compiled once when the REQ comes in.
+
+    Equal filters compile to equal, hashable values whatever the order or repetition of their values, so the pool
+    keeps one entry per distinct filter and evaluates it once per event for all of its subscriptions. The limit only
+    matters to the replay and is left out.
+    """
+
+    ids: FrozenSet[str]
+    id_prefixes: Tuple[str, ...]
+    authors: FrozenSet[str]
+    author_prefixes: Tuple[str, ...]
+    kinds: FrozenSet[int]
+    event_ids: FrozenSet[str]
+    pubkeys: FrozenSet[str]
+    since: Optional[int]
+    until: Optional[int]
+
+    @classmethod
+    def compile(cls, filters: Filters) -> "CompiledFilters":
+        ids, authors = filters.ids or (), filters.authors or ()
+        return cls(
+            ids=frozenset(value for value in ids if not is_prefix(value)),
+            id_prefixes=tuple(sorted({value for value in ids if is_prefix(value)})),
+            authors=frozenset(value for value in authors if not is_prefix(value)),
+            author_prefixes=tuple(sorted({value for value in authors if is_prefix(value)})),
+            kinds=frozenset(filters.kinds or ()),
+            event_ids=frozenset(filters.event_ids or ()),
+            pubkeys=frozenset(filters.pubkeys or ()),
+            since=filters.since,
+            until=filters.until,
+        )
+
+    def matches(self, event: CompactEvent) -> bool:
+        """Same as `validate_filters` on the filter this was compiled from"""
+        if self.kinds and event.kind not in self.kinds:
+            return False
+        if (self.ids or self.id_prefixes) and not (event.id in self.ids or event.id.startswith(self.id_prefixes)):
+            return False
+        if (self.authors or self.author_prefixes) and not (
+            event.pubkey in self.authors or event.pubkey.startswith(self.author_prefixes)
+        ):
+            return False
+        if self.event_ids and self.event_ids.isdisjoint(event.e_tags):
+            return False
+        if self.pubkeys and self.pubkeys.isdisjoint(event.p_tags):
+            return False
+        if self.since is not None and event.created_at <= self.since:
+            return False
+        if self.until is not None and event.created_at >= self.until:
+            return False
+        return True
+
+
 class Subscription:
-    def __init__(self, filters: Filters, websocket: WebSocket, subscription_id: str):
-        self.filters = filters
-        self.websocket = websocket
+    def __init__(self, filters: Sequence[Filters], connection: Connection, subscription_id: str):
+        # an event only has to pass one of the filters
+        self.filters = list(filters)
+        self.compiled = frozenset(CompiledFilters.compile(filters) for filters in self.filters)
+        self.connection = connection
         self.subscription_id = subscription_id
+        self.replay: Optional[asyncio.Task] = None
+
+    def cancel_replay(self):
+        if self.replay is not None and not self.replay.done():
+            self.replay.cancel()
+
+    def matches(self, event: CompactEvent) -> bool:
+        return any(compiled.matches(event) for compiled in self.compiled)
+
+    async def send(self, event: CompactEvent, block: bool = False):
+        """Queue the event on the connection, it is up to the caller to check it matches.
+
+        Args:
+            event (CompactEvent): The event to send
+            block (bool): Wait for room in the send queue instead of applying the full queue policy
+        """
+        frame = event_message(self.subscription_id, event)
+        if block:
+            await self.connection.put(frame)
+        else:
+            await self.connection.send(frame)
 
-    async def send(self, event: Event):
-        if validate_filters(event, self.filters):
-            await self.websocket.send_text(dump_json(["EVENT", self.subscription_id, event.dict()]))
+
+def index_key(compiled: CompiledFilters) -> Optional[Tuple[str, List[Any]]]:
+    """Pick the filter attribute a compiled filter is indexed under.
+
+    A filter only matches when every condition it sets passes, so any single condition is enough to narrow the
+    candidates down. The most selective attribute that is set is used; filters without any of them match everything.
+
+    Args:
+        compiled (CompiledFilters): The filter to index
+
+    Returns:
+        Optional[Tuple[str, List[Any]]]: The index name and the values to index under, None if the filter matches all
+    """
+    for name, values in (
+        ("ids", compiled.ids.union(compiled.id_prefixes)),
+        ("authors", compiled.authors.union(compiled.author_prefixes)),
+        ("#e", compiled.event_ids),
+        ("#p", compiled.pubkeys),
+        ("kinds", compiled.kinds),
+    ):
+        if values:
+            return name, list(values)
+
+    return None
+
+
+# indexes whose values may be prefixes of the event's attribute
+PREFIX_INDEXES = ("ids", "authors")
 
 
 class SubscriptionPool:
-    def __init__(self) -> None:
-        self._subscriptions: MutableSet[Subscription] = set()
-        self._access_lock = asyncio.Lock()
+    """The live subscriptions, registered per connection and subscription id.
 
-    async def get_subscription(self, websocket: WebSocket) -> Optional[Subscription]:
-        """Retrieve a subscription from the pool with the matching websocket.
+    None of the bookkeeping awaits, so every operation is atomic on the event loop and needs no lock.
+    """
+
+    def __init__(self) -> None:
+        self._connections: Dict[Connection, Dict[str, Subscription]] = {}
+        self._count = 0
+
+        # the distinct filters of all subscriptions, each with the subscriptions sharing it
+        self._subscribers: Dict[CompiledFilters, Set[Subscription]] = {}
+        # inverted indexes: attribute -> value -> filters interested in that value
+        self._index: Dict[str, Dict[Any, Set[CompiledFilters]]] = {
+            name: defaultdict(set) for name in ("ids", "authors", "#e", "#p", "kinds")
+        }
+        self._match_all: Set[CompiledFilters] = set()
+        # lengths of the values in the prefix matched indexes, an event is looked up under each of its prefixes of
+        # these lengths so a lookup costs at most one probe per distinct length no matter how many prefixes there are
+        self._lengths: Dict[str, Counter] = {name: Counter() for name in PREFIX_INDEXES}
+
+    def __len__(self) -> int:
+        return self._count
+
+    def subscriptions(self) -> Iterator[Subscription]:
+        for subscriptions in self._connections.values():
+            yield from subscriptions.values()
+
+    def distinct_filters(self) -> int:
+        """Number of distinct filters across all subscriptions"""
+        return len(self._subscribers)
+
+    def count(self, connection: Connection) -> int:
+        """Number of subscriptions the connection has open"""
+        return len(self._connections.get(connection, ()))
+
+    def get_subscription(self, connection: Connection, subscription_id: str) -> Optional[Subscription]:
+        """Retrieve a subscription of the connection.
 
         Args:
-            websocket (WebSocket): The websocket to match
+            connection (Connection): The connection that opened the subscription
+            subscription_id (str): The id the client gave the subscription
 
         Returns:
             Optional[Subscription]: The matching subscription if found, else None.
         """
-        async with self._access_lock:
-            for subscription in self._subscriptions:
-                if subscription.websocket == websocket:
-                    return subscription
-
-            return None
+        return self._connections.get(connection, {}).get(subscription_id)
 
-    async def add_subscription(self, subscription: Subscription):
-        """Add a new subscription to the pool
+    def add_subscription(self, subscription: Subscription):
+        """Add a new subscription to the pool, replacing the connection's subscription with the same id
 
         Args:
             subscription (Subscription): The subscription to add
         """
-        async with self._access_lock:
-            self._subscriptions.add(subscription)
+        if previous := self.get_subscription(subscription.connection, subscription.subscription_id):
+            self._remove(previous)
+        self._add(subscription)
 
-    async def remove_subscription(self, subscription: Subscription):
-        """Remove the subscription from the pool
+    def remove_subscription(self, connection: Connection, subscription_id: str):
+        """Remove a subscription of the connection from the pool
 
         Args:
-            subscription (Subscription): The subscription to remove
+            connection (Connection): The connection that opened the subscription
+            subscription_id (str): The id the client gave the subscription
         """
-        logger.info(f"Removing subscription: {subscription.subscription_id}")
-        async with self._access_lock:
-            self._subscriptions.discard(subscription)
+        if subscription := self.get_subscription(connection, subscription_id):
+            logger.info(f"Removing subscription: {subscription_id}")
+            self._remove(subscription)
 
-    async def broadcast(self, event: Event):
-        """Broadcasts the event to all subscribers.
-        The subscriber will only receive the message if the event passes the filters.
+    def remove_connection(self, connection: Connection):
+        """Remove every subscription of the connection from the pool
+
+        Args:
+            connection (Connection): The connection that went away
+        """
+        for subscription in list(self._connections.get(connection, {}).values()):
+            self._remove(subscription)
+
+    def _add(self, subscription: Subscription):
+        self._connections.setdefault(subscription.connection, {})[subscription.subscription_id] = subscription
+        self._count += 1
+        for compiled in subscription.compiled:
+            subscribers = self._subscribers.get(compiled)
+            if subscribers is None:
+                subscribers = self._subscribers[compiled] = set()
+                self._index_filters(compiled)
+            subscribers.add(subscription)
+
+    def _remove(self, subscription: Subscription):
+        subscriptions = self._connections.get(subscription.connection)
+        if not subscriptions or subscriptions.get(subscription.subscription_id) is not subscription:
+            return
+
+        del subscriptions[subscription.subscription_id]
+        if not subscriptions:
+            del self._connections[subscription.connection]
+        self._count -= 1
+        subscription.cancel_replay()
+
+        for compiled in subscription.compiled:
+            subscribers = self._subscribers.get(compiled)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[compiled]
+                self._unindex_filters(compiled)
+
+    def _index_filters(self, compiled: CompiledFilters):
+        if key := index_key(compiled):
+            name, values = key
+            for value in values:
+                self._index[name][value].add(compiled)
+                if name in PREFIX_INDEXES:
+                    self._lengths[name][len(value)] += 1
+        else:
+            self._match_all.add(compiled)
+
+    def _unindex_filters(self, compiled: CompiledFilters):
+        if key := index_key(compiled):
+            name, values = key
+            index = self._index[name]
+            for value in values:
+                bucket = index[value]
+                bucket.discard(compiled)
+                if not bucket:
+                    del index[value]
+                if name in PREFIX_INDEXES:
+                    lengths = self._lengths[name]
+                    lengths[len(value)] -= 1
+                    if not lengths[len(value)]:
+                        del lengths[len(value)]
+        else:
+            self._match_all.discard(compiled)
+
+    def candidates(self, event: CompactEvent) -> Set[CompiledFilters]:
+        """Look up the distinct filters that could match the event.
+
+        Every returned filter still has to be evaluated, but filters that are not returned can never match.
 
         Args:
-            event (Event): The event to broadcast
+            event (CompactEvent): The event to look up
+
+        Returns:
+            Set[CompiledFilters]: The candidate filters
         """
-        _stale = []
+        candidates = set(self._match_all)
+
+        def collect(name: str, values: Iterable[Any]):
+            index = self._index[name]
+            if not index:
+                return
+            for value in values:
+                if bucket := index.get(value):
+                    candidates.update(bucket)
+
+        collect("ids", [event.id[:length] for length in self._lengths["ids"]])
+        collect("authors", [event.pubkey[:length] for length in self._lengths["authors"]])
+        collect("kinds", (event.kind,))
+        collect("#e", event.e_tags)
+        collect("#p", event.p_tags)
+        return candidates
+
+    def matching(self, event: CompactEvent) -> Set[Subscription]:
+        """The subscriptions the event passes a filter of, each distinct filter is evaluated once
 
-        async with self._access_lock:
-            for subscription in self._subscriptions:
-                try:
-                    await subscription.send(event)
-                except RuntimeError:
-                    _stale.append(subscription)
+        Args:
+            event (CompactEvent): The event
 
-            [await self.remove_subscription(subscription) for subscription in _stale]
+        Returns:
+            Set[Subscription]: The subscriptions to send the event to
+        """
+        matching = set()
+        for compiled in self.candidates(event):
+            if compiled.matches(event):
+                matching.update(self._subscribers[compiled])
+        return matching
+
+    async def broadcast(self, event: CompactEvent):
+        """Broadcasts the event to all subscribers.
+        The subscriber will only receive the message if the event passes the filters.
+        Frames are only queued on each connection, its writer task does the actual send.
+
+        Args:
+            event (CompactEvent): The event to broadcast
+        """
+        _stale = set()
+
+        for subscription in self.matching(event):
+            if subscription.connection in _stale:
+                continue
+            try:
+                await subscription.send(event)
+            except RuntimeError:
+                _stale.add(subscription.connection)
+
+        for connection in _stale:
+            logger.info("Removing subscriptions of closed connection")
+            self.remove_connection(connection)
@@ -0,0 +1,116 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional, Tuple, Union
+
+from ekiden.config import VerifyExecutor, settings
+from ekiden.keys import VerificationError
+from ekiden.nips import CompactEvent
+
+
+def verify_batch(batch: List[dict]) -> List[Union[CompactEvent, VerificationError]]:
+    """Verify a batch of events, runs inside the worker pool.
+
+    Args:
+        batch (List[dict]): The raw events
+
+    Returns:
+        List[Union[CompactEvent, VerificationError]]: The verified event, or the reason it failed, for each raw event
+    """
+    results = []
+    for event_data in batch:
+        try:
+            results.append(CompactEvent.verify(event_data))
+        except Exception as e:
+            results.append(VerificationError(str(e)))
+    return results
+
+
+class Verifier:
+    """Verifies event signatures off the event loop.
+
+    Events arriving within `window` seconds of each other are collected into a single batch and handed to a thread or
+    process pool, so the loop only awaits the results.
+    """
+
+    def __init__(
+        self,
+        executor: VerifyExecutor = None,
+        workers: int = None,
+        window: float = None,
+        batch_size: int = None,
+    ):
+        self.executor = executor or settings.verify_executor
+        self.workers = workers or settings.verify_workers
+        self.window = settings.verify_batch_window if window is None else window
+        self.batch_size = batch_size or settings.verify_batch_size
+
+        self._pool: Optional[Executor] = None
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None:
+            if self.executor == VerifyExecutor.process:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ekiden-verify")
+        return self._pool
+
+    async def verify(self, event_data: dict) -> CompactEvent:
+        """Verify the event, see `CompactEvent.verify`.
+
+        Args:
+            event_data (dict): The raw event
+
+        Raises:
+            VerificationError: The signature or the contents of the event are invalid
+
+        Returns:
+            CompactEvent: The verified event
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((event_data, future))
+
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        loop = asyncio.get_running_loop()
+        results = loop.run_in_executor(self._get_pool(), verify_batch, [event_data for event_data, _ in batch])
+        results.add_done_callback(partial(self._resolve, batch))
+
+    @staticmethod
+    def _resolve(batch: List[Tuple[dict, asyncio.Future]], results: asyncio.Future):
+        if results.cancelled() or results.exception():
+            error = results.exception() if not results.cancelled() else VerificationError("verification cancelled")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for (_, future), result in zip(batch, results.result()):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,57 @@
+"""
+Rate limits: token buckets refill at their rate up to their burst, and limiters keep a bounded set of them.
+"""
+from ekiden.admission import RateLimiter, TokenBucket
+
+
+def test_bucket_allows_a_burst_then_its_rate():
+    bucket = TokenBucket(rate=2, burst=3, now=0)
+    assert [bucket.take(now=0) for _ in range(4)] == [True, True, True, False]
+    assert not bucket.take(now=0.4)
+    assert bucket.take(now=0.5)
+    assert not bucket.take(now=0.5)
+
+
+def test_bucket_refills_up_to_its_burst():
+    bucket = TokenBucket(rate=10, burst=2, now=0)
+    assert bucket.take(2, now=0)
+    assert bucket.full(now=60)
+    assert bucket.take(2, now=60)
+    assert not bucket.take(now=60)
+
+
+def test_bucket_takes_nothing_when_refusing():
+    bucket = TokenBucket(rate=1, burst=3, now=0)
+    assert not bucket.take(4, now=0)
+    assert bucket.take(3, now=0)
+
+
+def test_ready_takes_no_tokens():
+    bucket = TokenBucket(rate=1, burst=1, now=0)
+    assert bucket.ready(now=0) and bucket.ready(now=0)
+    assert bucket.take(now=0)
+    assert not bucket.ready(now=0)
+
+
+def test_limiter_keeps_a_bucket_per_key():
+    limiter = RateLimiter(rate=0.001, burst=2, size=10)
+    assert limiter.take("a") and limiter.take("a")
+    assert not limiter.take("a")
+    assert not limiter.ready("a")
+    assert limiter.ready("b") and limiter.take("b")
+
+
+def test_limiter_without_rate_admits_everything():
+    limiter = RateLimiter(rate=0, burst=0, size=10)
+    assert all(limiter.take("a") for _ in range(100))
+    assert len(limiter) == 0
+
+
+def test_limiter_holds_at_most_size_buckets():
+    limiter = RateLimiter(rate=0.001, burst=1, size=2)
+    for key in "abc":
+        assert limiter.take(key)
+    assert len(limiter) == 2
+    # the least recently used bucket was forgotten, a new one starts out full
+    assert limiter.take("a")
+    assert not limiter.take("c")
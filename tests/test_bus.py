@@ -0,0 +1,188 @@
+"""
+The unix socket bus between workers: what reaches the other workers from when they start, who may send to them, and
+how a worker that could not keep up or was written behind learns about it.
+"""
+import asyncio
+import os
+import socket
+import stat
+import tempfile
+
+import pytest
+from test_relay import run, signed
+
+from ekiden import metrics
+from ekiden.bus import Bus, UnixSocketBus, default_path
+from ekiden.config import settings
+from ekiden.hot import HotEvents
+from ekiden.nips import CompactEvent
+
+
+@pytest.fixture
+def path():
+    # socket paths are limited to about a hundred characters, pytest's temporary directories can be longer
+    with tempfile.TemporaryDirectory(prefix="ekiden-") as directory:
+        yield os.path.join(directory, "bus")
+
+
+def dropped(reason: str) -> int:
+    for line in metrics.bus_dropped.render():
+        if f'reason="{reason}"' in line:
+            return int(line.split()[-1])
+    return 0
+
+
+class Peer:
+    """A worker's end of the bus, recording what it was delivered"""
+
+    def __init__(self, path: str, address: str):
+        self.bus = UnixSocketBus(path)
+        self.bus.address = os.path.join(path, address)
+        self.events = []
+        self.lost = 0
+
+    async def deliver(self, event: CompactEvent):
+        self.events.append(event.id)
+
+    def on_lost(self):
+        self.lost += 1
+
+    async def start(self) -> "Peer":
+        await self.bus.start(self.deliver, self.on_lost)
+        return self
+
+
+def notes(count: int) -> list:
+    return [CompactEvent.verify(signed(content=str(number))) for number in range(count)]
+
+
+def test_events_reach_the_other_workers_only(path):
+    async def main():
+        first, second = await Peer(path, "1.sock").start(), await Peer(path, "2.sock").start()
+        events = notes(3)
+        try:
+            for event in events:
+                await first.bus.publish(event)
+            await asyncio.sleep(0.05)
+        finally:
+            await first.bus.close()
+            await second.bus.close()
+        assert second.events == [event.id for event in events]
+        assert first.events == [] and second.lost == 0
+
+    asyncio.run(main())
+
+
+def test_directory_is_private(path):
+    async def main():
+        peer = await Peer(path, "1.sock").start()
+        info = os.lstat(path)
+        await peer.bus.close()
+        assert stat.S_IMODE(info.st_mode) == 0o700 and info.st_uid == os.getuid()
+
+    asyncio.run(main())
+
+
+def test_directory_others_can_enter_is_refused(path):
+    os.mkdir(path)
+    os.chmod(path, 0o777)
+    with pytest.raises(PermissionError):
+        asyncio.run(Peer(path, "1.sock").start())
+
+
+def test_default_directory_is_shared_by_the_workers_of_one_database(monkeypatch):
+    first = default_path()
+    assert str(os.getuid()) in os.path.basename(first)
+    monkeypatch.setattr(settings, "db_path", "other.sqlite3")
+    assert default_path() != first
+
+
+def test_messages_from_outside_the_directory_are_dropped(path):
+    async def main():
+        peer = await Peer(path, "1.sock").start()
+        event = notes(1)[0]
+        outsider = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        outsider.bind(os.path.join(os.path.dirname(path), "outsider.sock"))
+        before = dropped("unknown_sender")
+        try:
+            outsider.sendto(f"1 {event.payload()}".encode("utf-8"), peer.bus.address)
+            await asyncio.sleep(0.05)
+        finally:
+            outsider.close()
+            await peer.bus.close()
+        assert peer.events == []
+        assert dropped("unknown_sender") == before + 1
+
+    asyncio.run(main())
+
+
+def test_worker_that_falls_behind_learns_it_lost_events(path):
+    async def main():
+        first, second = await Peer(path, "1.sock").start(), await Peer(path, "2.sock").start()
+        events = notes(30)
+        before = dropped("peer_full")
+        try:
+            # the second worker's loop doesn't get to read its socket in between
+            for event in events[:-1]:
+                await first.bus.publish(event)
+            await asyncio.sleep(0.05)
+            await first.bus.publish(events[-1])
+            await asyncio.sleep(0.05)
+        finally:
+            await first.bus.close()
+            await second.bus.close()
+        assert dropped("peer_full") > before
+        assert len(second.events) < len(events) and second.events[-1] == events[-1].id
+        assert second.lost == 1
+
+    asyncio.run(main())
+
+
+def test_starting_worker_gets_events_right_away(path):
+    async def main():
+        first = await Peer(path, "1.sock").start()
+        events = notes(2)
+        # the first worker just listed the directory, before the second one was there
+        await first.bus.publish(events[0])
+        second = await Peer(path, "2.sock").start()
+        try:
+            await first.bus.publish(events[1])
+            await asyncio.sleep(0.05)
+        finally:
+            await first.bus.close()
+            await second.bus.close()
+        assert second.events == [events[1].id]
+
+    asyncio.run(main())
+
+
+def test_resync_reaches_the_other_workers(path):
+    async def main():
+        first, second = await Peer(path, "1.sock").start(), await Peer(path, "2.sock").start()
+        try:
+            await first.bus.resync()
+            await asyncio.sleep(0.05)
+        finally:
+            await first.bus.close()
+            await second.bus.close()
+        assert (first.lost, second.lost) == (0, 1)
+
+    asyncio.run(main())
+
+
+def test_relay_listens_before_warming_its_buffer(tmp_path):
+    class Recording(Bus):
+        def __init__(self, hot: HotEvents):
+            self.hot = hot
+            self.warmed_at_start = None
+
+        async def start(self, deliver, lost=None):
+            self.warmed_at_start = self.hot.warmed
+
+    async def scenario(storage, worker):
+        hot = HotEvents(size=10, age=0)
+        bus = Recording(hot)
+        await worker(hot=hot, bus=bus).relay.start()
+        assert bus.warmed_at_start is False and hot.warmed
+
+    run(scenario, tmp_path)
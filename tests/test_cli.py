@@ -0,0 +1,103 @@
+"""
+`ekiden import` and `ekiden export`: NDJSON goes in and comes back out unchanged, and importing applies the same
+duplicate, replaceable and deletion handling as publishing to the relay.
+"""
+import asyncio
+import io
+import json
+
+from test_relay import PUBKEY, signed
+from test_storage import run
+
+from ekiden import cli
+from ekiden.keys import PrivateKey
+from ekiden.nips import Filters, Kind
+from ekiden.storage import SqliteStorage
+
+
+def ndjson(events: list) -> bytes:
+    return b"".join(json.dumps(event).encode("utf-8") + b"\n" for event in events)
+
+
+async def imported(storage: SqliteStorage, data: bytes) -> cli.Importer:
+    importer = cli.Importer(storage, workers=1, batch_size=2)
+    await importer.run(io.BytesIO(data))
+    return importer
+
+
+async def exported(storage: SqliteStorage, filters: Filters = None) -> list:
+    output = io.BytesIO()
+    await cli.export_events(storage, filters or Filters(), output, page_size=2)
+    return [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_export_gives_back_what_was_imported(tmp_path):
+    events = [signed(content=f"note {number}", tags=[["p", PUBKEY]]) for number in range(5)]
+    events.append(signed(Kind.set_metadata, "profile"))
+    data = ndjson(events) + b"\n" + b"not json\n" + json.dumps({**events[0], "sig": "00" * 64}).encode("utf-8") + b"\n"
+    newest_first = sorted(events, key=lambda event: (event["created_at"], event["id"]), reverse=True)
+
+    dumped = io.BytesIO()
+
+    async def original(storage):
+        importer = await imported(storage, data)
+        assert (importer.stored, importer.invalid, importer.skipped) == (6, 2, 0)
+        assert await exported(storage) == newest_first
+        assert await exported(storage, Filters(kinds=[1], limit=2)) == newest_first[1:3]
+        await cli.export_events(storage, Filters(), dumped)
+
+    async def copy(storage):
+        # what was exported imports into another database as is
+        assert (await imported(storage, dumped.getvalue())).stored == 6
+        assert await exported(storage) == newest_first
+
+    run(original, str(tmp_path / "ekiden.sqlite3"))
+    run(copy, str(tmp_path / "copy.sqlite3"))
+
+
+def test_commands_read_and_write_files(tmp_path):
+    events = [signed(content=f"note {number}") for number in range(3)]
+    (tmp_path / "events.jsonl").write_bytes(ndjson(events))
+    path = str(tmp_path / "ekiden.sqlite3")
+
+    def command(*argv: str):
+        asyncio.run(cli.run(cli.parser().parse_args(argv), SqliteStorage(path=path, readers=1)))
+
+    command("import", str(tmp_path / "events.jsonl"), "--workers", "1")
+    command("export", "--filter", '{"limit": 2}', "--output", str(tmp_path / "newest.jsonl"))
+    lines = (tmp_path / "newest.jsonl").read_bytes().splitlines()
+    assert [json.loads(line)["id"] for line in lines] == [events[2]["id"], events[1]["id"]]
+
+
+def test_duplicates_are_skipped(tmp_path):
+    events = [signed(content=f"note {number}") for number in range(3)]
+
+    async def scenario(storage):
+        importer = await imported(storage, ndjson(events + events[:1]))
+        assert (importer.stored, importer.skipped) == (3, 1)
+        importer = await imported(storage, ndjson(events))
+        assert (importer.stored, importer.skipped) == (0, 3)
+        assert len(await exported(storage)) == 3
+
+    run(scenario, str(tmp_path / "ekiden.sqlite3"))
+
+
+def test_replaceable_and_deletion_semantics_apply(tmp_path):
+    old, new = signed(Kind.set_metadata, "old", created_at=100), signed(Kind.set_metadata, "new", created_at=200)
+    deleted, unseen = signed(content="deleted"), signed(content="deleted before it was ever stored")
+    deletion = signed(Kind.delete, tags=[["e", deleted["id"]], ["e", unseen["id"]]])
+    note = signed(content="note")
+    # someone else can't delete the author's events
+    forged = signed(Kind.delete, tags=[["e", note["id"]]], key=PrivateKey())
+
+    async def scenario(storage):
+        importer = await imported(storage, ndjson([new, old, deleted, deletion, note, forged]))
+        # the older version lost to the newer one
+        assert (importer.stored, importer.skipped) == (5, 1)
+        importer = await imported(storage, ndjson([old, deleted, unseen]))
+        assert (importer.stored, importer.skipped) == (0, 3)
+
+        ids = {event["id"] for event in await exported(storage)}
+        assert ids == {new["id"], deletion["id"], note["id"], forged["id"]}
+
+    run(scenario, str(tmp_path / "ekiden.sqlite3"))
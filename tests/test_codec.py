@@ -0,0 +1,142 @@
+"""
+Conformance of the JSON codecs: every backend must encode exactly like the standard library did before the codec layer
+existed, since event ids are hashed over that encoding.
+"""
+import hashlib
+import json
+import random
+
+import pytest
+
+from ekiden import codec
+from ekiden.config import JsonCodec
+from ekiden.keys import PrivateKey
+from ekiden.nips import CompactEvent, Event, create_tag, dump_json
+
+
+def reference(obj) -> str:
+    # the encoding ids have always been computed over
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def installed(name: JsonCodec) -> codec.Backend:
+    if name != JsonCodec.stdlib:
+        pytest.importorskip(name.value)
+    return codec.BACKENDS[name]()
+
+
+@pytest.fixture(params=[JsonCodec.orjson, JsonCodec.msgspec, JsonCodec.stdlib], ids=lambda name: name.value)
+def backend(request) -> codec.Backend:
+    return installed(request.param)
+
+
+STRINGS = [
+    "",
+    "hello, world",
+    '"quoted" \\backslash\\ /slash/',
+    "\b\f\n\r\t",
+    "\x00\x01\x1f",
+    "\x7f",  # DEL
+    "\x80\x85\x9f",  # C1 controls
+    "\xa0\xad",  # no-break space, soft hyphen
+    "\u2028\u2029",  # line and paragraph separators, escaped by some encoders
+    "\ufeff",  # byte order mark
+    "\ufffe\uffff",  # noncharacters
+    "\u200b\u200d\u200e\u200f",  # zero width and direction marks
+    "é",
+    "e\u0301",  # combining accent
+    "日本語のテキスト",
+    "مرحبا بالعالم",
+    "🎉",
+    "\U0001f469\u200d\U0001f469\u200d\U0001f467",  # joined emoji
+    "\U0001f1ef\U0001f1f5",  # flag
+    "\U0010ffff",  # last code point
+    "<script>alert('x')</script>&amp;",
+]
+
+INTEGERS = [0, 1, -1, 2**31 - 1, 2**31, 2**53, 2**53 + 1, 2**63 - 1, -(2**63), 2**64 - 1]
+
+
+@pytest.mark.parametrize("value", STRINGS)
+def test_strings(backend, value):
+    assert backend.dumps(value) == reference(value)
+    assert backend.dumps([value, {"k": value}]) == reference([value, {"k": value}])
+
+
+@pytest.mark.parametrize("code_point", range(0x00, 0xA0))
+def test_every_ascii_and_c1_character(backend, code_point):
+    value = f"a{chr(code_point)}b"
+    assert backend.dumps(value) == reference(value)
+
+
+@pytest.mark.parametrize("value", INTEGERS)
+def test_integers(backend, value):
+    assert backend.dumps([value]) == reference([value])
+
+
+def test_constants_and_nesting(backend):
+    value = [True, False, None, [], {}, [[]], [{"a": [1, "b", None]}]]
+    assert backend.dumps(value) == reference(value)
+
+
+def test_random_strings(backend):
+    rng = random.Random(1)
+    # weighted towards the ranges escaping decisions are made in, surrogates can't be encoded at all
+    ranges = [(0x00, 0x7F), (0x80, 0x7FF), (0x800, 0xD7FF), (0xE000, 0xFFFF), (0x10000, 0x10FFFF)]
+    for _ in range(2_000):
+        value = "".join(chr(rng.randint(*rng.choice(ranges))) for _ in range(rng.randint(0, 40)))
+        assert backend.dumps([value]) == reference([value])
+
+
+def test_probes_conform(backend):
+    assert codec.conforms(backend)
+
+
+def test_nonconforming_backend_is_rejected():
+    escaping = codec.Backend(JsonCodec.stdlib, json.loads, json.dumps, (ValueError,))
+    assert not codec.conforms(escaping)
+
+
+def test_dumps_falls_back_past_backend_limits():
+    # integers over 64 bits and lone surrogates are beyond orjson and msgspec
+    for value in ([2**64], [-(2**70)], ["\ud800"]):
+        assert codec.dumps(value) == reference(value)
+
+
+def test_loads_matches_stdlib(backend):
+    document = reference([0, "a" * 64, 1_700_000_000, 1, [["e", "é🎉"]], ' \x00"\\'])
+    assert backend.loads(document) == json.loads(document)
+    assert backend.loads(document.encode("utf-8")) == json.loads(document)
+
+
+@pytest.mark.parametrize("document", ["", "[", "not json", '{"a":}', b"\xff"])
+def test_loads_rejects_malformed(document):
+    with pytest.raises(ValueError):
+        codec.loads(document)
+
+
+def signed(content: str, tags=()) -> dict:
+    private_key = PrivateKey()
+    return Event(
+        pubkey=private_key.public_key_hex(),
+        kind=1,
+        content=content,
+        tags=[create_tag(list(tag)) for tag in tags],
+        created_at=1_700_000_000,
+    ).signed(private_key.hex())
+
+
+@pytest.mark.parametrize("content", STRINGS)
+def test_event_ids_are_unchanged(content):
+    event = signed(content, tags=[["e", "b" * 64, "wss://relay.example/é"], ["p", "c" * 64]])
+    canonical = reference([0, event["pubkey"], event["created_at"], event["kind"], event["tags"], event["content"]])
+
+    assert Event.serialize(event["pubkey"], event["created_at"], event["kind"], event["tags"], content) == canonical
+    assert event["id"] == hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    assert CompactEvent.verify(codec.loads(dump_json(event))).id == event["id"]
+
+
+def test_payload_round_trips():
+    event = signed('gm 🌅\n"nostr"', tags=[["p", "c" * 64]])
+    compact = CompactEvent.verify(codec.loads(reference(event)))
+    assert compact.payload() == reference(event)
@@ -0,0 +1,112 @@
+"""
+The send queue of a connection under each full queue policy: broadcast frames may be dropped or get the client
+disconnected, responses and replayed events are always delivered.
+"""
+import asyncio
+
+import pytest
+
+from ekiden.config import QueuePolicy
+from ekiden.connections import Connection, ConnectionClosedError
+
+
+class WebSocket:
+    """Stands in for a client that reads nothing until it is released"""
+
+    def __init__(self):
+        self.frames = []
+        self.released = asyncio.Event()
+        self.closed = False
+
+    async def send_text(self, data: str):
+        await self.released.wait()
+        self.frames.append(data)
+
+    async def close(self):
+        self.closed = True
+
+
+async def stalled(policy: QueuePolicy) -> Connection:
+    """A connection with a queue of three frames, stuck on writing the first one it was given"""
+    connection = Connection(WebSocket(), queue_size=3, policy=policy)
+    connection.start()
+    await connection.put("in flight")
+    await asyncio.sleep(0)
+    return connection
+
+
+async def drained(connection: Connection) -> list:
+    connection.websocket.released.set()
+    await asyncio.sleep(0.01)
+    await connection.close()
+    return connection.websocket.frames
+
+
+def test_drop_oldest_only_drops_broadcast_frames():
+    async def main():
+        connection = await stalled(QueuePolicy.drop_oldest)
+        await connection.put("OK")
+        await connection.send("event 1")
+        await connection.put("EOSE")
+        await connection.send("event 2")
+        await connection.send("event 3")
+        return await drained(connection)
+
+    assert asyncio.run(main()) == ["in flight", "OK", "EOSE", "event 3"]
+
+
+def test_drop_oldest_drops_the_new_frame_when_nothing_else_may_be():
+    async def main():
+        connection = await stalled(QueuePolicy.drop_oldest)
+        for frame in ("OK", "event 1", "EOSE"):
+            await connection.put(frame)
+        await connection.send("event 2")
+        return await drained(connection)
+
+    assert asyncio.run(main()) == ["in flight", "OK", "event 1", "EOSE"]
+
+
+def test_disconnect_closes_a_client_that_falls_behind():
+    async def main():
+        connection = await stalled(QueuePolicy.disconnect)
+        for number in range(3):
+            await connection.send(f"event {number}")
+        with pytest.raises(ConnectionClosedError):
+            await connection.send("event 3")
+        with pytest.raises(ConnectionClosedError):
+            await connection.put("OK")
+        connection.websocket.released.set()
+        await asyncio.sleep(0.01)
+        assert connection.closed and connection.websocket.closed
+        await connection.close()
+
+    asyncio.run(main())
+
+
+def test_block_waits_for_room():
+    async def main():
+        connection = await stalled(QueuePolicy.block)
+        for number in range(3):
+            await connection.send(f"event {number}")
+        blocked = asyncio.create_task(connection.send("event 3"))
+        await asyncio.sleep(0)
+        assert not blocked.done()
+        frames = await drained(connection)
+        assert blocked.done()
+        return frames
+
+    assert asyncio.run(main()) == ["in flight", "event 0", "event 1", "event 2", "event 3"]
+
+
+def test_frames_waiting_for_room_are_refused_once_the_connection_closes():
+    async def main():
+        connection = await stalled(QueuePolicy.block)
+        for number in range(3):
+            await connection.put(f"event {number}")
+        waiting = asyncio.create_task(connection.put("EOSE"))
+        await asyncio.sleep(0)
+        await connection.close()
+        with pytest.raises(ConnectionClosedError):
+            await waiting
+
+    asyncio.run(main())
@@ -0,0 +1,141 @@
+"""
+The buffer of recent events: what it holds above its floor, when its answer is complete, and how replays fill in the
+rest from the database.
+"""
+from test_relay import run, signed
+
+from ekiden.hoshi import Hoshi
+from ekiden.hot import HotEvents
+from ekiden.nips import CompactEvent, Filters, Kind
+
+
+def hot_events(size: int) -> HotEvents:
+    hot = HotEvents(size=size, age=0)
+    # warmed from an empty database
+    hot.warmed = True
+    return hot
+
+
+def note(created_at: int, content: str = "") -> CompactEvent:
+    return CompactEvent.verify(signed(content=content or str(created_at), created_at=created_at))
+
+
+def test_everything_is_held_until_the_buffer_is_full():
+    hot = hot_events(size=3)
+    for created_at in (1, 2, 3):
+        hot.add(note(created_at))
+    assert hot.floor is None
+    events, complete = hot.match(Filters(), limit=10)
+    assert [event.created_at for event in events] == [3, 2, 1]
+    assert complete
+
+
+def test_floor_moves_up_to_the_dropped_events():
+    hot = hot_events(size=3)
+    for created_at in (1, 2, 3, 4):
+        hot.add(note(created_at))
+    assert len(hot) == 3 and hot.floor == 1
+
+    # older than the floor, left to the database
+    hot.add(note(1, "late"))
+    assert len(hot) == 3 and hot.floor == 1
+
+
+def test_answer_is_complete_only_when_nothing_below_the_floor_can_match():
+    hot = hot_events(size=3)
+    for created_at in (1, 2, 3, 4):
+        hot.add(note(created_at))
+
+    events, complete = hot.match(Filters(), limit=10)
+    assert [event.created_at for event in events] == [4, 3, 2] and not complete
+    events, complete = hot.match(Filters(), limit=2)
+    assert [event.created_at for event in events] == [4, 3] and complete
+    events, complete = hot.match(Filters(since=1), limit=10)
+    assert [event.created_at for event in events] == [4, 3, 2] and complete
+    _, complete = hot.match(Filters(since=0), limit=10)
+    assert not complete
+
+
+def test_newer_replaceable_version_replaces_the_held_one():
+    hot = hot_events(size=10)
+    old = CompactEvent.verify(signed(Kind.set_metadata, "old", created_at=1))
+    new = CompactEvent.verify(signed(Kind.set_metadata, "new", created_at=2))
+    hot.add(old)
+    hot.add(new)
+    hot.add(old)
+    assert new.id in hot and old.id not in hot
+
+
+def test_deleted_event_is_forgotten():
+    hot = hot_events(size=10)
+    deleted = note(1)
+    hot.add(deleted)
+    hot.add(CompactEvent.verify(signed(Kind.delete, tags=[["e", deleted.id]], created_at=2)))
+    assert deleted.id not in hot
+
+
+def test_replay_completes_from_the_database_below_the_floor(tmp_path):
+    async def scenario(storage, worker):
+        relay = worker(hot=HotEvents(size=3, age=0))
+        await relay.relay.hot.warm(storage)
+        # two events in the second the floor ends up at, only one of them is still held
+        published = [signed(content=content, created_at=created_at) for created_at, content in enumerate("abcdef", 1)]
+        published.append(signed(content="same second", created_at=4))
+        for event in published:
+            await relay.publish(event)
+        assert relay.relay.hot.floor == 4 and len(relay.relay.hot) == 3
+
+        hoshi = Hoshi()
+        hoshi.relay, hoshi.storage = relay.relay, storage
+        newest_first = sorted(published, key=lambda event: (event["created_at"], event["id"]), reverse=True)
+
+        replayed = [event_id async for event_id, _ in hoshi.stored_events(Filters(), limit=100)]
+        assert replayed == [event["id"] for event in newest_first]
+        replayed = [event_id async for event_id, _ in hoshi.stored_events(Filters(until=5), limit=3)]
+        assert replayed == [event["id"] for event in newest_first[2:5]]
+        assert relay.relay.hot.hits == 0
+
+        replayed = [event_id async for event_id, _ in hoshi.stored_events(Filters(), limit=2)]
+        assert replayed == [event["id"] for event in newest_first[:2]]
+        assert relay.relay.hot.hits == 1
+
+    run(scenario, tmp_path)
+
+
+def test_events_stored_while_warming_are_kept(tmp_path):
+    async def scenario(storage, worker):
+        stored, arriving = note(1), note(2)
+        await storage.store_events([stored])
+        hot = HotEvents(size=10, age=0)
+
+        class Storing:
+            async def stream_events(self, filters, limit, page_size):
+                async for row in storage.stream_events(filters, limit=limit, page_size=page_size):
+                    # stored and delivered by another worker while the stored events are read
+                    hot.add(arriving)
+                    yield row
+
+        await hot.warm(Storing())
+        assert stored.id in hot and arriving.id in hot
+        events, complete = hot.match(Filters(), limit=10)
+        assert [event.id for event in events] == [arriving.id, stored.id] and complete
+
+    run(scenario, tmp_path)
+
+
+def test_reset_buffer_answers_nothing_until_warmed_again(tmp_path):
+    async def scenario(storage, worker):
+        relay = worker(hot=HotEvents(size=10, age=0))
+        await relay.relay.hot.warm(storage)
+        await relay.publish(signed(content="published"))
+        # written behind the relay's back, e.g. by `ekiden import`
+        imported = note(1, "imported")
+        await storage.store_events([imported])
+
+        relay.relay.lost()
+        assert relay.relay.hot.match(Filters(), limit=10) == ([], False)
+        await relay.relay._resync
+        events, complete = relay.relay.hot.match(Filters(), limit=10)
+        assert imported.id in {event.id for event in events} and complete
+
+    run(scenario, tmp_path)
@@ -0,0 +1,154 @@
+"""
+Client messages handled by `Hoshi` that are answered without touching storage or verification: malformed requests get
+a NOTICE or a CLOSED instead of tearing the connection down.
+"""
+import asyncio
+import json
+
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import WebSocketRoute
+from starlette.testclient import TestClient
+
+from ekiden.config import settings
+from ekiden.hoshi import Hoshi
+from ekiden.nips import Filters
+from ekiden.subscriptions import Subscription
+
+
+class Connection:
+    """Stands in for `connections.Connection`, recording the frames queued for the client"""
+
+    def __init__(self):
+        self.frames = []
+
+    async def put(self, frame: str):
+        self.frames.append(json.loads(frame))
+
+
+@pytest.fixture
+def client():
+    # the relay is never started: nothing sent by these tests may reach storage
+    with TestClient(Starlette(routes=[WebSocketRoute("/", endpoint=Hoshi())])) as client:
+        with client.websocket_connect("/") as websocket:
+            yield websocket
+
+
+def answer(websocket, message) -> list:
+    websocket.send_text(json.dumps(message))
+    return json.loads(websocket.receive_text())
+
+
+@pytest.mark.parametrize("pubkey", [["a", "list"], {"a": "dict"}, 1, None])
+def test_event_with_a_pubkey_that_is_not_a_string_is_refused(client, pubkey):
+    assert answer(client, ["EVENT", {"id": "ab" * 32, "pubkey": pubkey}]) == [
+        "OK",
+        "ab" * 32,
+        "false",
+        "invalid: pubkey must be a string",
+    ]
+
+
+def test_event_that_is_not_an_object_is_refused(client):
+    assert answer(client, ["EVENT", ["not", "an", "event"]])[:3] == ["OK", "", "false"]
+
+
+def test_count_without_filters_is_closed():
+    connection = Connection()
+    asyncio.run(Hoshi().handle_count(connection=connection, subscription_id="c", filters_dicts=[]))
+    [(kind, subscription_id, message)] = connection.frames
+    assert (kind, subscription_id) == ("CLOSED", "c")
+    assert message.startswith("invalid:")
+
+
+@pytest.mark.parametrize("filters", [{"kinds": ["x"]}, 5, {"since": "yesterday"}])
+def test_count_with_malformed_filters_is_closed(client, filters):
+    kind, subscription_id, message = answer(client, ["COUNT", "c", {}, filters])
+    assert (kind, subscription_id) == ("CLOSED", "c")
+    assert message.startswith("invalid:")
+    # the connection is still usable
+    assert answer(client, ["COUNT", "c"])[:2] == ["CLOSED", "c"]
+
+
+@pytest.mark.parametrize("filters", [{"kinds": "abc"}, "notadict", {"limit": "x"}])
+def test_req_with_malformed_filters_is_closed(client, filters):
+    kind, subscription_id, message = answer(client, ["REQ", "s", filters])
+    assert (kind, subscription_id) == ("CLOSED", "s")
+    assert message.startswith("invalid:")
+    assert len(Hoshi.sub_pool) == 0
+    # the connection is still usable
+    assert answer(client, ["COUNT", "c"])[:2] == ["CLOSED", "c"]
+
+
+def test_replay_slot_is_only_held_while_a_page_is_read():
+    async def main():
+        hoshi = Hoshi()
+        hoshi.replay_slots = asyncio.Semaphore(1)
+        size = settings.replay_page_size
+
+        async def events():
+            for number in range(2 * size + 1):
+                assert hoshi.replay_slots.locked()
+                yield str(number), "{}"
+
+        pages = []
+        async for page in hoshi.pages(events()):
+            # frames are queued, possibly waiting on a slow client, without the slot
+            assert not hoshi.replay_slots.locked()
+            pages.append(len(page))
+        return pages
+
+    assert asyncio.run(main()) == [settings.replay_page_size, settings.replay_page_size, 1]
+
+
+def test_replay_cap_is_shared_by_the_filters_of_a_req(monkeypatch):
+    monkeypatch.setattr(settings, "replay_max_events", 5)
+    limits = []
+
+    class Stored(Hoshi):
+        async def stored_events(self, filters, limit):
+            limits.append(limit)
+            for number in range(limit):
+                yield f"{filters.kinds[0]}-{number}", "{}"
+
+    connection = Connection()
+    filters = [Filters(kinds=[kind]) for kind in range(100)]
+    asyncio.run(Stored().send_stored(Subscription(filters, connection, "s")))
+    assert limits == [5]
+    assert len(connection.frames) == 5
+
+    connection, limits[:] = Connection(), []
+    filters = [Filters(kinds=[kind], limit=2) for kind in range(100)]
+    asyncio.run(Stored().send_stored(Subscription(filters, connection, "s")))
+    assert limits == [2, 2, 1]
+    assert len(connection.frames) == 5
+
+
+def test_connection_closed_under_the_endpoint_ends_it_quietly():
+    class WebSocket:
+        """A client whose socket fails on the first frame written to it, and keeps sending"""
+
+        client = None
+
+        async def accept(self):
+            pass
+
+        async def receive(self) -> dict:
+            # the writer gets to fail in between
+            await asyncio.sleep(0.01)
+            return {"type": "websocket.receive", "text": json.dumps(["COUNT", "c"])}
+
+        async def send_text(self, data: str):
+            raise ConnectionResetError
+
+    asyncio.run(asyncio.wait_for(Hoshi().endpoint(WebSocket()), 1))
+
+
+@pytest.mark.parametrize("subscription_id", [{"a": 1}, ["a"], 1, None, "", "x" * 65])
+@pytest.mark.parametrize("verb", ["REQ", "COUNT", "CLOSE"])
+def test_invalid_subscription_id_gets_a_notice(client, verb, subscription_id):
+    message = [verb, subscription_id] if verb == "CLOSE" else [verb, subscription_id, {}]
+    kind, notice = answer(client, message)
+    assert kind == "NOTICE" and notice.startswith("invalid:")
+    # the connection is still usable
+    assert answer(client, ["COUNT", "c"])[:2] == ["CLOSED", "c"]
@@ -0,0 +1,63 @@
+"""
+Access to /debug/profile: it is always routed, answers only while the profiler is enabled, and only to the holder of
+the profiler token or, without one, to local clients.
+"""
+import pytest
+from starlette.requests import Request
+from starlette.testclient import TestClient
+
+from ekiden import main
+from ekiden.config import settings
+
+
+@pytest.fixture
+def client():
+    # used outside of a with block, the relay isn't started
+    return TestClient(main.create_app())
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(main.profiler, "enabled", True)
+
+
+def request_from(host: str) -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": [], "client": (host, 1234)})
+
+
+def test_disabled_profiler_is_not_found(client, monkeypatch):
+    monkeypatch.setattr(main.profiler, "enabled", False)
+    assert client.get("/debug/profile?seconds=0").status_code == 404
+
+
+def test_signal_toggles_the_profiler(monkeypatch):
+    monkeypatch.setattr(main.profiler, "enabled", False)
+    main.toggle_profiler()
+    assert main.profiler.enabled
+    main.toggle_profiler()
+    assert not main.profiler.enabled
+
+
+def test_remote_client_without_token_is_refused(client, enabled):
+    # the test client's address is not a loopback one
+    assert client.get("/debug/profile?seconds=0").status_code == 403
+
+
+@pytest.mark.parametrize("host, allowed", [("127.0.0.1", True), ("::1", True), ("192.0.2.1", False), ("a", False)])
+def test_local_clients_are_allowed_without_token(host, allowed):
+    assert main.profiling_allowed(request_from(host)) is allowed
+
+
+def test_behind_a_proxy_every_client_needs_the_token(monkeypatch):
+    monkeypatch.setattr(settings, "trusted_proxies", 1)
+    assert not main.profiling_allowed(request_from("127.0.0.1"))
+
+
+def test_token_is_required_once_set(client, enabled, monkeypatch):
+    monkeypatch.setattr(settings, "profiler_token", "secret")
+    assert client.get("/debug/profile?seconds=0").status_code == 403
+    assert client.get("/debug/profile?seconds=0", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    assert not main.profiling_allowed(request_from("127.0.0.1"))
+
+    response = client.get("/debug/profile?seconds=0", headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 200
@@ -0,0 +1,220 @@
+"""
+Ingestion through `AsyncRelay.event`: what gets stored, answered and fanned out to subscribers, against a real SQLite
+database. Each relay stands for one worker, relays sharing a storage stand for workers of the same server.
+"""
+import asyncio
+import itertools
+import json
+
+import pytest
+
+from ekiden.dedup import RecentIds
+from ekiden.keys import PrivateKey
+from ekiden.nips import CompactEvent, Event, Kind, create_tag
+from ekiden.relay import AsyncRelay
+from ekiden.storage import SqliteStorage
+
+KEY = PrivateKey()
+PUBKEY = KEY.public_key_hex()
+_created_at = itertools.count(1_700_000_000)
+
+
+def signed(kind: int = Kind.text_note, content: str = "", tags=(), created_at: int = None, key=KEY) -> dict:
+    event = Event(
+        pubkey=key.public_key_hex(),
+        created_at=created_at or next(_created_at),
+        kind=int(kind),
+        tags=[create_tag(tag) for tag in tags],
+        content=content,
+    )
+    return event.signed(key.hex())
+
+
+class Subscribers:
+    """Stands in for the subscription pool, recording what was broadcast"""
+
+    def __init__(self):
+        self.events = []
+
+    async def broadcast(self, event: CompactEvent):
+        self.events.append(event.id)
+
+
+class Worker:
+    def __init__(self, storage: SqliteStorage, **kwargs):
+        self.subscribers = Subscribers()
+        self.relay = AsyncRelay(self.subscribers, storage, **kwargs)
+
+    async def publish(self, event: dict) -> list:
+        return json.loads(await self.relay.event(dict(event)))
+
+
+def run(scenario, tmp_path):
+    async def main():
+        storage = SqliteStorage(path=str(tmp_path / "ekiden.sqlite3"), readers=1)
+        await storage.open()
+        workers = []
+
+        def worker(**kwargs) -> Worker:
+            workers.append(Worker(storage, **kwargs))
+            return workers[-1]
+
+        try:
+            await scenario(storage, worker)
+        finally:
+            for each in workers:
+                await each.relay.close()
+            await storage.close()
+
+    asyncio.run(main())
+
+
+async def stored_versions(storage: SqliteStorage, kind: int) -> list:
+    return [event_id for _, _, _, event_id, _ in await storage.latest_events([PUBKEY], [kind])]
+
+
+def test_newer_replaceable_version_replaces_the_stored_one(tmp_path):
+    async def scenario(storage, worker):
+        relay = worker()
+        old, new = signed(Kind.set_metadata, "old", created_at=100), signed(Kind.set_metadata, "new", created_at=200)
+
+        assert (await relay.publish(old))[2] == "true"
+        assert (await relay.publish(new))[2] == "true"
+        assert relay.subscribers.events == [old["id"], new["id"]]
+        assert await stored_versions(storage, Kind.set_metadata) == [new["id"]]
+
+    run(scenario, tmp_path)
+
+
+def test_stale_replaceable_version_is_rejected(tmp_path):
+    async def scenario(storage, worker):
+        relay = worker()
+        new, old = signed(Kind.set_metadata, "new", created_at=200), signed(Kind.set_metadata, "old", created_at=100)
+
+        await relay.publish(new)
+        ok = await relay.publish(old)
+        assert ok[2] == "false" and ok[3].startswith("invalid:")
+        assert relay.subscribers.events == [new["id"]]
+        assert await stored_versions(storage, Kind.set_metadata) == [new["id"]]
+
+    run(scenario, tmp_path)
+
+
+def test_stale_version_unknown_to_the_worker_never_reaches_subscribers(tmp_path):
+    async def scenario(storage, worker):
+        first, second = worker(), worker()
+        new, old = signed(Kind.set_metadata, "new", created_at=200), signed(Kind.set_metadata, "old", created_at=100)
+
+        await first.publish(new)
+        # the second worker never heard of the newer version, only the database knows it
+        ok = await second.publish(old)
+        assert ok[2] == "false" and ok[3].startswith("invalid:")
+        assert second.subscribers.events == []
+        assert second.relay.latest.get(PUBKEY, Kind.set_metadata) is None
+        versions = await second.relay.latest_versions([PUBKEY], [Kind.set_metadata])
+        assert [version.id for version in versions] == [new["id"]]
+
+    run(scenario, tmp_path)
+
+
+def test_deletion_removes_the_event_and_refuses_it_again(tmp_path):
+    async def scenario(storage, worker):
+        relay = worker()
+        note = signed(content="to be deleted")
+        deletion = signed(Kind.delete, tags=[["e", note["id"]]])
+
+        await relay.publish(note)
+        assert (await relay.publish(deletion))[2] == "true"
+        assert note["id"] in relay.relay.tombstones
+        assert [event_id for event_id, _ in await storage.tombstones()] == [note["id"]]
+
+        ok = await relay.publish(note)
+        assert ok[2] == "false" and "deleted" in ok[3]
+        assert relay.subscribers.events == [note["id"], deletion["id"]]
+
+    run(scenario, tmp_path)
+
+
+def test_deletion_only_covers_events_of_the_same_author(tmp_path):
+    async def scenario(storage, worker):
+        relay = worker()
+        note = signed(content="someone else's")
+        deletion = signed(Kind.delete, tags=[["e", note["id"]]], key=PrivateKey())
+
+        await relay.publish(note)
+        await relay.publish(deletion)
+        ok = await relay.publish(note)
+        assert ok[2] == "true" and ok[3].startswith("duplicate:")
+
+    run(scenario, tmp_path)
+
+
+def test_tombstones_are_loaded_on_start(tmp_path):
+    async def scenario(storage, worker):
+        note = signed(content="deleted before the restart")
+        await worker().publish(note)
+        await worker().publish(signed(Kind.delete, tags=[["e", note["id"]]]))
+
+        restarted = worker()
+        await restarted.relay.start()
+        ok = await restarted.publish(note)
+        assert ok[2] == "false" and "deleted" in ok[3]
+        assert restarted.subscribers.events == []
+
+    run(scenario, tmp_path)
+
+
+@pytest.mark.parametrize("kind", [Kind.set_metadata, Kind.contact_list])
+def test_deleted_replaceable_version_is_forgotten(kind, tmp_path):
+    async def scenario(storage, worker):
+        relay = worker()
+        version = signed(kind)
+        await relay.publish(version)
+        await relay.publish(signed(Kind.delete, tags=[["e", version["id"]]]))
+
+        assert relay.relay.latest.get(PUBKEY, kind) is None
+        assert await stored_versions(storage, kind) == []
+
+    run(scenario, tmp_path)
+
+
+def test_duplicate_is_not_broadcast_again(tmp_path):
+    async def scenario(storage, worker):
+        relay = worker()
+        note = signed(content="twice")
+
+        assert (await relay.publish(note))[2:] == ["true", ""]
+        ok = await relay.publish(note)
+        assert ok[2] == "true" and ok[3].startswith("duplicate:")
+        assert relay.subscribers.events == [note["id"]]
+
+    run(scenario, tmp_path)
+
+
+def test_duplicate_evicted_from_recent_ids_is_not_broadcast_again(tmp_path):
+    async def scenario(storage, worker):
+        relay = worker(recent_ids=RecentIds(size=1))
+        first, second = signed(content="first"), signed(content="second")
+
+        await relay.publish(first)
+        await relay.publish(second)
+        # only the database remembers the first event now
+        ok = await relay.publish(first)
+        assert ok[2] == "true" and ok[3].startswith("duplicate:")
+        assert relay.subscribers.events == [first["id"], second["id"]]
+
+    run(scenario, tmp_path)
+
+
+def test_delivered_event_is_broadcast_once(tmp_path):
+    async def scenario(storage, worker):
+        relay = worker()
+        note = CompactEvent.verify(signed(content="from another worker"))
+
+        await relay.relay.deliver(note)
+        await relay.relay.deliver(note)
+        assert relay.subscribers.events == [note.id]
+        ok = await relay.publish(signed(content="from another worker", created_at=note.created_at))
+        assert ok[2] == "true" and ok[3].startswith("duplicate:")
+
+    run(scenario, tmp_path)
@@ -0,0 +1,150 @@
+"""
+Events kept for a limited time: partitions by max age and `created_at` are read as one table, dropped whole once
+expired, and events with a NIP-40 expiration tag are deleted by compaction, the maintained counts following along.
+"""
+import asyncio
+import time
+from hashlib import sha256
+
+from test_relay import KEY, PUBKEY, signed
+
+from ekiden.nips import CompactEvent, Filters, Kind, dump_json
+from ekiden.retention import Retention
+from ekiden.storage import SqliteStorage
+
+AGE = 1_000_000
+PARTITION_SECONDS = 100
+# the start of a partition a few partitions back, so every event below is in the past
+START = int(time.time()) // PARTITION_SECONDS * PARTITION_SECONDS - 5 * PARTITION_SECONDS
+
+
+def run(scenario, tmp_path):
+    async def main():
+        retention = Retention(ages={Kind.text_note: AGE}, default=0, partition_seconds=PARTITION_SECONDS)
+        storage = SqliteStorage(path=str(tmp_path / "ekiden.sqlite3"), readers=1, retention=retention)
+        await storage.open()
+        try:
+            await scenario(storage)
+        finally:
+            await storage.close()
+
+    asyncio.run(main())
+
+
+def event(kind: int = Kind.text_note, created_at: int = START, content: str = "", expires_at: int = None):
+    if expires_at is None:
+        return CompactEvent.verify(signed(kind, content or str(created_at), created_at=created_at))
+    # `signed` only knows e and p tags
+    tags = [["expiration", str(expires_at)]]
+    kind = int(kind)
+    event_id = sha256(dump_json([0, PUBKEY, created_at, kind, tags, content]).encode("utf-8")).hexdigest()
+    return CompactEvent.verify(
+        {
+            "id": event_id,
+            "pubkey": PUBKEY,
+            "created_at": created_at,
+            "kind": kind,
+            "tags": tags,
+            "content": content,
+            "sig": KEY.sign(bytes.fromhex(event_id)),
+        }
+    )
+
+
+def newest_first(events: list) -> list:
+    return [event.id for event in sorted(events, key=lambda event: (event.created_at, event.id), reverse=True)]
+
+
+async def replayed(storage: SqliteStorage, filters: Filters, limit: int = 100) -> list:
+    return [event_id async for event_id, _ in storage.stream_events(filters, limit=limit, page_size=2)]
+
+
+async def partitions(storage: SqliteStorage) -> list:
+    async with storage.reader() as tx:
+        return sorted(partition.start - START for partition in await storage._partitions(tx))
+
+
+async def counts(storage: SqliteStorage, filters: Filters) -> int:
+    aggregate = await storage.aggregate_count(filters)
+    assert aggregate == await storage.indexed_count([filters], 5)
+    return aggregate
+
+
+def test_partitions_are_merged_newest_first(tmp_path):
+    notes = [event(created_at=START + offset) for offset in (5, 105, 205, 305, 399)]
+    # the same second as a note of another partition, ties are broken on the id like in a single table
+    notes.append(event(created_at=START + 105, content="tie"))
+    kept = [event(Kind.set_metadata, START + 50), event(Kind.delete, START + 250), event(7, START + 305)]
+
+    async def scenario(storage):
+        await storage.store_events(notes + kept)
+        assert await partitions(storage) == [0, 100, 200, 300]
+
+        everything = newest_first(notes + kept)
+        assert await replayed(storage, Filters()) == everything
+        for limit in (1, 3, 4, 7):
+            assert await replayed(storage, Filters(), limit) == everything[:limit]
+        assert await replayed(storage, Filters(kinds=[1])) == newest_first(notes)
+
+        window = Filters(since=START + 105, until=START + 399)
+        expected = newest_first([event for event in notes + kept if START + 105 < event.created_at < START + 399])
+        assert await replayed(storage, window) == expected
+        assert await replayed(storage, window, 2) == expected[:2]
+
+    run(scenario, tmp_path)
+
+
+def test_expired_partitions_are_dropped_with_their_counts(tmp_path):
+    notes = [event(created_at=START + offset) for offset in (5, 50, 105, 205)]
+    profile = event(Kind.set_metadata, START + 10)
+
+    async def scenario(storage):
+        await storage.store_events(notes + [profile])
+        assert await counts(storage, Filters(kinds=[1])) == 4
+        assert await counts(storage, Filters(authors=[PUBKEY])) == 5
+
+        # nothing has expired yet
+        assert await storage.drop_partitions(START + AGE) == []
+        # the newest event of the first partition is as old as its kind may get
+        dropped = await storage.drop_partitions(START + PARTITION_SECONDS - 1 + AGE)
+        assert [partition.start - START for partition in dropped] == [0]
+        assert await partitions(storage) == [100, 200]
+
+        assert await replayed(storage, Filters()) == newest_first(notes[2:] + [profile])
+        assert await counts(storage, Filters(kinds=[1])) == 2
+        assert await counts(storage, Filters(authors=[PUBKEY])) == 3
+        assert await counts(storage, Filters(authors=[PUBKEY], kinds=[1])) == 2
+
+    run(scenario, tmp_path)
+
+
+def test_events_past_their_expiration_tag_are_deleted_in_batches(tmp_path):
+    now = int(time.time())
+    expired = [
+        event(created_at=START + 1, content="in a partition", expires_at=now - 10),
+        event(7, START + 2, "kept for good otherwise", expires_at=now - 5),
+        event(7, START + 3, "also expired", expires_at=now - 1),
+    ]
+    later = event(7, START + 4, "expires later", expires_at=now + 3600)
+    kept = event(7, START + 5, "no expiration")
+
+    async def scenario(storage):
+        await storage.store_events(expired + [later, kept])
+        # expired events are no longer replayed, but the maintained counts hold them until they are deleted
+        assert await replayed(storage, Filters()) == newest_first([later, kept])
+        assert await storage.aggregate_count(Filters(kinds=[7])) == 4
+
+        deleted = []
+        while batch := await storage.delete_expired(now, batch=2):
+            assert len(batch) <= 2
+            deleted.extend(batch)
+        assert sorted(deleted) == sorted((event.id, PUBKEY) for event in expired)
+
+        assert await replayed(storage, Filters()) == newest_first([later, kept])
+        assert await counts(storage, Filters(kinds=[7])) == 2
+        assert await counts(storage, Filters(kinds=[1])) == 0
+        # deleting again finds nothing, the expiration of the later event still waits
+        assert await storage.delete_expired(now, batch=2) == []
+        assert [event_id for event_id, _ in await storage.delete_expired(now + 3600, batch=2)] == [later.id]
+
+    run(scenario, tmp_path)
@@ -0,0 +1,213 @@
+"""
+The SQLite schema: databases written by earlier versions are migrated when opened, and the counts kept alongside the
+events answer COUNT requests exactly like counting the rows would.
+"""
+import asyncio
+import json
+import sqlite3
+
+import pytest
+from pydantic import ValidationError
+from test_relay import KEY, PUBKEY, signed
+
+from ekiden.keys import PrivateKey
+from ekiden.nips import CompactEvent, Filters, Kind
+from ekiden.storage import EVENT_INDEXES, MIGRATIONS, SqliteStorage, _SqliteTransaction
+
+# the table `Tortoise.generate_schemas` created for the first `database.Event` model
+LEGACY_SCHEMA = """CREATE TABLE "event" (
+    "table_id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    "id" TEXT NOT NULL,
+    "kind" INT NOT NULL,
+    "content" TEXT NOT NULL,
+    "created_at" INT NOT NULL,
+    "tags" JSON NOT NULL,
+    "pubkey" TEXT NOT NULL,
+    "sig" TEXT NOT NULL
+)"""
+
+
+def legacy_tags(event: dict) -> str:
+    # tags were stored as the fields of `nips.ETag` and `nips.PTag`
+    fields = {"e": "id", "p": "pubkey"}
+    return json.dumps([{fields[name]: value, "recommended_relay_url": url} for name, value, url in event["tags"]])
+
+
+def legacy_database(path: str, events: list):
+    db = sqlite3.connect(path)
+    db.execute(LEGACY_SCHEMA)
+    db.executemany(
+        'INSERT INTO "event" ("id", "kind", "content", "created_at", "tags", "pubkey", "sig") '
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (
+                event["id"],
+                event["kind"],
+                event["content"],
+                event["created_at"],
+                legacy_tags(event),
+                PUBKEY,
+                event["sig"],
+            )
+            for event in events
+        ],
+    )
+    db.commit()
+    db.close()
+
+
+def run(scenario, path: str):
+    async def main():
+        storage = SqliteStorage(path=path, readers=1)
+        await storage.open()
+        try:
+            await scenario(storage)
+        finally:
+            await storage.close()
+
+    asyncio.run(main())
+
+
+def user_version(path: str) -> int:
+    db = sqlite3.connect(path)
+    try:
+        return db.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        db.close()
+
+
+def indexes(path: str) -> set:
+    db = sqlite3.connect(path)
+    try:
+        return {
+            name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'event'")
+        }
+    finally:
+        db.close()
+
+
+def test_new_database_needs_no_migration(tmp_path):
+    path = str(tmp_path / "ekiden.sqlite3")
+
+    async def scenario(storage):
+        pass
+
+    run(scenario, path)
+    assert user_version(path) == len(MIGRATIONS)
+
+
+def test_legacy_database_is_migrated(tmp_path):
+    path = str(tmp_path / "ekiden.sqlite3")
+    note = signed(content="stored by the first version, é", tags=[["p", PUBKEY]])
+    reply = signed(content="reply", tags=[["e", note["id"], "wss://relay.example"]])
+    legacy_database(path, [note, reply, reply])
+
+    async def scenario(storage):
+        stored = [json.loads(raw) async for _, raw in storage.stream_events(Filters(), limit=10, page_size=10)]
+        assert stored == [reply, note]
+        for filters in ({"#e": [note["id"]]}, {"#p": [PUBKEY]}):
+            filters = Filters.parse_obj(filters)
+            assert await storage.indexed_count([filters], 5) == await storage.aggregate_count(filters) == 1
+        # the event is refused as already stored now that ids are unique
+        assert await storage.store_events([CompactEvent.verify(dict(note))]) == set()
+
+    run(scenario, path)
+    assert user_version(path) == len(MIGRATIONS)
+    assert {f"idx_event_{'_'.join(columns)}" for columns in EVENT_INDEXES} <= indexes(path)
+    assert not {"idx_event_pubkey_kind_created_at", "idx_event_kind_created_at"} & indexes(path)
+    run(scenario, path)
+
+
+def test_maintained_counts_follow_replacement_and_deletion(tmp_path):
+    other = signed(content="mentioned")["id"]
+    note = signed(content="note", tags=[["e", other], ["p", PUBKEY]])
+    kept = signed(content="kept", tags=[["e", other]])
+    profile = signed(Kind.set_metadata, "profile", tags=[["p", PUBKEY]], created_at=100)
+    newer_profile = signed(Kind.set_metadata, "newer profile", created_at=200)
+    stale_profile = signed(Kind.set_metadata, "stale profile", tags=[["e", other]], created_at=50)
+    deletion = signed(Kind.delete, tags=[["e", note["id"]]])
+    shapes = [
+        {"kinds": [0]},
+        {"kinds": [1, 5]},
+        {"authors": [PUBKEY]},
+        {"authors": [PUBKEY], "kinds": [0, 1]},
+        {"#e": [other]},
+        {"#e": [other], "kinds": [1]},
+        {"#p": [PUBKEY]},
+        {"#e": [note["id"]]},
+    ]
+
+    async def scenario(storage):
+        async def counts() -> list:
+            counted = []
+            for shape in shapes:
+                filters = Filters.parse_obj(shape)
+                aggregate = await storage.aggregate_count(filters)
+                assert aggregate == await storage.indexed_count([filters], 5), shape
+                counted.append(aggregate)
+            return counted
+
+        await storage.store_events([CompactEvent.verify(dict(event)) for event in (note, kept, profile)])
+        assert await counts() == [1, 2, 3, 3, 2, 2, 2, 0]
+        await storage.store_events([CompactEvent.verify(dict(event)) for event in (newer_profile, stale_profile)])
+        assert await counts() == [1, 2, 3, 3, 2, 2, 1, 0]
+        await storage.store_events([CompactEvent.verify(dict(deletion))])
+        assert await counts() == [1, 2, 3, 2, 1, 1, 0, 1]
+
+    run(scenario, str(tmp_path / "ekiden.sqlite3"))
+
+
+@pytest.mark.parametrize(
+    "shape",
+    [{}, {"authors": [PUBKEY]}, {"kinds": [1]}, {"authors": [PUBKEY], "kinds": [1]}, {"since": 1, "until": 2e9}],
+)
+def test_every_replay_page_is_an_index_range(shape, tmp_path, monkeypatch):
+    plans = []
+    fetchall = _SqliteTransaction.fetchall
+
+    async def explained(tx, sql, params=()):
+        if sql.startswith('SELECT "created_at", "id", "raw"'):
+            plan = await tx.connection.execute_fetchall(f"EXPLAIN QUERY PLAN {sql}", params)
+            plans.append([detail for *_, detail in plan])
+        return await fetchall(tx, sql, params)
+
+    async def scenario(storage):
+        events = [CompactEvent.verify(signed(content=str(n))) for n in range(3)]
+        await storage.store_events(events)
+        monkeypatch.setattr(_SqliteTransaction, "fetchall", explained)
+        stored = [event_id async for event_id, _ in storage.stream_events(Filters.parse_obj(shape), 3, page_size=1)]
+        assert stored == [event.id for event in reversed(events)]
+
+    run(scenario, str(tmp_path / "ekiden.sqlite3"))
+    assert len(plans) == 3
+    # events are read in index order, never sorted, and the pages after the first seek to where the last one ended
+    assert not [detail for plan in plans for detail in plan if "TEMP B-TREE" in detail]
+    for plan in plans[1:]:
+        assert not [detail for detail in plan if detail.startswith("SCAN")], plan
+
+
+@pytest.mark.parametrize("value", ["\U0010ffff", "ABCD", "zz", "a" * 65])
+@pytest.mark.parametrize("field", ["ids", "authors"])
+def test_prefixes_must_be_lowercase_hex(field, value):
+    with pytest.raises(ValidationError):
+        Filters.parse_obj({field: [value]})
+
+
+def test_prefixes_are_index_ranges(tmp_path):
+    keys = [KEY, PrivateKey(), PrivateKey()]
+    events = [CompactEvent.verify(signed(content=str(n), key=keys[n % 3])) for n in range(30)]
+
+    async def scenario(storage):
+        await storage.store_events(events)
+        for field, value in [("ids", lambda event: event.id), ("authors", lambda event: event.pubkey)]:
+            for prefix in ["", "0", "f", "7", "ff", *{value(event)[:3] for event in events}, value(events[0])]:
+                matched = [
+                    event_id
+                    async for event_id, _ in storage.stream_events(
+                        Filters.parse_obj({field: [prefix]}), limit=100, page_size=7
+                    )
+                ]
+                expected = [event.id for event in reversed(events) if value(event).startswith(prefix)]
+                assert matched == expected, (field, prefix)
+
+    run(scenario, str(tmp_path / "ekiden.sqlite3"))
@@ -0,0 +1,108 @@
+"""
+The indexed `SubscriptionPool` must send an event to exactly the subscriptions a linear scan with `validate_filters`
+would, whatever the shape of their filters.
+"""
+import random
+
+import pytest
+
+from ekiden.nips import CompactEvent, Filters
+from ekiden.subscriptions import (
+    CompiledFilters,
+    Subscription,
+    SubscriptionPool,
+    validate_filters,
+)
+
+# few distinct values, so filters and events share plenty of them
+HEXES = ["".join(random.Random(n).choice("0123456789abcdef") for _ in range(64)) for n in range(6)]
+KINDS = [0, 1, 3, 7]
+
+
+def values(rng: random.Random, prefixes: bool) -> list:
+    chosen = []
+    for _ in range(rng.randint(1, 3)):
+        value = rng.choice(HEXES)
+        if prefixes and rng.random() < 0.5:
+            # a prefix of a known value, or of one nothing has
+            value = value[: rng.randint(1, 63)] if rng.random() < 0.8 else "f" * rng.randint(1, 8)
+        chosen.append(value)
+    return chosen
+
+
+def random_filters(rng: random.Random) -> Filters:
+    data = {}
+    for field, prefixes in (("ids", True), ("authors", True), ("#e", False), ("#p", False)):
+        if rng.random() < 0.35:
+            data[field] = values(rng, prefixes)
+    if rng.random() < 0.35:
+        data["kinds"] = rng.sample(KINDS, rng.randint(1, 2))
+    if rng.random() < 0.2:
+        data["since"] = rng.randint(0, 10)
+    if rng.random() < 0.2:
+        data["until"] = rng.randint(0, 10)
+    return Filters.parse_obj(data)
+
+
+def random_event(rng: random.Random) -> CompactEvent:
+    tags = [(name, rng.choice(HEXES)) for name in "ep" for _ in range(rng.randint(0, 2))]
+    return CompactEvent(
+        id=rng.choice(HEXES),
+        pubkey=rng.choice(HEXES),
+        created_at=rng.randint(0, 10),
+        kind=rng.choice(KINDS),
+        tags=tuple(tags),
+        content="",
+        sig="",
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_pool_matches_like_a_linear_scan(seed):
+    rng = random.Random(seed)
+    pool = SubscriptionPool()
+    connections = [object() for _ in range(5)]
+    for n in range(300):
+        filters = [random_filters(rng) for _ in range(rng.randint(1, 3))]
+        pool.add_subscription(Subscription(filters, connection=rng.choice(connections), subscription_id=str(n)))
+
+    for _ in range(300):
+        event = random_event(rng)
+        expected = {
+            subscription
+            for subscription in pool.subscriptions()
+            if any(validate_filters(event, filters) for filters in subscription.filters)
+        }
+        assert pool.matching(event) == expected
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        {},
+        {"ids": [HEXES[0]]},
+        {"ids": [HEXES[0][:1], HEXES[1][:40]]},
+        {"authors": [HEXES[0][:63]]},
+        {"authors": [HEXES[1], HEXES[0][:10]], "kinds": [1]},
+        {"#e": [HEXES[2]], "#p": [HEXES[3]]},
+        {"since": 4, "until": 6},
+    ],
+)
+def test_compiled_filters_match_like_validate_filters(data):
+    rng = random.Random(0)
+    filters = Filters.parse_obj(data)
+    compiled = CompiledFilters.compile(filters)
+    for _ in range(500):
+        event = random_event(rng)
+        assert compiled.matches(event) == validate_filters(event, filters)
+
+
+def test_equal_filters_are_evaluated_once():
+    pool = SubscriptionPool()
+    for n, authors in enumerate(([HEXES[0], HEXES[1][:5]], [HEXES[1][:5], HEXES[0], HEXES[0]])):
+        pool.add_subscription(Subscription([Filters(authors=authors)], connection=object(), subscription_id=str(n)))
+    assert pool.distinct_filters() == 1
+
+    event = random_event(random.Random(0))
+    event.pubkey = HEXES[0]
+    assert {subscription.subscription_id for subscription in pool.matching(event)} == {"0", "1"}